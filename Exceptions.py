@@ -46,6 +46,12 @@ class AlreadyExists(Exception):
 class FullDumpMemoryFull(Exception):
     pass
 
+class HashTableFull(Exception):
+    pass
+
 class MissingDependency(Exception):
     pass
 
+class InvalidCheckpoint(Exception):
+    pass
+
@@ -18,12 +18,18 @@
 # limitations under the License.
 #
 
-__all__ = ['UltraDict']
+__all__ = ['UltraDict', 'ShardedUltraDict', 'HashTableUltraDict']
 
 import multiprocessing, multiprocessing.shared_memory, multiprocessing.synchronize
-import collections, os, pickle, sys, time, weakref
+import array, asyncio, collections, ctypes, functools, itertools, mmap, operator, os, pickle, platform, secrets, struct, sys, threading, time, weakref, zlib
 import importlib.util, importlib.machinery
 
+try:
+    # Needed to detect restarts of file backed dicts, see `path`
+    import fcntl
+except ModuleNotFoundError:
+    fcntl = None
+
 try:
     # Needed for the shared locked
     import atomics
@@ -46,6 +52,44 @@ except ModuleNotFoundError:
     except ModuleNotFoundError:
         import logging as log
 
+# Futex syscall numbers, used by the shared lock to wait for a release on Linux
+futex_syscalls = { 'x86_64': 202, 'aarch64': 98, 'riscv64': 98, 'i386': 240, 'i686': 240, 'armv7l': 240, 'ppc64le': 221, 's390x': 238 }
+futex_syscall = None
+
+if sys.platform == 'linux' and platform.machine() in futex_syscalls:
+    try:
+        import ctypes
+        futex_syscall = ctypes.CDLL(None, use_errno=True).syscall
+        futex_syscall.restype = ctypes.c_long
+
+        class Timespec(ctypes.Structure):
+            _fields_ = [ ('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long) ]
+    except (OSError, AttributeError):
+        futex_syscall = None
+
+# Compare-and-swap of 8 bytes, used for lock-free appends, see load_atomic_cas_8()
+atomic_cas_8 = None
+
+def load_atomic_cas_8():
+    """
+    Load the compare-and-swap of 8 bytes from libatomic on first use, only needed with `lock_free`.
+    Single operations of the atomics package take several microseconds, so libatomic is called directly.
+    """
+    global atomic_cas_8
+    if atomic_cas_8 is None:
+        import ctypes.util
+        library = ctypes.util.find_library('atomic')
+        try:
+            if not library:
+                raise OSError("libatomic not found")
+            cas = ctypes.CDLL(library).__atomic_compare_exchange_8
+        except (OSError, AttributeError) as e:
+            raise Exceptions.MissingDependency(f"lock_free=True needs libatomic, e.g. from the libatomic1 package of your system: {e}") from None
+        cas.restype = ctypes.c_bool
+        cas.argtypes = [ ctypes.c_void_p, ctypes.c_void_p, ctypes.c_uint64, ctypes.c_int, ctypes.c_int ]
+        atomic_cas_8 = cas
+    return atomic_cas_8
+
 def remove_shm_from_resource_tracker():
     """
     Monkey-patch multiprocessing.resource_tracker so SharedMemory won't be tracked
@@ -76,8 +120,130 @@ class UltraDict(collections.UserDict, dict):
     log = log
 
     class RLock(multiprocessing.synchronize.RLock):
-        """ Not yet used """
-        pass
+        """
+        Default lock if there is no shared lock, only works for forked processes.
+
+        It has no shared mode, so read() and write() both return the lock itself.
+        """
+
+        def read(self, *args, **kwargs):
+            return self
+
+        def write(self, *args, **kwargs):
+            return self
+
+    class FileMemory():
+        """
+        Memory-mapped file in the directory `path` with the same interface as
+        multiprocessing.shared_memory.SharedMemory, used as backend with `path`.
+
+        The file persists after all processes have closed it, until it gets unlinked.
+        """
+
+        __slots__ = 'name', 'size', 'buf', 'file_name', 'fd', 'mmap', 'created_by_ultra'
+
+        def __init__(self, path, name=None, create=False, size=0):
+            if name is None:
+                name = 'psm_' + secrets.token_hex(4)
+            self.name = name
+            self.file_name = os.path.join(path, name)
+
+            if create:
+                self.fd = os.open(self.file_name, os.O_RDWR | os.O_CREAT | os.O_EXCL, 0o600)
+                os.ftruncate(self.fd, size)
+            else:
+                self.fd = os.open(self.file_name, os.O_RDWR)
+                size = os.fstat(self.fd).st_size
+
+            self.size = size
+            self.mmap = mmap.mmap(self.fd, size)
+            self.buf = memoryview(self.mmap)
+
+        def close(self):
+            if self.buf is not None:
+                self.buf.release()
+                self.buf = None
+            if self.mmap is not None:
+                self.mmap.close()
+                self.mmap = None
+            if self.fd >= 0:
+                os.close(self.fd)
+                self.fd = -1
+
+        def unlink(self):
+            os.unlink(self.file_name)
+
+        def lock_shared(self, on_first):
+            """
+            Lock the file shared until it's closed, also if the process dies. If no other process
+            has it locked, call `on_first()` before, so the first process after a restart can reset
+            the state that the processes before have left in the file.
+
+            Does nothing if file locks are not available, e.g. on Windows.
+            """
+            if not fcntl:
+                return
+            try:
+                fcntl.flock(self.fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                try:
+                    on_first()
+                finally:
+                    fcntl.flock(self.fd, fcntl.LOCK_SH)
+            except BlockingIOError:
+                # Blocks until a first process has finished on_first()
+                fcntl.flock(self.fd, fcntl.LOCK_SH)
+
+    class Futex():
+        """
+        Futex in shared memory to sleep until woken up, only available on Linux.
+
+        Refers to 8 bytes, 4 bytes of wake counter used as futex and 4 bytes with
+        the number of waiters, so waking up only needs a syscall if someone is waiting.
+        """
+
+        __slots__ = 'address', 'wake_remote', 'wake_ctx', 'wake_atomic', 'waiters_remote', 'waiters_ctx', 'waiters_atomic'
+
+        # Wakes up all waiters
+        all = 2**31 - 1
+
+        def __init__(self, remote):
+            self.wake_ctx = atomics.atomicview(buffer=remote[0:4], atype=atomics.UINT)
+            self.waiters_ctx = atomics.atomicview(buffer=remote[4:8], atype=atomics.UINT)
+            self.wake_atomic = self.wake_ctx.__enter__()
+            self.waiters_atomic = self.waiters_ctx.__enter__()
+            # Loads of the atomics package are slow, so we read plainly where the order
+            # is already ensured by an atomic read-modify-write before
+            self.wake_remote = remote[0:4]
+            self.waiters_remote = remote[4:8]
+            self.address = ctypes.addressof(ctypes.c_uint32.from_buffer(remote))
+
+        def wait(self, blocked, timeout):
+            """ Sleep for at most `timeout` seconds if `blocked()` is true """
+            # The wake counter must be read before calling `blocked()`, a wake up
+            # in between changes it and the futex does not sleep at all
+            wake = int.from_bytes(self.wake_remote, 'little')
+            self.waiters_atomic.inc()
+            try:
+                if blocked():
+                    seconds = int(timeout)
+                    # FUTEX_WAIT is 0, returns early if the wake counter has changed
+                    futex_syscall(futex_syscalls[platform.machine()], ctypes.c_void_p(self.address), 0, ctypes.c_uint32(wake),
+                        ctypes.byref(Timespec(seconds, int((timeout - seconds) * 1e9))), None, 0)
+            finally:
+                self.waiters_atomic.dec()
+
+        def wake(self, count=1):
+            """ Wake up `count` waiting processes, if there are any """
+            if int.from_bytes(self.waiters_remote, 'little'):
+                self.wake_atomic.inc()
+                # FUTEX_WAKE is 1
+                futex_syscall(futex_syscalls[platform.machine()], ctypes.c_void_p(self.address), 1, count, None, None, 0)
+
+        def cleanup(self):
+            self.wake_ctx.__exit__(None, None, None)
+            self.waiters_ctx.__exit__(None, None, None)
+            del self.wake_ctx, self.wake_atomic, self.waiters_ctx, self.waiters_atomic
+            del self.wake_remote, self.waiters_remote
 
     class SharedLock():
         """
@@ -87,16 +253,68 @@ class UltraDict(collections.UserDict, dict):
         Internally uses atomics package of patomics for atomic locking.
 
         This is needed if you write to the shared memory with independent processes.
+
+        With `readers_name`, the lock also has a shared mode, see read(). Writers
+        are preferred, as soon as a writer waits, no new readers get the lock.
+
+        With `tickets_name`, writers get the lock in the order they have asked for it,
+        see acquire_ticket(). Otherwise, whoever is fastest gets it and some processes
+        might wait much longer than others under heavy contention.
+
+        On Linux, waiting processes sleep on a futex until the lock is released,
+        otherwise they poll the lock with `sleep_time`.
         """
 
+        class ReadLock():
+            """ Context manager for the shared mode of a SharedLock, see `SharedLock.read()` """
+
+            __slots__ = 'lock', 'parameters'
+
+            def __init__(self, lock, parameters):
+                self.lock = lock
+                self.parameters = parameters
+
+            def __enter__(self):
+                self.lock.acquire_read(*self.parameters)
+                return self.lock
+
+            def __exit__(self, type, value, traceback):
+                self.lock.release_read()
+                # Make sure exceptions are not ignored
+                return False
+
         __slots__ = 'parent', 'has_lock',  'ctx', 'lock_atomic', 'lock_remote', \
             'pid', 'pid_bytes', 'pid_remote', 'pid_remote_ctx', 'pid_remote_atomic', \
-            'next_acquire_parameters'
+            'futex', 'read_futex', 'has_read_lock', 'readers_remote', 'readers_ctx', 'readers_atomic', \
+            'writers_remote', 'writers_ctx', 'writers_atomic', 'next_acquire_parameters', \
+            'next_ticket_ctx', 'next_ticket_atomic', 'now_serving_ctx', 'now_serving_atomic', 'ticket', \
+            'acquisitions', 'contended', 'wait_times', 'skipped_tickets'
+
+        # Set to False to always poll the lock, e.g. for benchmarks
+        use_futex = True
+
+        # Maximum time to wait on the futex before checking the lock again,
+        # e.g. in case the lock owner has died
+        futex_timeout = 0.01
+
+        # If the lock is free but the ticket being served is not used for this long,
+        # its owner has died or given up and the ticket is skipped
+        ticket_timeout = 0.05
 
-        def __init__(self, parent, lock_name, pid_name):
+        # Number of the latest waiting times kept for the statistics in status()
+        wait_times_size = 10_000
+
+        def __init__(self, parent, lock_name, pid_name, futex_name=None, readers_name=None, tickets_name=None):
             self.has_lock = 0
+            self.has_read_lock = 0
             self.next_acquire_parameters = ()
 
+            # Statistics, only counting this process
+            self.acquisitions = 0
+            self.contended = 0
+            self.skipped_tickets = 0
+            self.wait_times = collections.deque(maxlen=self.wait_times_size)
+
             # `lock_name` contains the name of the attribute that the parent uses
             # to store the memory view on the remote lock, so `self.lock_remote` is
             # referring to a memory view
@@ -114,8 +332,40 @@ class UltraDict(collections.UserDict, dict):
             self.lock_atomic = self.ctx.__enter__()
             self.pid_remote_atomic = self.pid_remote_ctx.__enter__()
 
+            # `readers_name` refers to 8 bytes, 4 bytes with the number of readers holding
+            # the lock and 4 bytes with the number of writers waiting for the lock
+            self.readers_atomic = self.writers_atomic = None
+            if readers_name:
+                readers_remote = getattr(parent, readers_name)
+                self.readers_ctx = atomics.atomicview(buffer=readers_remote[0:4], atype=atomics.UINT)
+                self.writers_ctx = atomics.atomicview(buffer=readers_remote[4:8], atype=atomics.UINT)
+                self.readers_atomic = self.readers_ctx.__enter__()
+                self.writers_atomic = self.writers_ctx.__enter__()
+                self.readers_remote = readers_remote[0:4]
+                self.writers_remote = readers_remote[4:8]
+
+            # `tickets_name` refers to 8 bytes, 4 bytes with the next ticket to hand out
+            # and 4 bytes with the ticket whose turn it is
+            self.ticket = None
+            self.next_ticket_atomic = self.now_serving_atomic = None
+            if tickets_name:
+                tickets_remote = getattr(parent, tickets_name)
+                self.next_ticket_ctx = atomics.atomicview(buffer=tickets_remote[0:4], atype=atomics.UINT)
+                self.now_serving_ctx = atomics.atomicview(buffer=tickets_remote[4:8], atype=atomics.UINT)
+                self.next_ticket_atomic = self.next_ticket_ctx.__enter__()
+                self.now_serving_atomic = self.now_serving_ctx.__enter__()
+
+            # `futex_name` refers to 8 bytes for the futex of the writers and, with
+            # readers, 8 more bytes for the futex of the readers
+            self.futex = self.read_futex = None
+            if futex_name and futex_syscall and self.use_futex:
+                futex_remote = getattr(parent, futex_name)
+                self.futex = UltraDict.Futex(futex_remote[0:8])
+                if readers_name:
+                    self.read_futex = UltraDict.Futex(futex_remote[8:16])
+
             def after_fork():
-                if self.has_lock:
+                if self.has_lock or self.has_read_lock:
                     raise Exception("Release the SharedLock before you fork the process")
 
                 # After forking, we got a new pid
@@ -132,28 +382,42 @@ class UltraDict(collections.UserDict, dict):
             # The block parameter will be ignored
             time_start = None
             blocking_pid = None
-            while True:
-                try:
-                    return self.acquire(block=False, sleep_time=sleep_time)
-                except Exceptions.CannotAcquireLock as e:
-                    if not time_start:
-                        time_start = e.timestamp
-                        blocking_pid = e.blocking_pid
-
-                    # We should not be the blocking pid
-                    assert blocking_pid != self.pid
-
-                    time_passed = time.monotonic() - time_start
-
-                    if time_passed >= timeout:
-                        if steal_after_timeout:
-                            # If the blocking pid has changed meanwhile, someone else took or stole the lock
-                            if blocking_pid == e.blocking_pid:
-                                self.steal_from_dead(from_pid=blocking_pid, release=True)
-                            time_start = None
-                            blocking_pid = None
-                            continue
-                        raise Exceptions.CannotAcquireLockTimeout(blocking_pid = e.blocking_pid, timestamp=time_start) from None
+            announced = False
+            try:
+                while True:
+                    try:
+                        self.acquire(block=False, sleep_time=sleep_time)
+                        if time_start:
+                            self.count_wait(time_start)
+                        return True
+                    except Exceptions.CannotAcquireLock as e:
+                        if not time_start:
+                            time_start = e.timestamp
+                            blocking_pid = e.blocking_pid
+                        if not announced:
+                            announced = True
+                            self.announce_writer()
+
+                        # We should not be the blocking pid
+                        assert blocking_pid != self.pid
+
+                        time_passed = time.monotonic() - time_start
+
+                        if time_passed >= timeout:
+                            # Readers have no pid that we could steal the lock from
+                            if steal_after_timeout and blocking_pid:
+                                # If the blocking pid has changed meanwhile, someone else took or stole the lock
+                                if blocking_pid == e.blocking_pid:
+                                    self.steal_from_dead(from_pid=blocking_pid, release=True)
+                                time_start = None
+                                blocking_pid = None
+                                continue
+                            raise Exceptions.CannotAcquireLockTimeout(blocking_pid = e.blocking_pid, timestamp=time_start) from None
+
+                        self.wait(sleep_time, timeout - time_passed)
+            finally:
+                if announced:
+                    self.announce_writer(-1)
 
 
         #@profile
@@ -163,31 +427,251 @@ class UltraDict(collections.UserDict, dict):
                 self.has_lock += 1
                 return True
 
+            if self.has_read_lock:
+                raise Exception("Cannot acquire the SharedLock for writing while holding it for reading")
+
+            if self.next_ticket_atomic is not None:
+                return self.acquire_ticket(block=block, sleep_time=sleep_time, timeout=timeout, steal_after_timeout=steal_after_timeout)
+
             if timeout:
                 return self.acquire_with_timeout(sleep_time=sleep_time, timeout=timeout, steal_after_timeout=steal_after_timeout)
 
-            while True:
-                # We need both, the shared lock to be False and the lock_pid to be 0
-                if self.test_and_inc():
+            time_start = None
+            try:
+                while True:
+                    # We need both, the shared lock to be False and the lock_pid to be 0
+                    if self.test_and_inc():
+                        self.got_lock(block, sleep_time, time_start)
+                        return True
 
-                    assert self.has_lock == 0
-                    self.has_lock = 1
+                    if not block:
+                        raise Exceptions.CannotAcquireLock(blocking_pid=self.get_remote_pid())
 
-                    # If nobody had owned the lock, so the remote pid should be zero
-                    assert self.pid_remote[0:4] == b'\x00\x00\x00\x00'
+                    if time_start is None:
+                        time_start = time.monotonic()
+                        self.announce_writer()
 
-                    self.pid_remote[:] = self.pid_bytes
-                    return True
+                    self.wait(sleep_time)
+            finally:
+                if time_start is not None:
+                    self.announce_writer(-1)
+
+        def announce_writer(self, count=1):
+            """
+            Announce that we wait to write, so no new readers get the lock meanwhile.
+
+            Only done when the lock is not free, to keep atomic operations off the fast path.
+            """
+            if self.writers_atomic is not None:
+                if count > 0:
+                    self.writers_atomic.inc()
+                else:
+                    self.writers_atomic.dec()
+
+        def got_lock(self, block, sleep_time, time_start):
+            """ Take the ownership after setting the shared lock """
+            assert self.has_lock == 0
+            self.has_lock = 1
+
+            # If nobody had owned the lock, so the remote pid should be zero
+            assert self.pid_remote[0:4] == b'\x00\x00\x00\x00'
+
+            self.pid_remote[:] = self.pid_bytes
+
+            if self.readers_atomic is not None:
+                self.wait_for_readers(block, sleep_time)
+
+            # Only count acquisitions that have not been given up for the readers
+            self.acquisitions += 1
+            if time_start is not None:
+                self.count_wait(time_start)
+
+        def count_wait(self, time_start):
+            self.contended += 1
+            self.wait_times.append(time.monotonic() - time_start)
+
+        def acquire_ticket(self, block=True, sleep_time=0.000001, timeout=None, steal_after_timeout=False):
+            """
+            Acquire the lock in the order of tickets, like at a deli counter.
+
+            Every writer draws the next ticket and waits until it is served. The shared
+            lock itself still guarantees that only one process owns the lock, so dead
+            owners can be detected and their lock stolen as usual. Tickets that are not
+            used, because their owners have died or given up, are skipped after `ticket_timeout`.
+            """
+            announced = False
+            try:
+                ticket = None
+                time_start = None
+                last_serving = serving_since = None
+                while True:
+                    if ticket is None:
+                        ticket = self.take_ticket(block)
+
+                    serving = self.get_now_serving()
+                    if serving == ticket:
+                        if self.test_and_inc():
+                            self.ticket = ticket
+                            self.got_lock(block, sleep_time, time_start)
+                            return True
+                        if not block:
+                            # Someone with a skipped ticket was faster
+                            self.return_ticket(ticket)
+                            raise Exceptions.CannotAcquireLock(blocking_pid=self.get_remote_pid())
+
+                    # Our ticket was skipped, we were too slow
+                    elif (serving - ticket) & 0xFFFFFFFF < 0x80000000:
+                        ticket = None
+                        continue
+
+                    now = time.monotonic()
+                    if time_start is None:
+                        time_start = now
+                    if not announced:
+                        announced = True
+                        self.announce_writer()
+                    if serving != last_serving:
+                        last_serving, serving_since = serving, now
+                    elif now - serving_since > self.ticket_timeout and not self.get_remote_lock():
+                        self.skip_ticket(serving)
+                        continue
+
+                    if timeout and now - time_start >= timeout:
+                        blocking_pid = self.get_remote_pid()
+                        # Readers have no pid that we could steal the lock from
+                        if steal_after_timeout and blocking_pid:
+                            # The turn of the dead owner is over as well
+                            if self.steal_from_dead(from_pid=blocking_pid, release=True):
+                                self.skip_ticket(serving)
+                            time_start = None
+                            continue
+                        self.return_ticket(ticket)
+                        raise Exceptions.CannotAcquireLockTimeout(blocking_pid=blocking_pid, timestamp=time_start)
+
+                    self.wait(sleep_time, timeout - (now - time_start) if timeout else None,
+                        blocked=lambda: self.get_now_serving() == serving and (serving != ticket or self.get_remote_lock()))
+            finally:
+                if announced:
+                    self.announce_writer(-1)
+
+        def take_ticket(self, block):
+            if block:
+                return self.next_ticket_atomic.fetch_inc()
+            # Without blocking, only take a ticket if it is served right away
+            serving = self.now_serving_atomic.load()
+            if self.next_ticket_atomic.cmpxchg_strong(expected=serving, desired=(serving + 1) & 0xFFFFFFFF).success:
+                return serving
+            raise Exceptions.CannotAcquireLock(blocking_pid=self.get_remote_pid())
+
+        def return_ticket(self, ticket):
+            """ Give up an unused ticket, so nobody else must wait for it """
+            # If nobody has taken a ticket after us, we can take it back
+            if self.next_ticket_atomic.cmpxchg_strong(expected=(ticket + 1) & 0xFFFFFFFF, desired=ticket).success:
+                return
+            # If it is our turn, it is skipped right away, otherwise after `ticket_timeout`
+            if self.now_serving_atomic.load() == ticket:
+                self.skip_ticket(ticket)
+
+        def skip_ticket(self, ticket):
+            """ Serve the next ticket, if `ticket` is still being served """
+            if self.now_serving_atomic.cmpxchg_strong(expected=ticket, desired=(ticket + 1) & 0xFFFFFFFF).success:
+                if self.ticket != ticket:
+                    self.skipped_tickets += 1
+                return True
+            return False
+
+        def wait_for_readers(self, block, sleep_time):
+            """ Wait until the readers that got the lock before us have released it """
+            while self.get_readers():
+                if not block:
+                    self.release()
+                    raise Exceptions.CannotAcquireLock(blocking_pid=0)
+                self.wait(sleep_time, blocked=self.get_readers)
+
+        def acquire_read(self, block=True, sleep_time=0.000001):
+            """ Acquire the lock in shared mode, see `read()` """
+            # Writing includes reading, without readers, there is only the exclusive mode
+            if self.has_lock or self.readers_atomic is None:
+                return self.acquire(block=block, sleep_time=sleep_time)
+
+            if self.has_read_lock:
+                self.has_read_lock += 1
+                return True
 
-                # If set to 0, we practically have a busy wait
-                if sleep_time:
-                    # On Python < 3.10, this smallest possible time is actually rather big,
-                    #  maybe around 10 ms, depending on your CPU.
-                    time.sleep(sleep_time)
+            while True:
+                if not self.is_writing():
+                    self.readers_atomic.inc()
+                    # A writer might have taken the lock before it has seen us
+                    if not self.get_remote_lock():
+                        self.has_read_lock = 1
+                        return True
+                    self.leave_read()
 
                 if not block:
                     raise Exceptions.CannotAcquireLock(blocking_pid=self.get_remote_pid())
 
+                self.wait(sleep_time, futex=self.read_futex, blocked=self.is_writing)
+
+        def release_read(self):
+            if self.has_lock:
+                return self.release()
+
+            if self.has_read_lock > 0:
+                self.has_read_lock -= 1
+                if not self.has_read_lock:
+                    self.leave_read()
+                return True
+
+            return False
+
+        def leave_read(self):
+            # The last reader wakes up the writer that waits for the readers
+            if self.readers_atomic.fetch_dec() == 1 and self.futex is not None:
+                self.futex.wake(UltraDict.Futex.all)
+
+        def is_writing(self):
+            """ True if a writer holds or waits for the lock """
+            return self.get_writers() or self.get_remote_lock()
+
+        def read(self, block=True, sleep_time=0.000001):
+            """
+            Returns a context manager to acquire the lock in shared mode, many readers
+            can hold it at the same time but no writer, e.g. `with ultra.lock.read(): ...`
+            """
+            return self.ReadLock(self, (block, sleep_time))
+
+        def write(self, block=True, timeout=None, sleep_time=0.000001, steal_after_timeout=False):
+            """ Acquire the lock exclusively, the same as using the lock itself """
+            return self(block=block, timeout=timeout, sleep_time=sleep_time, steal_after_timeout=steal_after_timeout)
+
+        def wait(self, sleep_time, timeout=None, futex=None, blocked=None):
+            """ Wait until the lock might have been released, or until `blocked()` might be false """
+            # If set to 0, we practically have a busy wait
+            if not sleep_time:
+                return
+
+            futex = futex or self.futex
+            if not futex:
+                # On Python < 3.10, this smallest possible time is actually rather big,
+                #  maybe around 10 ms, depending on your CPU.
+                time.sleep(sleep_time)
+                return
+
+            timeout = self.futex_timeout if timeout is None else max(min(timeout, self.futex_timeout), 0)
+            futex.wait(blocked or self.get_remote_lock, timeout)
+
+        def wake(self):
+            """ Wake up one waiting writer or, if there is none, all waiting readers """
+            if not self.futex:
+                return
+            if self.read_futex and not self.get_writers():
+                self.read_futex.wake(UltraDict.Futex.all)
+            elif self.next_ticket_atomic is not None:
+                # Only the owner of the next ticket can go on, but we don't know who that is
+                self.futex.wake(UltraDict.Futex.all)
+            else:
+                self.futex.wake()
+
         #@profile
         def test_and_inc(self):
             old = self.lock_atomic.exchange(b'\x01')
@@ -215,6 +699,10 @@ class UltraDict(collections.UserDict, dict):
                 if not self.has_lock:
                     self.pid_remote[:] = b'\x00\x00\x00\x00'
                     self.test_and_dec()
+                    if self.ticket is not None:
+                        self.skip_ticket(self.ticket)
+                        self.ticket = None
+                    self.wake()
                 #log.debug("Relased lock, lock={} pid_remote={}", self.has_lock, int.from_bytes(self.pid_remote, 'little'))
                 return True
 
@@ -257,23 +745,25 @@ class UltraDict(collections.UserDict, dict):
                 Optionally, the lock can be directly released after stealing it.
             """
 
+            # No process must exist anymore with the from_pid or it must at least be dead (ie. zombie status)
+            if not self.is_dead(from_pid):
+                raise Exception(f"Trying to steal lock from process that is still alive, something seems really wrong from_pid={from_pid} pid={self.pid}")
+
+            return self.steal(from_pid=from_pid, release=release)
+
+        @staticmethod
+        def is_dead(pid):
+            """ Check if the process with `pid` does not exist anymore or is a zombie """
             try:
                 import psutil
             except ModuleNotFoundError:
                 raise Exceptions.MissingDependency("Install `psutil` Python package to use shared_lock=True") from None
-            # No process must exist anymore with the from_pid or it must at least be dead (ie. zombie status)
             try:
-                p = psutil.Process(from_pid)
-                if p and p.is_running() and p.status() not in [psutil.STATUS_ZOMBIE, psutil.STATUS_DEAD]:
-                    raise Exception(f"Trying to steal lock from process that is still alive, something seems really wrong from_pid={from_pid} pid={self.pid} p={p}")
+                p = psutil.Process(pid)
+                return not p.is_running() or p.status() in [psutil.STATUS_ZOMBIE, psutil.STATUS_DEAD]
             except psutil.NoSuchProcess:
-                # If the process is already gone, we cannot find information about it.
-                # It will be safe to steal the lock.
-                pass
-            except Exception as e:
-                raise e
-
-            return self.steal(from_pid=from_pid, release=release)
+                # If the process is already gone, we cannot find information about it
+                return True
 
         def status(self):
             return {
@@ -281,6 +771,31 @@ class UltraDict(collections.UserDict, dict):
                 'lock_remote': int.from_bytes(self.lock_remote, 'little'),
                 'pid': self.pid,
                 'pid_remote': int.from_bytes(self.pid_remote, 'little'),
+                'has_read_lock': self.has_read_lock,
+                'readers': self.get_readers() if self.readers_atomic is not None else None,
+                'writers_waiting': self.get_writers() if self.writers_atomic is not None else None,
+                'fair': self.next_ticket_atomic is not None,
+                'next_ticket': self.next_ticket_atomic.load() if self.next_ticket_atomic is not None else None,
+                'now_serving': self.now_serving_atomic.load() if self.now_serving_atomic is not None else None,
+                **self.wait_statistics(),
+            }
+
+        def wait_statistics(self):
+            """
+            Statistics of this process about waiting for the lock for writing. The waiting
+            times in seconds are taken from the latest `wait_times_size` contended acquisitions.
+            """
+            wait_times = sorted(self.wait_times)
+            def percentile(p):
+                return wait_times[min(int(len(wait_times) * p), len(wait_times) - 1)] if wait_times else 0.0
+            return {
+                'acquisitions': self.acquisitions,
+                'contended': self.contended,
+                'skipped_tickets': self.skipped_tickets,
+                'wait_p50': percentile(0.5),
+                'wait_p99': percentile(0.99),
+                'wait_p999': percentile(0.999),
+                'wait_max': wait_times[-1] if wait_times else 0.0,
             }
 
         def print_status(self, status=None):
@@ -300,6 +815,20 @@ class UltraDict(collections.UserDict, dict):
                 del self.pid_remote_ctx
             if hasattr(self, 'pid_remote_aotmic'):
                 del self.pid_remote_atomic
+            for futex in (getattr(self, 'futex', None), getattr(self, 'read_futex', None)):
+                if futex:
+                    futex.cleanup()
+            self.futex = self.read_futex = None
+            if getattr(self, 'next_ticket_atomic', None) is not None:
+                self.next_ticket_ctx.__exit__(None, None, None)
+                self.now_serving_ctx.__exit__(None, None, None)
+                del self.next_ticket_ctx, self.now_serving_ctx
+                self.next_ticket_atomic = self.now_serving_atomic = None
+            if getattr(self, 'readers_atomic', None) is not None:
+                self.readers_ctx.__exit__(None, None, None)
+                self.writers_ctx.__exit__(None, None, None)
+                del self.readers_ctx, self.writers_ctx, self.readers_remote, self.writers_remote
+                self.readers_atomic = self.writers_atomic = None
             del self.lock_remote
             del self.pid_remote
             del self.pid_bytes
@@ -311,6 +840,15 @@ class UltraDict(collections.UserDict, dict):
         def get_remote_lock(self):
             return int.from_bytes(self.lock_remote, 'little')
 
+        def get_readers(self):
+            return int.from_bytes(self.readers_remote, 'little')
+
+        def get_writers(self):
+            return int.from_bytes(self.writers_remote, 'little')
+
+        def get_now_serving(self):
+            return self.now_serving_atomic.load()
+
         def __repr__(self):
             return f"{self.__class__.__name__} @{hex(id(self))} lock_remote={int.from_bytes(self.lock_remote, 'little')}, has_lock={self.has_lock}, pid={self.pid}), pid_remote={int.from_bytes(self.pid_remote, 'little')}"
 
@@ -325,13 +863,361 @@ class UltraDict(collections.UserDict, dict):
             return False
 
         def __call__(self, block=True, timeout=None, sleep_time=0.000001, steal_after_timeout=False):
-            self.next_acquire_parameters = ( block, timeout, sleep_time, steal_after_timeout )
+            # Same order as the parameters of acquire()
+            self.next_acquire_parameters = ( block, sleep_time, timeout, steal_after_timeout )
+
+            return self
+
+    class Batch():
+        """
+        Collects changes to an UltraDict and streams them as one single update
+        when leaving the context, see `UltraDict.batch()`.
+
+        Other users apply all changes of a batch at once.
+        """
+
+        __slots__ = 'parent', 'updates', 'pending'
+
+        def __init__(self, parent):
+            self.parent = parent
+            self.updates = []
+            # Keys changed by this batch, True if set and False if deleted
+            self.pending = {}
+
+        def __setitem__(self, key, item):
+            self.updates.append((1, key, item))
+            self.pending[key] = True
+
+        def __delitem__(self, key):
+            if not self.pending.get(key, key in self.parent):
+                raise KeyError(key)
+            self.updates.append((0, key, b''))
+            self.pending[key] = False
+
+        def update(self, other=None, **kwargs):
+            if other is not None:
+                for k, v in other.items() if isinstance(other, collections.abc.Mapping) else other:
+                    self[k] = v
+            for k, v in kwargs.items():
+                self[k] = v
+
+        def commit(self):
+            """ Stream all collected changes as one update using a single lock acquisition, or none with `lock_free` """
+            if not self.updates:
+                return
+
+            parent = self.parent
+            if parent.lock_free:
+                # Never with the lock, whoever holds it might wait for our reserved update, see wait_for_head()
+                updates = [ (mode, key, parent.prepare_item(item) if mode else item) for mode, key, item in self.updates ]
+                parent.append_update(None, updates, mode=2)
+            else:
+                with parent.lock:
+                    parent.apply_update()
+                    updates = [ (mode, key, parent.prepare_item(item) if mode else item) for mode, key, item in self.updates ]
+                    # Also updates the local copy of our parent
+                    parent.append_update(None, updates, mode=2)
+
+            self.updates = []
+            self.pending = {}
 
+        def __len__(self):
+            return len(self.updates)
+
+        def __enter__(self):
             return self
 
+        def __exit__(self, type, value, traceback):
+            # Discard the batch if there was an exception
+            if type is None:
+                self.commit()
+            # Make sure exceptions are not ignored
+            return False
+
+    class LazyValue():
+        """
+        Placeholder in our local copy for a value of a lazy full dump that has not
+        been unserialized yet, see `UltraDict.lazy_value`.
+
+        Note that `UltraDict.data` can contain the placeholder when using lazy=True.
+        """
+        __slots__ = ()
+
+        def __repr__(self):
+            return '<lazy value>'
+
+    # The one and only placeholder for values that have not been unserialized yet
+    lazy_value = LazyValue()
+
+    class RecordCodec():
+        """
+        Compact encoding of updates in the stream whose key and value are None, bool, int or float, used
+        instead of pickling a tuple of mode, key and value if the serializer is pickle.
+
+        The first byte has the tags of the types of key and value, then comes the mode, then the key and the value
+        with their fixed size. Pickles always start with 0x80, which is no valid first byte, so both kinds of
+        updates can be mixed in the stream.
+
+        Keys and values of type str and bytes are still pickled, decoding them in Python is slower than pickle.
+
+        Updates of str and bytes keys can refer to their key by id instead, see KeyTable. Their key tag is
+        KEY_DEFINITION or KEY_REFERENCE, their value is either one of the types above or pickled.
+        """
+        __slots__ = 'encoders', 'decoders'
+
+        # Tags of the types, ints take 4 or 8 bytes depending on their size
+        NONE, BOOL, INT32, INT64, FLOAT = range(5)
+        formats = ('', '?', 'i', 'q', 'd')
+        tags = { type(None): NONE, bool: BOOL, int: INT32, float: FLOAT }
+        value_structs = tuple(struct.Struct('<' + format) for format in formats)
+
+        # Key tags of updates with key ids and the value tag of pickled values
+        KEY_DEFINITION, KEY_REFERENCE = 5, 6
+        PICKLE = 5
+        # Tags, mode, id, epoch and the length of the pickled key, which comes next, see KeyTable
+        definition_struct = struct.Struct('<BBIQI')
+        # Tags, mode and id
+        reference_struct = struct.Struct('<BBI')
+
+        def __init__(self):
+            # Functions that encode `mode, key, item` by the types of key and item, see dumps_record()
+            packers = { (key_tag, value_tag): self.get_packer(key_tag, value_tag) for key_tag in range(5) for value_tag in range(5) }
+            self.encoders = { (key_type, value_type): self.get_encoder(key_tag, value_tag, packers)
+                for key_type, key_tag in self.tags.items() for value_type, value_tag in self.tags.items() }
+
+            # Functions that decode an update by its first byte, see read_updates()
+            self.decoders = [ None ] * 256
+            self.decoders[0x80] = pickle.loads
+            for key_tag in range(5):
+                for value_tag in range(5):
+                    self.decoders[key_tag | value_tag << 3] = self.get_decoder(key_tag, value_tag)
+
+        @classmethod
+        def get_packer(cls, key_tag, value_tag):
+            """ Encode `mode, key, item` with exactly these tags """
+            pack = struct.Struct('<BB' + cls.formats[key_tag] + cls.formats[value_tag]).pack
+            header = key_tag | value_tag << 3
+            if key_tag and value_tag:
+                return functools.partial(pack, header)
+            if key_tag:
+                return lambda mode, key, item: pack(header, mode, key)
+            if value_tag:
+                return lambda mode, key, item: pack(header, mode, item)
+            return lambda mode, key, item: pack(header, mode)
+
+        @classmethod
+        def get_encoder(cls, key_tag, value_tag, packers):
+            """ Encode `mode, key, item` with these tags, choosing the size of ints """
+            INT32, INT64 = cls.INT32, cls.INT64
+            if key_tag == INT32 and value_tag == INT32:
+                def encode(mode, key, item):
+                    return packers[INT32 if -0x80000000 <= key <= 0x7FFFFFFF else INT64,
+                                   INT32 if -0x80000000 <= item <= 0x7FFFFFFF else INT64](mode, key, item)
+                return encode
+            if key_tag == INT32:
+                small, big = packers[INT32, value_tag], packers[INT64, value_tag]
+                return lambda mode, key, item: (small if -0x80000000 <= key <= 0x7FFFFFFF else big)(mode, key, item)
+            if value_tag == INT32:
+                small, big = packers[key_tag, INT32], packers[key_tag, INT64]
+                return lambda mode, key, item: (small if -0x80000000 <= item <= 0x7FFFFFFF else big)(mode, key, item)
+            return packers[key_tag, value_tag]
+
+        @classmethod
+        def get_decoder(cls, key_tag, value_tag):
+            """ Decode an update with these tags to a tuple of mode, key and value """
+            # Skip the first byte, so the fields are mode, key and value
+            unpack_from = struct.Struct('<xB' + cls.formats[key_tag] + cls.formats[value_tag]).unpack_from
+            if key_tag and value_tag:
+                return unpack_from
+            if key_tag:
+                return lambda view: (*unpack_from(view), None)
+            if value_tag:
+                def decode(view):
+                    mode, item = unpack_from(view)
+                    return mode, None, item
+                return decode
+            return lambda view: (unpack_from(view)[0], None, None)
+
+        def dumps_value(self, item):
+            """ Encode the value of an update that refers to its key by id, returns its tag and bytes """
+            tag = self.tags.get(type(item))
+            if tag == self.NONE:
+                return tag, b''
+            if tag == self.INT32 and not -0x80000000 <= item <= 0x7FFFFFFF:
+                tag = self.INT64 if -0x8000000000000000 <= item <= 0x7FFFFFFFFFFFFFFF else None
+            if tag is None:
+                return self.PICKLE, pickle.dumps(item)
+            return tag, self.value_structs[tag].pack(item)
+
+        def dumps_definition(self, mode, key_id, epoch, key, item):
+            """ Encode an update that defines the id of its key, see KeyTable """
+            key = pickle.dumps(key)
+            tag, value = self.dumps_value(item)
+            return self.definition_struct.pack(self.KEY_DEFINITION | tag << 3, mode, key_id, epoch, len(key)) + key + value
+
+        def dumps_reference(self, mode, key_id, item):
+            """ Encode an update that refers to its key by id, see KeyTable """
+            tag, value = self.dumps_value(item)
+            return self.reference_struct.pack(self.KEY_REFERENCE | tag << 3, mode, key_id) + value
+
+        def get_decoders(self, key_table):
+            """ Decoders of all kinds of updates by their first byte, keys with ids are looked up in `key_table` """
+            decoders = list(self.decoders)
+            for value_tag in range(6):
+                decoders[self.KEY_DEFINITION | value_tag << 3] = self.get_definition_decoder(value_tag, key_table)
+                decoders[self.KEY_REFERENCE | value_tag << 3] = self.get_reference_decoder(value_tag, key_table)
+            return decoders
+
+        def get_definition_decoder(self, value_tag, key_table):
+            """ Decode an update that defines the id of its key and add it to `key_table` """
+            unpack_from = self.definition_struct.unpack_from
+            start = self.definition_struct.size
+            loads_value = self.get_value_decoder(value_tag)
+
+            def decode(view):
+                _, mode, key_id, epoch, length = unpack_from(view)
+                key = pickle.loads(view[start:start+length])
+                key_table.define(epoch, key_id, key)
+                return mode, key, loads_value(view, start + length)
+            return decode
+
+        def get_reference_decoder(self, value_tag, key_table):
+            """ Decode an update that refers to its key by id """
+            keys = key_table.keys
+            if value_tag == self.PICKLE:
+                unpack_from = self.reference_struct.unpack_from
+                start = self.reference_struct.size
+                def decode(view):
+                    _, mode, key_id = unpack_from(view)
+                    return mode, keys[key_id], pickle.loads(view[start:])
+                return decode
+            if value_tag == self.NONE:
+                unpack_from = self.reference_struct.unpack_from
+                def decode(view):
+                    _, mode, key_id = unpack_from(view)
+                    return mode, keys[key_id], None
+                return decode
+            unpack_from = struct.Struct(self.reference_struct.format + self.formats[value_tag]).unpack_from
+            def decode(view):
+                _, mode, key_id, item = unpack_from(view)
+                return mode, keys[key_id], item
+            return decode
+
+        def get_value_decoder(self, value_tag):
+            """ Decode the value at `start` of an update that refers to its key by id """
+            if value_tag == self.PICKLE:
+                return lambda view, start: pickle.loads(view[start:])
+            if value_tag == self.NONE:
+                return lambda view, start: None
+            unpack_from = self.value_structs[value_tag].unpack_from
+            return lambda view, start: unpack_from(view, start)[0]
+
+    # Encoders and decoders of compact updates in the stream
+    record_codec = RecordCodec()
+
+    class KeyTable():
+        """
+        Ids of the keys in the update stream, so updates can refer to their key by id instead of
+        pickling it again, see RecordCodec.
+
+        Writers with the lock define the id of a str or bytes key with its first update after the
+        latest full dump or compaction, the following updates of the key only contain the id.
+        Definitions carry the stream offset of that full dump or compaction as epoch, the table starts
+        over with each new epoch. Lock-free writers and batches always write the whole key.
+        """
+        __slots__ = 'epoch', 'keys', 'ids', 'decoders'
+
+        types = (str, bytes)
+
+        def __init__(self, record_codec):
+            self.epoch = -1
+            # Key of each id
+            self.keys = []
+            # Id of each key
+            self.ids = {}
+            # Decoders of updates that look up keys in this table, see read_updates()
+            self.decoders = record_codec.get_decoders(self)
+
+        def define(self, epoch, key_id, key):
+            if epoch != self.epoch:
+                self.reset()
+                self.epoch = epoch
+            # Ids are defined in order, everything else is garbage from an overrun stream
+            assert key_id <= len(self.keys)
+            if key_id == len(self.keys):
+                self.keys.append(key)
+            else:
+                self.keys[key_id] = key
+            self.ids[key] = key_id
+
+        def lookup(self, epoch, key):
+            """ Get the id of `key` in `epoch` or None if it has not been defined yet """
+            if epoch != self.epoch:
+                return None
+            return self.ids.get(key)
+
+        def next_id(self, epoch):
+            return len(self.keys) if epoch == self.epoch else 0
+
+        def reset(self):
+            # Decoders refer to the list of keys, so it must stay the same
+            self.keys.clear()
+            self.ids.clear()
+            self.epoch = -1
+
+        def copy(self, record_codec):
+            key_table = type(self)(record_codec)
+            key_table.epoch = self.epoch
+            key_table.keys.extend(self.keys)
+            key_table.ids.update(self.ids)
+            return key_table
+
+        def __repr__(self):
+            return f'<KeyTable epoch={self.epoch} keys={len(self.keys)}>'
+
+    # Seconds that `get(key, fresh=False)` may skip checking for new updates without `max_staleness`
+    default_max_staleness = 0.005
+
+    # Operations that can be streamed instead of the new value, see add()
+    operations = { 'add': operator.add, 'max': max, 'min': min }
+
+    # Header of each update in the stream, FF byte, 4 bytes of length, then another FF byte
+    update_header = struct.Struct('<BIB')
+
+    # End of each lock-free reservation, a skipped update with the pid of the writer and the
+    # lower 4 bytes of the offset of the reservation, see reserve()
+    reservation_footer = struct.Struct('<BIBII')
+
+    # Seconds that the head of the stream may stand still until waiting lock-free writers
+    # check if the writer of the next update has died, see recover_head()
+    dead_writer_timeout = 0.1
+
+    # Header of checkpoint files, see checkpoint()
+    checkpoint_header = struct.Struct('<8sB7sIIIIIIQQ')
+
+    # Bytes copied at once between shared memory and checkpoint files
+    checkpoint_chunk_size = 1 << 20
+
+    # Header of each update in the write-ahead log, 8 bytes of stream offset, 4 bytes of length and 4 bytes of CRC32
+    wal_header = struct.Struct('<QII')
+
     __slots__ = 'name', 'control', 'buffer', 'buffer_size', 'lock', 'shared_lock', \
         'update_stream_position', 'update_stream_position_remote', \
+        'update_stream_lap', 'update_stream_lap_remote', \
         'full_dump_counter', 'full_dump_memory', 'full_dump_size', \
+        'full_dump_stream_position_remote', 'full_dump_stream_lap_remote', \
+        'full_dump_length_remote', \
+        'compaction_memory', 'compaction_counter_remote', 'compaction_length_remote', \
+        'compaction_memory_name_remote', \
+        'zero_copy', 'zero_copy_remote', 'view_memories', 'listeners', \
+        'lazy', 'lazy_remote', 'lazy_dump', \
+        'versions', 'versions_remote', 'key_versions', 'key_table', \
+        'lock_futex_remote', 'lock_readers_remote', 'lock_tickets_remote', \
+        'fair_lock', 'fair_lock_remote', \
+        'lock_free', 'lock_free_remote', 'stream_tail_remote', 'stream_reserver_remote', 'stream_tail_address', 'generation_address', 'stalled_head', \
+        'stream_futex_remote', 'stream_futex', 'generation', 'generation_remote', 'max_staleness', 'synced', \
+        'checkpoint_thread', 'checkpoint_stop', \
+        'wal', 'wal_remote', 'wal_fd', 'wal_sync_interval', 'wal_written', 'wal_thread', 'wal_stop', \
         'serializer', \
         'lock_pid_remote', \
         'lock_remote', \
@@ -340,11 +1226,12 @@ class UltraDict(collections.UserDict, dict):
         'shared_lock_remote', \
         'recurse', 'recurse_remote', 'recurse_register', \
         'full_dump_memory_name_remote', \
-        'data', 'closed', 'auto_unlink', \
+        'data', 'closed', 'auto_unlink', 'path', \
         'finalizer'
 
     def __init__(self, *args, name=None, create=None, buffer_size=10_000, serializer=pickle, shared_lock=None, full_dump_size=None,
-            auto_unlink=None, recurse=None, recurse_register=None, **kwargs):
+            auto_unlink=None, recurse=None, recurse_register=None, zero_copy=None, lazy=None, versions=None, fair_lock=None, lock_free=None,
+            max_staleness=None, path=None, wal=None, wal_sync_interval=0.01, **kwargs):
         # pylint: disable=too-many-branches, too-many-statements
 
         # On win32, only multiples of 4k are allowed
@@ -355,24 +1242,72 @@ class UltraDict(collections.UserDict, dict):
 
         assert buffer_size < 2**32
 
-        if recurse:
+        if recurse or zero_copy or lazy:
             assert serializer == pickle
 
         self.data = {}
 
+        # Full dump memories that values in our local copy point into, see zero_copy
+        self.view_memories = []
+
+        # Index of the lazy full dump that placeholders in our local copy point into, see lazy
+        self.lazy_dump = None
+
+        # Version of each key, ie. the stream offset of the last update of the key, see versions
+        self.key_versions = {}
+
+        # Called for each change of our local copy, see apply_record_and_notify()
+        self.listeners = []
+
+        # Ids of the keys in the update stream, see KeyTable
+        self.key_table = self.KeyTable(self.record_codec)
+
         # Local position, ie. the last position we have processed from the stream
         self.update_stream_position  = 0
 
+        # Local lap counter, ie. how often the stream has wrapped around the end
+        # of the buffer up to our local position
+        self.update_stream_lap       = 0
+
         # Local version counter for the full dumps, ie. if we find a higher version
         # remote, we need to load a full dump
         self.full_dump_counter       = 0
 
+        # Local generation, ie. the offset of the head of the stream at our last update, see apply_update()
+        self.generation              = -1
+
+        # Seconds that reads may skip checking for new updates after the last check, see get()
+        self.max_staleness           = max_staleness
+        # Time of the last check for new updates by a read that allows stale data
+        self.synced                  = 0.0
+
+        # Background thread writing checkpoints, see start_checkpoints()
+        self.checkpoint_thread       = None
+        self.checkpoint_stop         = None
+
+        # Write-ahead log of all updates, see write_wal()
+        self.wal_fd                  = None
+        self.wal_sync_interval       = wal_sync_interval
+        self.wal_written             = 0
+        self.wal_thread              = None
+        self.wal_stop                = None
+        if wal:
+            wal = os.path.abspath(wal)
+
         self.closed = False
         self.auto_unlink = auto_unlink
 
+        # Directory with memory-mapped files instead of shared memory, see FileMemory
+        self.path = path
+        if path:
+            if name is None:
+                name = os.path.basename(os.path.normpath(path))
+            if create is not False:
+                os.makedirs(path, exist_ok=True)
+
         # Small 1000 bytes of shared memory where we store the runtime state
         # of our update stream
-        self.control = self.get_memory(create=create, name=name, size=1000)
+        self.control = self.get_memory(create=create, name=name, size=1000, path=self.path)
         self.name = self.control.name
 
         def finalize(weak_self, name):
@@ -390,11 +1325,16 @@ class UltraDict(collections.UserDict, dict):
         self.serializer = serializer
 
         # Actual stream buffer that contains marshalled data of changes to the dict
-        self.buffer = self.get_memory(create=create, name=self.name + '_memory', size=buffer_size)
+        self.buffer = self.get_memory(create=create, name=self.name + '_memory', size=buffer_size, path=self.path)
         # TODO: Raise exception if buffer size mismatch
         self.buffer_size = self.buffer.size
 
+        # The files stay locked by every process using them, see FileMemory.lock_shared()
+        if path:
+            self.control.lock_shared(self.reset_after_restart)
+
         self.full_dump_memory = None
+        self.compaction_memory = None
 
         # Dynamic full dump memory handling
         # Warning: Issues on Windows when the process ends that has created the full dump memory
@@ -402,8 +1342,9 @@ class UltraDict(collections.UserDict, dict):
 
         if hasattr(self.control, 'created_by_ultra'):
 
+            # Files are kept for the next start by default
             if auto_unlink is None:
-                self.auto_unlink = True
+                self.auto_unlink = not path
 
             if recurse:
                 self.recurse_remote[0:1] = b'1'
@@ -411,13 +1352,31 @@ class UltraDict(collections.UserDict, dict):
             if shared_lock:
                 self.shared_lock_remote[0:1] = b'1'
 
+            if zero_copy:
+                self.zero_copy_remote[0:1] = b'1'
+
+            if lazy:
+                self.lazy_remote[0:1] = b'1'
+
+            if versions:
+                self.versions_remote[0:1] = b'1'
+
+            if fair_lock:
+                self.fair_lock_remote[0:1] = b'1'
+
+            if lock_free:
+                self.lock_free_remote[0:1] = b'1'
+
+            if wal:
+                self.wal_remote[:] = wal.encode('utf-8').ljust(255, b'\x00')
+
             # We created the control memory, thus let's check if we need to create the
             # full dump memory as well
             if full_dump_size:
                 self.full_dump_size = full_dump_size
                 self.full_dump_static_size_remote[:] = full_dump_size.to_bytes(4, 'little')
 
-                self.full_dump_memory = self.get_memory(create=True, name=self.name + '_full', size=full_dump_size)
+                self.full_dump_memory = self.get_memory(create=True, name=self.name + '_full', size=full_dump_size, path=self.path)
                 self.full_dump_memory_name_remote[:] = self.full_dump_memory.name.encode('utf-8').ljust(255)
 
         # We just attached to the existing control
@@ -441,33 +1400,105 @@ class UltraDict(collections.UserDict, dict):
             elif recurse != recurse_remote:
                 raise Exceptions.ParameterMismatch(f"recure={recurse} was set but the creator has used recurse={recurse_remote}")
 
+            # Check if zero_copy parameter was not set to inconsistent value
+            zero_copy_remote = self.zero_copy_remote[0:1] == b'1'
+            if zero_copy is None:
+                zero_copy = zero_copy_remote
+            elif zero_copy != zero_copy_remote:
+                raise Exceptions.ParameterMismatch(f"zero_copy={zero_copy} was set but the creator has used zero_copy={zero_copy_remote}")
+
+            # Check if lazy parameter was not set to inconsistent value
+            lazy_remote = self.lazy_remote[0:1] == b'1'
+            if lazy is None:
+                lazy = lazy_remote
+            elif lazy != lazy_remote:
+                raise Exceptions.ParameterMismatch(f"lazy={lazy} was set but the creator has used lazy={lazy_remote}")
+
+            # Check if versions parameter was not set to inconsistent value
+            versions_remote = self.versions_remote[0:1] == b'1'
+            if versions is None:
+                versions = versions_remote
+            elif versions != versions_remote:
+                raise Exceptions.ParameterMismatch(f"versions={versions} was set but the creator has used versions={versions_remote}")
+
+            # Check if fair_lock parameter was not set to inconsistent value
+            fair_lock_remote = self.fair_lock_remote[0:1] == b'1'
+            if fair_lock is None:
+                fair_lock = fair_lock_remote
+            elif fair_lock != fair_lock_remote:
+                raise Exceptions.ParameterMismatch(f"fair_lock={fair_lock} was set but the creator has used fair_lock={fair_lock_remote}")
+
+            # Check if lock_free parameter was not set to inconsistent value
+            lock_free_remote = self.lock_free_remote[0:1] == b'1'
+            if lock_free is None:
+                lock_free = lock_free_remote
+            elif lock_free != lock_free_remote:
+                raise Exceptions.ParameterMismatch(f"lock_free={lock_free} was set but the creator has used lock_free={lock_free_remote}")
+
+            # Check if wal parameter was not set to inconsistent value
+            wal_remote = bytes(self.wal_remote).decode('utf-8').strip('\x00') or None
+            if wal is None:
+                wal = wal_remote
+            elif wal != wal_remote:
+                raise Exceptions.ParameterMismatch(f"wal={wal} was set but the creator has used wal={wal_remote}")
+
             # Got existing size of full dump memory, that must mean it's static size
             # and we should attach to it
             if size > 0:
                 self.full_dump_size = size
-                self.full_dump_memory = self.get_memory(create=False, name=self.name + '_full')
+                self.full_dump_memory = self.get_memory(create=False, name=self.name + '_full', path=self.path)
+
+        if fair_lock and not shared_lock:
+            raise Exceptions.ParameterMismatch("fair_lock=True needs shared_lock=True")
+
+        if lock_free and not shared_lock:
+            raise Exceptions.ParameterMismatch("lock_free=True needs shared_lock=True")
 
         # Local lock for all processes and threads created by the same interpreter
         if shared_lock:
             try:
-                self.lock = self.SharedLock(self, 'lock_remote', 'lock_pid_remote')
+                self.lock = self.SharedLock(self, 'lock_remote', 'lock_pid_remote', 'lock_futex_remote', 'lock_readers_remote',
+                    'lock_tickets_remote' if fair_lock else None)
             except NameError:
                 #self.cleanup()
                 raise Exceptions.MissingDependency("Install `atomics` Python package to use shared_lock=True") from None
         else:
-            self.lock = multiprocessing.RLock()
+            self.lock = self.RLock(ctx=multiprocessing.get_context())
 
         self.shared_lock = shared_lock
+        self.fair_lock = bool(fair_lock)
+
+        # Writers reserve space in the update stream with compare-and-swap on its tail, see append_update(),
+        # and move the head over complete updates with compare-and-swap on the generation, see advance_head()
+        self.lock_free = bool(lock_free)
+        if self.lock_free:
+            load_atomic_cas_8()
+            self.stream_tail_address = ctypes.addressof(ctypes.c_uint64.from_buffer(self.stream_tail_remote))
+            self.generation_address = ctypes.addressof(ctypes.c_uint64.from_buffer(self.generation_remote))
+            # Head of the stream that we have seen standing still and since when, see advance_head()
+            self.stalled_head = (None, None)
+
+        # Wakes up everyone waiting for new updates, see wait_for_update()
+        self.stream_futex = None
+        if futex_syscall and self.SharedLock.use_futex:
+            try:
+                self.stream_futex = self.Futex(self.stream_futex_remote)
+            except NameError:
+                # Without the atomics package, waiting users poll the stream instead
+                pass
 
         # Parameters that could be read from remote if we are connecting to an existing UltraDict
         self.recurse = recurse
+        self.zero_copy = bool(zero_copy)
+        self.lazy = bool(lazy)
+        self.versions = bool(versions)
 
         # In recurse mode, we must ensure a recurse register
         if self.recurse:
             # Must be either the name of an UltraDict as a string or an UltraDict instance
             if recurse_register is not None:
                 if type(recurse_register) == str:
-                    self.recurse_register = UltraDict(name=recurse_register)
+                    self.recurse_register = UltraDict(name=recurse_register, path=path)
                 elif type(recurse_register) == UltraDict:
                     self.recurse_register = recurse_register
                 else:
@@ -476,7 +1507,7 @@ class UltraDict(collections.UserDict, dict):
             # If no register was defined, we should create one
             else:
                 self.recurse_register = UltraDict(name=f'{self.name}_register',
-                    recurse=False, auto_unlink=False, shared_lock=self.shared_lock)
+                    recurse=False, auto_unlink=False, shared_lock=self.shared_lock, path=path)
                 # The register should not run its own finalizer if we need it later for unlinking our nested children
                 if self.auto_unlink:
                     self.recurse_register.finalizer.detach()
@@ -485,8 +1516,20 @@ class UltraDict(collections.UserDict, dict):
         else:
             self.recurse_register = None
 
+        # Everyone who writes also appends to the write-ahead log, only the creator replays it
+        self.wal = wal
+        replayed = 0
+        if wal:
+            self.open_wal()
+            if hasattr(self.control, 'created_by_ultra'):
+                replayed = self.replay_wal()
+
         super().__init__(*args, **kwargs)
 
+        # UserDict.__init__() has replaced our local copy, so the replayed updates are loaded from the full dump again
+        if replayed:
+            self.load(force=True)
+
         # Load all data from shared memory
         self.apply_update()
 
@@ -504,7 +1547,7 @@ class UltraDict(collections.UserDict, dict):
 
     def __del__(self):
         #log.debug("__del__", self.name)
-        self.close()
+        self.close(from_finalizer=True)
         if hasattr(self, 'recurse') and self.recurse:
             #log.debug("Close recurse register")
             self.recurse_register.close()
@@ -521,6 +1564,63 @@ class UltraDict(collections.UserDict, dict):
         self.shared_lock_remote            = self.control.buf[18: 19]
         self.recurse_remote                = self.control.buf[19: 20]
         self.full_dump_memory_name_remote  = self.control.buf[20:275]
+        # Lap counter of the circular update stream
+        self.update_stream_lap_remote      = self.control.buf[280:284]
+        # Stream position up to which the latest full dump contains all updates,
+        # the update stream must not be overwritten from there on
+        self.full_dump_stream_position_remote = self.control.buf[284:288]
+        self.full_dump_stream_lap_remote   = self.control.buf[288:292]
+        # Length of the latest full dump, used to estimate the cost of a new one
+        self.full_dump_length_remote       = self.control.buf[292:296]
+        # Compactions of the update stream, see compact()
+        self.compaction_counter_remote     = self.control.buf[296:300]
+        self.compaction_length_remote      = self.control.buf[300:304]
+        self.compaction_memory_name_remote = self.control.buf[304:559]
+        self.zero_copy_remote              = self.control.buf[559:560]
+        self.lazy_remote                   = self.control.buf[560:561]
+        self.versions_remote               = self.control.buf[561:562]
+        self.fair_lock_remote              = self.control.buf[562:563]
+        # Futexes of the writers and readers of the shared lock, see SharedLock.wait()
+        self.lock_futex_remote             = self.control.buf[564:580]
+        # Number of readers and number of waiting writers of the shared lock
+        self.lock_readers_remote           = self.control.buf[580:588]
+        # Next ticket and ticket being served of the shared lock, see fair_lock
+        self.lock_tickets_remote           = self.control.buf[588:596]
+        self.lock_free_remote              = self.control.buf[563:564]
+        # Offset over all laps up to which the update stream is reserved, see lock_free
+        self.stream_tail_remote            = self.control.buf[600:608]
+        # Futex to wait for new updates, see wait_for_update() and lock_free
+        self.stream_futex_remote           = self.control.buf[608:616]
+        # Offset of the head of the stream over all laps in one word, written before
+        # the head itself, so readers can check for new updates with one read
+        self.generation_remote             = self.control.buf[616:624]
+        # File name of the write-ahead log, see wal
+        self.wal_remote                    = self.control.buf[624:879]
+        # Pid and offset of the writer that has reserved the rest of a lap of the stream, see reserve()
+        self.stream_reserver_remote        = self.control.buf[879:891]
+
+    def reset_after_restart(self):
+        """
+        Reset the state of the shared lock and of waiting or appending processes in the control
+        memory. Only called by the first process that uses the files after all processes before
+        have ended, see `path`.
+        """
+        self.lock_remote[:] = bytes(len(self.lock_remote))
+        self.lock_pid_remote[:] = bytes(len(self.lock_pid_remote))
+        self.lock_futex_remote[:] = bytes(len(self.lock_futex_remote))
+        self.lock_readers_remote[:] = bytes(len(self.lock_readers_remote))
+        self.lock_tickets_remote[:] = bytes(len(self.lock_tickets_remote))
+        self.stream_futex_remote[:] = bytes(len(self.stream_futex_remote))
+
+        # Space that was reserved but never published is given up. Lock-free writers only move the generation, see get_stream_head()
+        if self.lock_free_remote[0:1] == b'1':
+            head = int.from_bytes(self.generation_remote, 'little')
+        else:
+            lap, position = self.get_lap_and_position(self.update_stream_lap_remote, self.update_stream_position_remote)
+            head = lap * self.buffer_size + position
+        self.generation_remote[:] = head.to_bytes(8, 'little')
+        self.stream_tail_remote[:] = head.to_bytes(8, 'little')
+        self.stream_reserver_remote[:] = bytes(len(self.stream_reserver_remote))
 
     def del_remotes(self):
         """
@@ -535,20 +1635,26 @@ class UltraDict(collections.UserDict, dict):
 
     def __reduce__(self):
         from functools import partial
-        return (partial(self.__class__, name=self.name, auto_unlink=self.auto_unlink, recurse_register=self.recurse_register), ())
+        return (partial(self.__class__, name=self.name, auto_unlink=self.auto_unlink, recurse_register=self.recurse_register,
+            path=self.path), ())
 
     @staticmethod
-    def get_memory(*, create=True, name=None, size=0):
+    def get_memory(*, create=True, name=None, size=0, path=None):
         """
         Attach an existing SharedMemory object with `name`.
 
         If `create` is True, create the object if it does not exist.
+
+        With `path`, the memory is a memory-mapped file in the directory `path`, see FileMemory.
         """
         assert size > 0 or not create
         if name:
             # First try to attach to existing memory
             try:
-                memory = multiprocessing.shared_memory.SharedMemory(name=name)
+                if path:
+                    memory = UltraDict.FileMemory(path, name=name)
+                else:
+                    memory = multiprocessing.shared_memory.SharedMemory(name=name)
                 #log.debug('Attached shared memory: ', memory.name)
 
                 if create:
@@ -560,7 +1666,10 @@ class UltraDict(collections.UserDict, dict):
 
         # No existing memory found
         if create or create is None:
-            memory = multiprocessing.shared_memory.SharedMemory(create=True, size=size, name=name)
+            if path:
+                memory = UltraDict.FileMemory(path, name=name, create=True, size=size)
+            else:
+                memory = multiprocessing.shared_memory.SharedMemory(create=True, size=size, name=name)
             #multiprocessing.resource_tracker.unregister(memory._name, 'shared_memory')
             # Remember that we have created this memory
             memory.created_by_ultra = True
@@ -571,16 +1680,52 @@ class UltraDict(collections.UserDict, dict):
         raise Exceptions.CannotAttachSharedMemory(f"Could not get memory '{name}'")
 
     #@profile
-    def dump(self):
-        """ Dump the full dict into shared memory """
+    def dump(self, reset_stream=False, reserved=False):
+        """
+        Dump the full dict into shared memory
+
+        The update stream is not reset by a full dump. Everyone who has already applied
+        the latest updates can continue streaming, only users who have fallen behind the
+        position of the full dump need to load it.
+
+        If `reset_stream` is True, the update stream continues at the start of a new lap,
+        which forces all other users to load the full dump. With `lock_free`, the rest of
+        the current lap is reserved for that, unless the caller has already done it (`reserved`).
+        """
 
         with self.lock:
             old = bytes(self.full_dump_memory_name_remote).decode('utf-8').strip().strip('\x00')
 
+            if reset_stream and self.lock_free and not reserved:
+                start, end = self.reserve(None)
+                try:
+                    self.wait_for_head(start)
+                    return self.dump(reset_stream=True, reserved=True)
+                except BaseException:
+                    self.abandon_reservation(start, end)
+                    raise
+
             self.apply_update()
 
-            marshalled = self.serializer.dumps(self.data)
+            # After applying all updates, our local position is the remote position
+            lap, position = self.update_stream_lap, self.update_stream_position
+            if reset_stream:
+                lap, position = (lap * self.buffer_size + position) // self.buffer_size + 1, 0
+
+            # Out-of-band buffers of big values, not possible with a static full dump memory
+            # because it will be overwritten by the next full dump
+            buffers = []
+            if self.lazy and not self.full_dump_size:
+                marshalled = self.dumps_lazy(self.data, buffers)
+            elif self.zero_copy and not self.full_dump_size:
+                marshalled = self.dumps_zero_copy(self.data, buffers)
+            else:
+                marshalled = self.serializer.dumps(self.data)
+            if self.versions:
+                # Versions of all keys come last, after the buffers of the body
+                buffers.append(pickle.PickleBuffer(pickle.dumps(self.key_versions)))
             length = len(marshalled)
+            size = self.get_dump_size(marshalled, buffers)
 
             # If we don't have a fixed size, let's create full dump memory dynamically
             # TODO: This causes issues on Windows because the memory is not persistant
@@ -589,23 +1734,14 @@ class UltraDict(collections.UserDict, dict):
                 full_dump_memory = self.full_dump_memory
             else:
                 # Dynamic full dump memory
-                full_dump_memory = self.get_memory(create=True, size=length + 6)
+                full_dump_memory = self.get_memory(create=True, size=size, path=self.path)
 
             #log.debug("Full dump memory: ", full_dump_memory)
 
-            if length + 6 > full_dump_memory.size:
-                raise Exceptions.FullDumpMemoryFull(f'Full dump memory too small for full dump: needed={length + 6} got={full_dump_memory.size}')
+            if size > full_dump_memory.size:
+                raise Exceptions.FullDumpMemoryFull(f'Full dump memory too small for full dump: needed={size} got={full_dump_memory.size}')
 
-            # Write header, 6 bytes
-            # First byte is FF byte
-            full_dump_memory.buf[0:1] = b'\xFF'
-            # Then comes 4 bytes of length of the body
-            full_dump_memory.buf[1:5] = length.to_bytes(4, 'little')
-            # Then another FF bytes, end of header
-            full_dump_memory.buf[5:6] = b'\xFF'
-
-            # Write body
-            full_dump_memory.buf[6:6+length] = marshalled
+            self.write_dump(full_dump_memory, marshalled, lap, position, buffers)
 
             # On Windows, if we close it, it cannot be read anymore by anyone else.
             if not self.full_dump_size and sys.platform != 'win32':
@@ -618,22 +1754,46 @@ class UltraDict(collections.UserDict, dict):
             # we update the remote name so other users can find it
             if not (self.full_dump_size and self.full_dump_memory):
                 self.full_dump_memory_name_remote[:] = full_dump_memory.name.encode('utf-8').ljust(255)
+            self.full_dump_length_remote[:] = length.to_bytes(4, 'little')
+
+            # The full dump contains all compacted updates, so the compaction can go.
+            # This must happen after updating the full dump name, see load().
+            old_compaction = self.get_compaction_memory_name()
+            self.compaction_memory_name_remote[:] = b'\x00' * 255
+            self.compaction_length_remote[:] = b'\x00\x00\x00\x00'
+
+            # From now on, the update stream is protected from being overwritten starting at the
+            # position of the full dump. Lap first, then position, see get_full_dump_stream_position()
+            self.full_dump_stream_lap_remote[:] = lap.to_bytes(4, 'little')
+            self.full_dump_stream_position_remote[:] = position.to_bytes(4, 'little')
 
-            self.full_dump_counter += 1
             current = int.from_bytes(self.full_dump_counter_remote, 'little')
+            self.full_dump_counter = current + 1
             # Now also increment the remote counter
             self.full_dump_counter_remote[:] = int(current + 1).to_bytes(4, 'little')
 
-            # Reset the stream position to zero as we have
-            # just provided a fresh new full dump
-            self.update_stream_position = 0
-            self.update_stream_position_remote[:] = b'\x00\x00\x00\x00'
+            if reset_stream:
+                # Continue the update stream at the start of a new lap
+                self.update_stream_lap = lap
+                self.update_stream_position = position
+                if self.lock_free:
+                    # Our reservation of the rest of the lap holds the head, others move it on from the new lap, see publish()
+                    self.publish(self.get_head(), lap * self.buffer_size + position)
+                else:
+                    # Generation first, then position, then lap, see get_stream_head()
+                    self.generation_remote[:] = (lap * self.buffer_size + position).to_bytes(8, 'little')
+                    self.update_stream_position_remote[:] = position.to_bytes(4, 'little')
+                    self.update_stream_lap_remote[:] = lap.to_bytes(4, 'little')
+                    if self.stream_futex:
+                        self.stream_futex.wake(self.Futex.all)
 
             #log.info("Dumped dict with {} elements to {} bytes, remote_counter={}", len(self), len(marshalled), current+1)
 
             # If the old full dump memory was dynamically created, delete it
             if old and old != full_dump_memory.name and not self.full_dump_size:
-                self.unlink_by_name(old)
+                self.unlink_by_name(old, path=self.path)
+            if old_compaction:
+                self.unlink_by_name(old_compaction, ignore_errors=True, path=self.path)
 
             # On Windows, we need to keep a reference to the full dump memory,
             # otherwise it's destoryed
@@ -654,13 +1814,22 @@ class UltraDict(collections.UserDict, dict):
             name = bytes(self.full_dump_memory_name_remote).decode('utf-8').strip().strip('\x00')
             #log.debug("Full dump name={}", name)
             assert len(name) >= 1
-            return self.get_memory(create=False, name=name)
+            return self.get_memory(create=False, name=name, path=self.path)
         except Exceptions.CannotAttachSharedMemory as e:
             if retry < max_retry:
                 return self.get_full_dump_memory(max_retry=max_retry, retry=retry+1)
             elif retry == max_retry:
+                if self.lock_free:
+                    # The lock holder might wait for our reservation to be published, see wait_for_head(),
+                    # so we must never block on the lock. Until we get it, we try again after a while.
+                    try:
+                        with self.lock.read(block=False):
+                            return self.get_full_dump_memory(max_retry=max_retry, retry=retry+1)
+                    except Exceptions.CannotAcquireLock:
+                        self.lock.wait(self.SharedLock.futex_timeout)
+                        return self.get_full_dump_memory(max_retry=max_retry, retry=retry)
                 # On the last retry, let's use a lock to ensure we can safely import the dump
-                with self.lock:
+                with self.lock.read():
                     return self.get_full_dump_memory(max_retry=max_retry, retry=retry+1)
             else:
                 raise e
@@ -670,139 +1839,1819 @@ class UltraDict(collections.UserDict, dict):
         """
         Opportunistacally load full dumps without any locking.
 
+        If the update stream has been compacted since the latest full dump, the compaction
+        is applied on top of the full dump.
+
         There is a rare case where a full dump is replaced with a newer full dump while
         we didn't have the chance to load the old one. In this case, we just retry.
         """
         full_dump_counter = int.from_bytes(self.full_dump_counter_remote, 'little')
         #log.debug("Loading full dump local_counter={} remote_counter={}", self.full_dump_counter, full_dump_counter)
+        if force or (self.full_dump_counter < full_dump_counter):
+            self.install_full_dump(self.read_full_dump())
+        else:
+            raise Exception("Cannot load full dump, no new data available")
+
+    def read_full_dump(self):
+        """
+        Read the latest full dump and the compaction on top of it, see load(). Our local copy is not
+        touched, so this can happen in another thread, see watch(). Returns the input for install_full_dump().
+        """
+        full_dump_counter = int.from_bytes(self.full_dump_counter_remote, 'little')
         try:
-            if force or (self.full_dump_counter < full_dump_counter):
-                if self.full_dump_size and self.full_dump_memory:
-                    full_dump_memory = self.full_dump_memory
-                else:
-                    # Retry if necessary
-                    full_dump_memory = self.get_full_dump_memory()
-
-                buf = full_dump_memory.buf
-                pos = 0
-
-                # Read header
-                # The first byte should be a FF byte to introduce the header
-                assert bytes(buf[pos:pos+1]) == b'\xFF'
-                pos += 1
-                # Then comes 4 bytes of length
-                length = int.from_bytes(bytes(buf[pos:pos+4]), 'little')
-                assert length > 0, (self.status(), full_dump_memory, bytes(buf[:]).decode('utf-8').strip().strip('\x00'), len(buf))
-                pos += 4
-                #log.debug("Found update, pos={} length={}", pos, length)
-                assert bytes(buf[pos:pos+1]) == b'\xFF'
-                pos += 1
-                # Unserialize the update data, we expect a tuple of key and value
-                self.data = self.serializer.loads(bytes(buf[pos:pos+length]))
-                self.full_dump_counter = full_dump_counter
-                self.update_stream_position = 0
+            # The compaction name must be read before the full dump name, see dump()
+            compaction_name = self.get_compaction_memory_name()
 
-                if sys.platform != 'win32' and not self.full_dump_memory:
-                    full_dump_memory.close()
+            if self.full_dump_size and self.full_dump_memory:
+                full_dump_memory = self.full_dump_memory
             else:
-                raise Exception("Cannot load full dump, no new data available")
+                # Retry if necessary
+                full_dump_memory = self.get_full_dump_memory()
+
+            lap, position, data, views = self.read_dump(full_dump_memory)
+
+            key_versions = {}
+            if self.versions:
+                key_versions = pickle.loads(views.pop())
+
+            lazy_dump = None
+            if self.lazy and not self.full_dump_size:
+                data, lazy_dump = self.loads_lazy(data, views)
+
+            if sys.platform != 'win32' and not self.full_dump_memory and not views:
+                full_dump_memory.close()
+
+            compaction = None
+            if compaction_name:
+                try:
+                    compaction_memory = self.get_memory(create=False, name=compaction_name, path=self.path)
+                except Exceptions.CannotAttachSharedMemory:
+                    # The compaction has just been replaced by a newer one
+                    return self.read_full_dump()
+
+                lap, position, (full_dump_name, *compaction), _ = self.read_dump(compaction_memory)
+
+                if sys.platform != 'win32':
+                    compaction_memory.close()
+
+                # The compaction belongs to an older full dump, so a new full dump
+                # has just been created
+                if full_dump_name != full_dump_memory.name:
+                    return self.read_full_dump()
+
+            return full_dump_counter, full_dump_memory, lap, position, data, views, lazy_dump, key_versions, compaction
         except AssertionError as e:
             full_dump_delta = int.from_bytes(self.full_dump_counter_remote, 'little') - self.full_dump_counter
             if full_dump_delta > 1:
                 # If more than one new full dump was created during the time we were trying to load one full dump
                 # it can happen that our full dump has just disappeared
-                return self.load(force=True)
+                return self.read_full_dump()
             # TODO: Before we reach max recursion depth, try to load the full dump using a lock
             self.print_status()
             raise e
 
-    #@profile
-    def append_update(self, key, item, delete=False):
-        """ Append dict changes to shared memory stream """
+    def install_full_dump(self, full_dump):
+        """ Replace our local copy with a full dump read by read_full_dump() """
+        full_dump_counter, full_dump_memory, lap, position, data, views, lazy_dump, key_versions, compaction = full_dump
+
+        old_data, old_lazy_dump = self.data, self.lazy_dump
+        self.data = data
+        self.lazy_dump = lazy_dump
+        self.key_versions = key_versions
+
+        if compaction:
+            compacted, compacted_versions = compaction
+            # Applied like a batch, the keys of deletes might not exist
+            self.apply_record(2, None, compacted, notify=False)
+            for mode, key, _ in compacted:
+                if mode:
+                    key_versions[key] = compacted_versions.get(key, 0)
+                else:
+                    key_versions.pop(key, None)
+
+        self.full_dump_counter = full_dump_counter
+        self.update_stream_lap = lap
+        self.update_stream_position = position
+        # Keys get new ids in the stream after the full dump or compaction
+        self.key_table.reset()
+
+        # Our local copy has been replaced as a whole. Placeholders of the old local copy can
+        # still be loaded from the old lazy full dump, so this must happen before it is closed.
+        for listener in self.listeners:
+            listener('resync', old_lazy_dump, old_data, self.data)
+        old_lazy_dump = None
+
+        # Values of our old local copy might have pointed into older full dumps
+        self.close_view_memories()
+        if views:
+            # Values of our local copy point into the full dump memory, so it must stay open
+            self.view_memories.append(full_dump_memory)
+
+    def read_dump(self, memory):
+        """
+        Read a full dump or a compaction from `memory`.
 
-        # If mode is 0, it means delete the key from the dict
-        # If mode is 1, it means update the key
-        #mode = not delete
-        marshalled = self.serializer.dumps((not delete, key, item))
+        Returns the lap and the position in the update stream to continue
+        streaming from, the unserialized body and the out-of-band buffers,
+        which are views into `memory`.
+        """
+        buf = memory.buf
+
+        # Read header, 14 bytes
+        # FF byte, 4 bytes of length, 4 bytes of lap and 4 bytes of position
+        # in the update stream to continue from, then another FF byte
+        marker, length, lap, position, end_marker = struct.unpack_from('<BIIIB', buf, 0)
+        assert marker == 0xFF
+        assert length > 0, (self.status(), memory, bytes(buf[:]).decode('utf-8').strip().strip('\x00'), len(buf))
+        assert end_marker == 0xFF
+        #log.debug("Found update, pos={} length={}", pos, length)
+
+        # After the body come 4 bytes with the number of out-of-band buffers,
+        # each buffer has 4 bytes of length in front
+        pos = 14 + length
+        count, = struct.unpack_from('<I', buf, pos)
+        pos += 4
+        buffers = []
+        for _ in range(count):
+            buffer_length, = struct.unpack_from('<I', buf, pos)
+            pos += 4
+            buffers.append(buf[pos:pos+buffer_length].toreadonly())
+            pos += buffer_length
+
+        # Unserialize the body directly from shared memory
+        return lap, position, self.loads(buf[14:14+length], buffers), buffers
+
+    @staticmethod
+    def write_dump(memory, marshalled, lap, position, buffers=()):
+        """ Write a full dump or a compaction with its header and out-of-band buffers to `memory` """
+        length = len(marshalled)
+
+        # Write header, 14 bytes
+        # First byte is FF byte
+        memory.buf[0:1] = b'\xFF'
+        # Then comes 4 bytes of length of the body
+        memory.buf[1:5] = length.to_bytes(4, 'little')
+        # Then comes the lap and the position in the update stream, 4 bytes each,
+        # where to continue streaming after loading the dump
+        memory.buf[5:9] = lap.to_bytes(4, 'little')
+        memory.buf[9:13] = position.to_bytes(4, 'little')
+        # Then another FF bytes, end of header
+        memory.buf[13:14] = b'\xFF'
+
+        # Write body
+        pos = 14 + length
+        memory.buf[14:pos] = marshalled
+
+        # Write number of out-of-band buffers, then each buffer with its length in front
+        memory.buf[pos:pos+4] = len(buffers).to_bytes(4, 'little')
+        pos += 4
+        for buffer in buffers:
+            raw = buffer.raw()
+            memory.buf[pos:pos+4] = raw.nbytes.to_bytes(4, 'little')
+            pos += 4
+            memory.buf[pos:pos+raw.nbytes] = raw
+            pos += raw.nbytes
+
+    @staticmethod
+    def get_dump_size(marshalled, buffers=()):
+        """ Size of the memory needed by write_dump() """
+        return 14 + len(marshalled) + 4 + sum(4 + buffer.raw().nbytes for buffer in buffers)
+
+    def dumps_zero_copy(self, data, buffers):
+        """
+        Serialize `data` using pickle protocol 5. Big bytes-like values are put into
+        out-of-band `buffers`, so users loading the full dump get read-only views into
+        the full dump memory instead of copies.
+        """
+        data = { key: pickle.PickleBuffer(value)
+                    if type(value) == memoryview or (type(value) in (bytes, bytearray) and len(value) >= 4096)
+                    else value
+                 for key, value in data.items() }
+        return pickle.dumps(data, protocol=5, buffer_callback=buffers.append)
+
+    def dumps_lazy(self, data, buffers):
+        """
+        Serialize each value of `data` separately into one out-of-band buffer and return
+        the serialized index of the full dump, ie. the keys and the end offsets of their
+        values in the buffer. Users loading the full dump only unserialize the index,
+        values are unserialized on first access, see loads_lazy().
+
+        With zero_copy, big bytes-like values are stored raw instead of serialized.
+        """
+        keys = list(data)
+        raw = set()
+        chunks = []
+        lengths = []
+        append, dumps, zero_copy, lazy_value = chunks.append, pickle.dumps, self.zero_copy, self.lazy_value
+
+        if self.lazy_dump is not None:
+            blob, old_offsets, old_raw, old_keys, positions = self.lazy_dump
+            if not positions:
+                positions.update(zip(old_keys, range(len(old_keys))))
+        # Range of consecutive values in the old lazy full dump, they are copied over in one go
+        run_start = run_stop = 0
+
+        for index, (key, value) in enumerate(data.items()):
+            if value is lazy_value:
+                # Never accessed since we have loaded the full dump, just copy it over
+                old = positions[key]
+                start = old_offsets[old - 1] if old else 0
+                if start != run_stop:
+                    if run_stop > run_start:
+                        append(blob[run_start:run_stop])
+                    run_start = start
+                run_stop = old_offsets[old]
+                lengths.append(run_stop - start)
+                if old in old_raw:
+                    raw.add(index)
+                continue
+
+            if run_stop > run_start:
+                append(blob[run_start:run_stop])
+                run_start = run_stop
+
+            if zero_copy and (type(value) == memoryview or (type(value) in (bytes, bytearray) and len(value) >= 4096)):
+                chunk = memoryview(value).cast('B')
+                raw.add(index)
+            else:
+                chunk = dumps(value)
+            append(chunk)
+            lengths.append(len(chunk))
+
+        if run_stop > run_start:
+            append(blob[run_start:run_stop])
+
+        offsets = array.array('Q', itertools.accumulate(lengths))
+        buffers.append(pickle.PickleBuffer(b''.join(chunks)))
+        return pickle.dumps((keys, offsets.tobytes(), raw))
+
+    def loads_lazy(self, index, buffers):
+        """
+        Build our local copy from the index of a lazy full dump with placeholders
+        for all values, see dumps_lazy().
+
+        Returns the local copy and the index of the lazy full dump. The positions
+        of the keys in the index are only looked up on first access.
+        """
+        keys, offsets_bytes, raw = index
+        offsets = array.array('Q')
+        offsets.frombytes(offsets_bytes)
+        data = dict.fromkeys(keys, self.lazy_value)
+        return data, (buffers[0], offsets, raw, keys, {})
+
+    def get_lazy_chunk(self, key, lazy_dump=None):
+        """
+        Get the serialized bytes of the value of `key` in the lazy full dump and whether they are raw bytes.
+        Another lazy full dump than ours can be given, e.g. the one our local copy was loaded from before.
+        """
+        blob, offsets, raw, keys, positions = lazy_dump or self.lazy_dump
+        if not positions:
+            positions.update(zip(keys, range(len(keys))))
+        index = positions[key]
+        start = offsets[index - 1] if index else 0
+        return blob[start:offsets[index]], index in raw
+
+    def load_lazy_value(self, key, lazy_dump=None):
+        """ Unserialize the value of `key` from the lazy full dump, see get_lazy_chunk() """
+        chunk, is_raw = self.get_lazy_chunk(key, lazy_dump)
+        if is_raw:
+            return chunk
+        return self.loads(chunk)
+
+    def load_lazy_values(self):
+        """ Unserialize all values of our local copy that have not been accessed yet """
+        if self.lazy_dump is None:
+            return
+        data = self.data
+        for key, value in data.items():
+            if value is self.lazy_value:
+                data[key] = self.load_lazy_value(key)
+        self.lazy_dump = None
+
+    def loads(self, view, buffers=None):
+        """
+        Unserialize directly from a memoryview into shared memory. Pickle does not
+        need to copy the memoryview to bytes first, other serializers might.
+        """
+        if self.serializer is pickle:
+            return pickle.loads(view, buffers=buffers)
+        return self.serializer.loads(bytes(view))
+
+    def close_view_memories(self):
+        """ Close full dump memories that values of our local copy pointed into, unless they are still in use """
+        for memory in list(self.view_memories):
+            try:
+                memory.close()
+                self.view_memories.remove(memory)
+            except BufferError:
+                # Someone still holds a view into the memory
+                pass
+
+    def get_compaction_memory_name(self):
+        return bytes(self.compaction_memory_name_remote).decode('utf-8').strip().strip('\x00')
+
+    def get_compaction_costs(self):
+        """
+        Estimate the costs of compacting the update stream and of creating a new full dump
+        as the number of bytes that have to be unserialized and serialized again.
+        """
+        lap, position = self.get_stream_head()
+        full_dump_lap, full_dump_position = self.get_full_dump_stream_position()
+        stream_length = (lap - full_dump_lap) * self.buffer_size + position - full_dump_position
+
+        compaction_cost = int.from_bytes(self.compaction_length_remote, 'little') + stream_length
+        full_dump_cost = int.from_bytes(self.full_dump_length_remote, 'little')
+        return compaction_cost, full_dump_cost
+
+    def should_compact(self):
+        """
+        Decide if compacting the update stream is cheaper than creating a new full dump.
+
+        There must be a dynamic full dump to build on, compactions are not used with
+        a static `full_dump_size`.
+        """
+        if self.full_dump_size:
+            return False
+        compaction_cost, full_dump_cost = self.get_compaction_costs()
+        return 0 < compaction_cost < full_dump_cost
+
+    def compact(self):
+        """
+        Compact the update stream into a fresh compaction memory instead of creating a full dump.
+
+        Only the last update of each key since the latest full dump is kept, operations like add()
+        are folded into the update before them. Users that load
+        the latest full dump also apply the compaction and continue streaming from the position
+        of the compaction. Users that have already applied all updates are not affected at all.
+        """
+        with self.lock:
+            self.apply_update()
+
+            # After applying all updates, our local position is the remote position
+            lap, position = self.update_stream_lap, self.update_stream_position
+            full_dump_name = bytes(self.full_dump_memory_name_remote).decode('utf-8').strip().strip('\x00')
+            old = self.get_compaction_memory_name()
+
+            compacted = {}
+            compacted_versions = {}
+
+            def fold(update, version=0):
+                mode, key, value = update
+                previous = compacted.get(key)
+                if mode == 3 and previous is not None:
+                    if previous[0] == 3:
+                        # Both are operations, chain them
+                        update = (3, key, self.chain_operations(previous[2], value))
+                    else:
+                        # Operations on a known value or on a deleted key result in a known value
+                        update = (1, key, self.run_operations(previous[2], value, previous[0] == 1))
+                compacted[key] = update
+                if self.versions:
+                    compacted_versions[key] = version
+
+            # Start from the previous compaction, if there is one
+            if old:
+                old_memory = self.get_memory(create=False, name=old, path=self.path)
+                _, _, (_, updates, old_versions), _ = self.read_dump(old_memory)
+                old_memory.close()
+                for update in updates:
+                    compacted[update[1]] = update
+                compacted_versions.update(old_versions)
+
+            # Then add all updates streamed since the latest full dump or compaction
+            full_dump_lap, full_dump_position = self.get_full_dump_stream_position()
+            offsets = []
+            updates, _, _ = self.read_updates(full_dump_lap, full_dump_position, lap * self.buffer_size + position, offsets)
+            for update, offset in zip(updates, offsets):
+                if update[0] == 2:
+                    # Flatten batches
+                    for batch_update in update[2]:
+                        fold(batch_update, offset)
+                else:
+                    fold(update, offset)
+
+            marshalled = self.serializer.dumps((full_dump_name, list(compacted.values()), compacted_versions))
+            length = len(marshalled)
+
+            compaction_memory = self.get_memory(create=True, size=self.get_dump_size(marshalled), path=self.path)
+            self.write_dump(compaction_memory, marshalled, lap, position)
+
+            # On Windows, if we close it, it cannot be read anymore by anyone else.
+            if sys.platform != 'win32':
+                compaction_memory.close()
+
+            self.compaction_memory_name_remote[:] = compaction_memory.name.encode('utf-8').ljust(255)
+            self.compaction_length_remote[:] = length.to_bytes(4, 'little')
+
+            # Users that have fallen behind the compaction need to load it.
+            # Lap first, then position, see get_full_dump_stream_position()
+            self.full_dump_stream_lap_remote[:] = lap.to_bytes(4, 'little')
+            self.full_dump_stream_position_remote[:] = position.to_bytes(4, 'little')
+
+            current = int.from_bytes(self.compaction_counter_remote, 'little')
+            self.compaction_counter_remote[:] = int(current + 1).to_bytes(4, 'little')
+
+            # The full dump counter signals everyone to check if they have fallen behind
+            current = int.from_bytes(self.full_dump_counter_remote, 'little')
+            self.full_dump_counter = current + 1
+            self.full_dump_counter_remote[:] = int(current + 1).to_bytes(4, 'little')
+
+            #log.info("Compacted {} updates to {} bytes", len(compacted), length)
+
+            if old:
+                self.unlink_by_name(old, ignore_errors=True, path=self.path)
+
+            # On Windows, we need to keep a reference to the compaction memory,
+            # otherwise it's destoryed
+            self.compaction_memory = compaction_memory
+
+            return compaction_memory
+
+    def checkpoint(self, path):
+        """
+        Write the latest full dump, the compaction and the update stream after them to the file `path`,
+        so the dict can be rebuilt from it with restore().
+
+        The shared memory is copied to the file in chunks without unserializing anything. This does not
+        take the lock, if a new full dump or compaction is created meanwhile, the checkpoint starts over.
+        The file is replaced atomically and synced to disk. With `wal`, the write-ahead log
+        is cleared afterwards if nothing has been appended since the copy of the stream.
+        """
+        buffer_size, chunk_size = self.buffer_size, self.checkpoint_chunk_size
+        flags = bytes(self.shared_lock_remote) + bytes(self.recurse_remote) + bytes(self.zero_copy_remote) + \
+            bytes(self.lazy_remote) + bytes(self.versions_remote) + bytes(self.fair_lock_remote) + bytes(self.lock_free_remote)
+        temp_path = f'{path}.tmp'
+
+        while True:
+            # The compaction name must be read before the full dump name, see dump()
+            counter = int.from_bytes(self.full_dump_counter_remote, 'little')
+            compaction_name = self.get_compaction_memory_name()
+            memories = []
+            try:
+                if counter and self.full_dump_size:
+                    # The static full dump memory is overwritten in place by the next full dump,
+                    # so it's copied while nobody can dump
+                    with self.lock.read():
+                        full_dump = bytes(self.full_dump_memory.buf[:self.get_dump_end(self.full_dump_memory.buf)])
+                elif counter:
+                    memories.append(self.get_full_dump_memory())
+                    full_dump = memories[-1].buf[:self.get_dump_end(memories[-1].buf)]
+                else:
+                    full_dump = b''
+                if compaction_name:
+                    memories.append(self.get_memory(create=False, name=compaction_name, path=self.path))
+                    compaction = memories[-1].buf[:self.get_dump_end(memories[-1].buf)]
+                else:
+                    compaction = b''
+            except (Exceptions.CannotAttachSharedMemory, AssertionError):
+                # Replaced by a newer full dump or compaction in the meantime.
+                # Views into the memories must be released before closing them
+                full_dump = compaction = None
+                for memory in memories:
+                    memory.close()
+                continue
+
+            start_lap, start_position = self.get_full_dump_stream_position()
+            lap, position = self.get_stream_head()
+            start, end = start_lap * buffer_size + start_position, lap * buffer_size + position
+
+            with open(temp_path, 'wb') as f:
+                f.write(self.checkpoint_header.pack(b'ULTRADCP', 1, flags, buffer_size, self.full_dump_size or 0,
+                    start_lap, start_position, lap, position, len(full_dump), len(compaction)))
+                for data in (full_dump, compaction):
+                    for pos in range(0, len(data), chunk_size):
+                        f.write(data[pos:pos+chunk_size])
+                # Views into the memories must be released before closing them
+                del data
+
+                # The stream from the latest full dump or compaction up to the head, without the laps
+                offset = start
+                while offset < end:
+                    pos = offset % buffer_size
+                    stop = min(end - offset, buffer_size - pos, chunk_size)
+                    f.write(self.buffer.buf[pos:pos+stop])
+                    offset += stop
+
+                f.flush()
+                os.fsync(f.fileno())
+
+            del full_dump, compaction
+            for memory in memories:
+                memory.close()
+
+            # The stream is only overwritten after a new full dump or compaction
+            if counter == int.from_bytes(self.full_dump_counter_remote, 'little'):
+                break
+
+        os.replace(temp_path, path)
+
+        # The write-ahead log can start over if the checkpoint contains all updates in it. Lock-free
+        # writers append to the log without the lock, so it's never cut then.
+        if self.wal and not self.lock_free:
+            with self.lock:
+                if int.from_bytes(self.generation_remote, 'little') == end:
+                    os.ftruncate(self.wal_fd, 0)
+
+    def start_checkpoints(self, path, interval):
+        """
+        Write a checkpoint to `path` every `interval` seconds in a background thread, see checkpoint(),
+        until stop_checkpoints() is called or the dict is closed. Nothing is written if the dict has not changed.
+        """
+        self.stop_checkpoints()
+        stop = threading.Event()
+
+        def run():
+            written = None
+            while True:
+                state = (int.from_bytes(self.full_dump_counter_remote, 'little'), int.from_bytes(self.generation_remote, 'little'))
+                if state != written:
+                    try:
+                        self.checkpoint(path)
+                        written = state
+                    except Exception as e: # pylint: disable=broad-except
+                        log.error(f"Exception in checkpoint to path={path!r}: {e!r}")
+                if stop.wait(interval):
+                    return
+
+        self.checkpoint_thread = threading.Thread(target=run, name=f'UltraDict checkpoints {self.name}', daemon=True)
+        self.checkpoint_stop = stop
+        self.checkpoint_thread.start()
+
+    def stop_checkpoints(self):
+        """ Stop writing checkpoints in the background, see start_checkpoints() """
+        if self.checkpoint_thread:
+            self.checkpoint_stop.set()
+            if self.checkpoint_thread is not threading.current_thread():
+                self.checkpoint_thread.join()
+            self.checkpoint_thread = self.checkpoint_stop = None
+
+    def open_wal(self):
+        """
+        Open the write-ahead log for appending and start syncing it to disk every
+        `wal_sync_interval` seconds in a background thread, see write_wal().
+        """
+        self.wal_fd = os.open(self.wal, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+        if not self.wal_sync_interval:
+            return
+        stop = threading.Event()
+
+        def run():
+            synced = 0
+            while not stop.wait(self.wal_sync_interval):
+                # Group commit, one sync for all updates since the last one
+                written = self.wal_written
+                if written != synced:
+                    os.fsync(self.wal_fd)
+                    synced = written
+
+        self.wal_thread = threading.Thread(target=run, name=f'UltraDict WAL {self.name}', daemon=True)
+        self.wal_stop = stop
+        self.wal_thread.start()
+
+    def write_wal(self, marshalled, offset):
+        """
+        Append the serialized update `marshalled` that ends at the stream `offset` to the write-ahead log.
+
+        Each update is appended with a single write, so the updates of many processes don't mix. They only
+        reach the disk with the next sync, so at most the updates of the last `wal_sync_interval` seconds are
+        lost if the machine crashes. With `wal_sync_interval=0`, every update is synced right away.
+        """
+        os.write(self.wal_fd, self.wal_header.pack(offset, len(marshalled), zlib.crc32(marshalled)) + marshalled)
+        if self.wal_sync_interval:
+            self.wal_written += 1
+        else:
+            os.fsync(self.wal_fd)
+
+    def sync_wal(self):
+        """ Sync all updates in the write-ahead log to disk now """
+        if self.wal_fd is not None:
+            os.fsync(self.wal_fd)
+
+    def close_wal(self):
+        """ Stop the background sync, sync a last time and close the write-ahead log """
+        if self.wal_thread:
+            self.wal_stop.set()
+            if self.wal_thread is not threading.current_thread():
+                self.wal_thread.join()
+            self.wal_thread = self.wal_stop = None
+        self.sync_wal()
+        os.close(self.wal_fd)
+        self.wal_fd = None
+
+    def read_wal(self):
+        """
+        Read all updates from the write-ahead log as a list of stream offset and serialized update.
+
+        Reading stops at the first update that is incomplete or damaged, e.g. because the machine
+        has crashed while writing it. Returns the updates and the length of the intact log.
+        """
+        updates = []
+        size = self.wal_header.size
+        with open(self.wal, 'rb') as f:
+            data = f.read()
+        pos = 0
+        while pos + size <= len(data):
+            offset, length, crc = self.wal_header.unpack_from(data, pos)
+            marshalled = data[pos+size:pos+size+length]
+            if len(marshalled) != length or zlib.crc32(marshalled) != crc:
+                break
+            updates.append((offset, marshalled))
+            pos += size + length
+        return updates, pos
+
+    def replay_wal(self):
+        """
+        Apply all updates from the write-ahead log that come after the head of the update stream,
+        e.g. on top of a checkpoint, see restore().
+
+        The updates keep their stream offsets, so their versions are the same as before. They only
+        go into a new full dump, the stream continues in the lap after the last of them, so new
+        updates in the log always have higher offsets. Returns the number of applied updates.
+        """
+        with self.lock:
+            self.apply_update()
+            updates, length = self.read_wal()
+            # Cut off a damaged end, so new updates are not appended behind it
+            os.ftruncate(self.wal_fd, length)
+
+            head = self.update_stream_lap * self.buffer_size + self.update_stream_position
+            # Updates in the log are ordered by their offsets, except for updates too big for the stream, see append_update()
+            updates = sorted((update for update in updates if update[0] > head), key=operator.itemgetter(0))
+            if not updates:
+                return 0
+
+            for offset, marshalled in updates:
+                mode, key, value = self.loads_record(marshalled)
+                self.apply_record(mode, key, value)
+                if self.versions:
+                    self.set_version(mode, key, value, offset)
+
+            # Move the head to the last update, nobody reads the stream up to there because of the full dump.
+            # Generation first, then position, then lap, see get_stream_head()
+            lap, position = divmod(updates[-1][0], self.buffer_size)
+            self.update_stream_lap, self.update_stream_position = lap, position
+            self.generation = lap * self.buffer_size + position
+            self.generation_remote[:] = self.generation.to_bytes(8, 'little')
+            self.stream_tail_remote[:] = self.generation.to_bytes(8, 'little')
+            self.update_stream_position_remote[:] = position.to_bytes(4, 'little')
+            self.update_stream_lap_remote[:] = lap.to_bytes(4, 'little')
+            self.dump(reset_stream=True)
+
+            return len(updates)
+
+    @classmethod
+    def restore(cls, path, name=None, **kwargs):
+        """
+        Create a new UltraDict from a checkpoint file written by checkpoint().
+
+        The full dump and the update stream are copied from the file into the new shared memory as they are,
+        only a compaction is unserialized again because it refers to its full dump by name. The parameters
+        of the dict that has written the checkpoint are used unless they are given in `kwargs`, the
+        `buffer_size` is always the same. In recurse mode, nested UltraDicts are not part of the checkpoint.
+        """
+        with open(path, 'rb') as f:
+            header = f.read(cls.checkpoint_header.size)
+            try:
+                magic, version, flags, buffer_size, full_dump_size, start_lap, start_position, lap, position, \
+                    full_dump_length, compaction_length = cls.checkpoint_header.unpack(header)
+            except struct.error:
+                magic = version = None
+            if magic != b'ULTRADCP' or version != 1:
+                raise Exceptions.InvalidCheckpoint(f"'{path}' is not an UltraDict checkpoint")
+
+            if kwargs.get('buffer_size', buffer_size) != buffer_size:
+                raise Exceptions.ParameterMismatch(f"buffer_size={kwargs['buffer_size']} was set but the checkpoint has buffer_size={buffer_size}")
+            parameters = dict(zip(('shared_lock', 'recurse', 'zero_copy', 'lazy', 'versions', 'fair_lock', 'lock_free'),
+                (flag == ord('1') for flag in flags)))
+            parameters.update(buffer_size=buffer_size, full_dump_size=full_dump_size or None)
+            parameters.update(kwargs)
+            # The write-ahead log is replayed on top of the checkpoint after copying it
+            wal = parameters.pop('wal', None)
+
+            ultra = cls(name=name, create=True, **parameters)
+            chunk_size = cls.checkpoint_chunk_size
+
+            def read_into(view):
+                for pos in range(0, len(view), chunk_size):
+                    if f.readinto(view[pos:pos+chunk_size]) != len(view[pos:pos+chunk_size]):
+                        raise Exceptions.InvalidCheckpoint(f"Checkpoint '{path}' is truncated")
+
+            with ultra.lock:
+                if full_dump_length:
+                    if ultra.full_dump_size:
+                        full_dump_memory = ultra.full_dump_memory
+                        if full_dump_length > full_dump_memory.size:
+                            raise Exceptions.FullDumpMemoryFull(f'Full dump memory too small for full dump: needed={full_dump_length} got={full_dump_memory.size}')
+                    else:
+                        full_dump_memory = ultra.get_memory(create=True, size=full_dump_length, path=ultra.path)
+                        ultra.full_dump_memory_name_remote[:] = full_dump_memory.name.encode('utf-8').ljust(255)
+                    read_into(full_dump_memory.buf[:full_dump_length])
+                    ultra.full_dump_length_remote[:] = full_dump_memory.buf[1:5]
+                    # On Windows, we need to keep a reference to the full dump memory, see dump()
+                    ultra.full_dump_memory = full_dump_memory
+
+                if compaction_length:
+                    compaction = bytearray(compaction_length)
+                    read_into(memoryview(compaction))
+                    _, length, compaction_lap, compaction_position, _ = struct.unpack_from('<BIIIB', compaction, 0)
+                    _, compacted, compacted_versions = ultra.serializer.loads(compaction[14:14+length])
+                    marshalled = ultra.serializer.dumps((full_dump_memory.name, compacted, compacted_versions))
+                    compaction_memory = ultra.get_memory(create=True, size=ultra.get_dump_size(marshalled), path=ultra.path)
+                    ultra.write_dump(compaction_memory, marshalled, compaction_lap, compaction_position)
+                    ultra.compaction_memory_name_remote[:] = compaction_memory.name.encode('utf-8').ljust(255)
+                    ultra.compaction_length_remote[:] = len(marshalled).to_bytes(4, 'little')
+                    ultra.compaction_counter_remote[:] = (1).to_bytes(4, 'little')
+                    ultra.compaction_memory = compaction_memory
+
+                # The stream goes to the same positions in the buffer, so all offsets and versions stay valid
+                offset, end = start_lap * buffer_size + start_position, lap * buffer_size + position
+                while offset < end:
+                    pos = offset % buffer_size
+                    stop = min(end - offset, buffer_size - pos)
+                    read_into(ultra.buffer.buf[pos:pos+stop])
+                    offset += stop
+
+                ultra.full_dump_stream_lap_remote[:] = start_lap.to_bytes(4, 'little')
+                ultra.full_dump_stream_position_remote[:] = start_position.to_bytes(4, 'little')
+                ultra.stream_tail_remote[:] = end.to_bytes(8, 'little')
+                # Generation first, then position, then lap, see get_stream_head()
+                ultra.generation_remote[:] = end.to_bytes(8, 'little')
+                ultra.update_stream_position_remote[:] = position.to_bytes(4, 'little')
+                ultra.update_stream_lap_remote[:] = lap.to_bytes(4, 'little')
+                if full_dump_length:
+                    ultra.full_dump_counter_remote[:] = (1).to_bytes(4, 'little')
+                    ultra.load(force=True)
+                ultra.apply_update()
+
+                if wal:
+                    ultra.wal = os.path.abspath(wal)
+                    ultra.wal_remote[:] = ultra.wal.encode('utf-8').ljust(255, b'\x00')
+                    ultra.open_wal()
+                    ultra.replay_wal()
+
+        return ultra
+
+    @staticmethod
+    def get_dump_end(buf):
+        """ Offset of the end of the full dump or compaction written by write_dump() to `buf` """
+        marker, length = struct.unpack_from('<BI', buf, 0)
+        assert marker == 0xFF and length > 0
+        pos = 14 + length
+        count, = struct.unpack_from('<I', buf, pos)
+        pos += 4
+        for _ in range(count):
+            buffer_length, = struct.unpack_from('<I', buf, pos)
+            pos += 4 + buffer_length
+        return pos
+
+    @staticmethod
+    def get_lap_and_position(lap_remote, position_remote):
+        """
+        Read a consistent pair of lap and position from the control memory.
+
+        Lap and position are two separate values, so we read the lap again after
+        reading the position and retry if it has changed in the meantime.
+        """
+        while True:
+            lap = int.from_bytes(lap_remote, 'little')
+            position = int.from_bytes(position_remote, 'little')
+            if lap == int.from_bytes(lap_remote, 'little'):
+                return lap, position
+
+    def get_stream_head(self):
+        """
+        Get lap and position of the remote end of the update stream.
+
+        Writers update the position first and the lap afterwards, so a torn read can
+        only ever be behind the real position, which is harmless. Before both, they
+        write the offset of the new head to `generation_remote`, see apply_update().
+
+        With `lock_free`, the head is only moved in `generation_remote`, see advance_head().
+        """
+        if self.lock_free:
+            return divmod(self.get_head(), self.buffer_size)
+        return self.get_lap_and_position(self.update_stream_lap_remote, self.update_stream_position_remote)
+
+    def get_full_dump_stream_position(self):
+        """
+        Get lap and position of the update stream from which on it must not be overwritten
+        because users catching up from the latest full dump still need it.
+
+        Writers update the lap first and the position afterwards, so a torn read can
+        only ever be ahead of the real position, which is harmless.
+        """
+        return self.get_lap_and_position(self.full_dump_stream_lap_remote, self.full_dump_stream_position_remote)
+
+    def is_overrun(self, offset=None):
+        """
+        Check if the update stream could already have been overwritten at `offset`
+        which defaults to our local position.
+
+        Offsets are counted over all laps, ie. `lap * buffer_size + position`.
+        """
+        if offset is None:
+            offset = self.update_stream_lap * self.buffer_size + self.update_stream_position
+        lap, position = self.get_full_dump_stream_position()
+        return lap * self.buffer_size + position > offset
+
+    #@profile
+    def append_update(self, key, item, delete=False, mode=None, check=None):
+        """
+        Append dict changes to shared memory stream and apply them to our local copy
+
+        The stream is a circular buffer. When an update does not fit into the rest of the buffer,
+        a wrap marker is written and the update continues at the start of the buffer in the next lap.
+        A full dump is only created before overwriting parts of the stream that are still needed
+        to catch up from the latest full dump.
+
+        If `check` is given, it is called right before appending, after all updates before have
+        been applied. If it returns False, nothing is appended and False is returned.
+        """
+
+        # If mode is 0, it means delete the key from the dict
+        # If mode is 1, it means update the key
+        # If mode is 2, it means apply a batch of updates, see Batch
+        # If mode is 3, it means apply a chain of operations to the value, see add()
+        if mode is None:
+            mode = int(not delete)
+        marshalled = self.dumps_record(mode, key, item)
+
+        if self.lock_free:
+            return self.append_update_lock_free(mode, key, item, marshalled, check)
+
+        # Str and bytes keys are written only once after each full dump, see KeyTable
+        key_ids = type(key) in self.KeyTable.types and mode != 2 and self.serializer is pickle
+
+        with self.lock:
+            if check is not None and not check():
+                return False
+
+            while True:
+                # The update that goes into the stream, the write-ahead log always gets the whole key
+                record, definition = self.dumps_key_record(mode, key, item) if key_ids else (marshalled, None)
+                length = len(record)
+
+                lap, start_position = self.get_stream_head()
+                # 6 bytes for the header
+                end_lap, end_position = lap, start_position + length + 6
+                #log.debug("Update start from={} len={}", start_position, length)
+                if length + 6 > self.buffer_size:
+                    #log.debug("Update too big for buffer")
+
+                    # todo: is is necessary? apply_update() is also done inside dump()
+                    self.apply_update()
+                    self.apply_record(mode, key, item)
+                    if self.versions:
+                        # The stream continues at the start of the next lap after the full dump
+                        self.set_version(mode, key, item, (self.update_stream_lap + 1) * self.buffer_size)
+                    self.dump(reset_stream=True)
+                    if self.wal:
+                        self.write_wal(marshalled, self.update_stream_lap * self.buffer_size)
+                    return True
+
+                wrap = end_position > self.buffer_size
+                if wrap:
+                    end_lap, end_position = lap + 1, length + 6
+
+                if wrap and end_position > start_position:
+                    # The update would overwrite its own wrap marker, so we need to start
+                    # a fresh lap. After the full dump, the key of the update needs a new id.
+                    self.dump(reset_stream=True)
+                    continue
+
+                # Writing the update overwrites what the stream contained one lap earlier.
+                # If that is still needed to catch up from the latest full dump, we need
+                # a new full dump first.
+                full_dump_lap, full_dump_position = self.get_full_dump_stream_position()
+                full_dump_offset = full_dump_lap * self.buffer_size + full_dump_position
+                if full_dump_offset < lap * self.buffer_size + start_position and \
+                        (end_lap - 1) * self.buffer_size + end_position > full_dump_offset:
+                    #log.debug("Buffer is full")
+                    if self.should_compact():
+                        self.compact()
+                    else:
+                        self.dump()
+                    continue
+                break
+
+            if wrap:
+                # The rest of the stream in this lap is empty, continue at the start of the buffer
+                if start_position < self.buffer_size:
+                    self.buffer.buf[start_position:start_position+1] = b'\xFE'
+                start_position = 0
+
+            if self.wal:
+                self.write_wal(marshalled, end_lap * self.buffer_size + end_position)
+
+            record = b'\xFF' + length.to_bytes(4, 'little') + b'\xFF' + record
+
+            # Write body with the real data
+            self.buffer.buf[start_position:end_position] = record
+
+            # Inform others about it, generation first, then position, then lap, see get_stream_head()
+            self.update_stream_lap = end_lap
+            self.update_stream_position = end_position
+            self.generation_remote[:] = (end_lap * self.buffer_size + end_position).to_bytes(8, 'little')
+            self.update_stream_position_remote[:] = end_position.to_bytes(4, 'little')
+            self.update_stream_lap_remote[:] = end_lap.to_bytes(4, 'little')
+            if self.stream_futex:
+                self.stream_futex.wake(self.Futex.all)
+            #log.debug("Update end to={} buffer_size={} ", end_position, self.buffer_size)
+
+            # We never read our own updates, so we need to remember the id of the key here
+            if definition:
+                self.key_table.define(*definition)
+
+            # Update our local copy
+            self.apply_record(mode, key, item)
+            if self.versions:
+                self.set_version(mode, key, item, end_lap * self.buffer_size + end_position)
+            return True
+
+    def append_update_lock_free(self, mode, key, item, marshalled, check=None):
+        """
+        Append an update without taking the lock, see `lock_free` and append_update().
+
+        Every writer reserves its own range of the update stream, see reserve(), so many writers can
+        write their updates at the same time. A writer marks its update as complete in its header once
+        it is written and then moves the head of the stream over all complete updates, see advance_head().
+        Readers never read beyond the head, so they stop at the first update that is not yet complete.
+        Writers never wait for each other, whoever completes the update before ours moves the head over ours.
+        Our local copy gets our update like everyone else's then, once all updates before it are complete.
+
+        If the head is already at our update, if it has a `check` or if it must go into the `wal`, we wait
+        until all updates before ours are published instead: The check must see them, the log must have the
+        order of the stream, and our local copy gets our update right away, as if we had taken the lock.
+
+        A reserved range that is not completed by its writer because of an exception or because the writer
+        has died, is published as skipped, see abandon_reservation() and recover_head().
+        """
         length = len(marshalled)
+        buffer_size = self.buffer_size
+        buf = self.buffer.buf
+        # Header, update and the footer with our pid, see reserve()
+        size = length + 6 + self.reservation_footer.size
+
+        if size > buffer_size:
+            # Too big for the stream, the update goes into a full dump instead, see append_update()
+            with self.lock:
+                start, end = self.reserve(None)
+                try:
+                    self.wait_for_head(start)
+                    self.apply_update()
+                    appended = check is None or check()
+                    if appended:
+                        self.apply_record(mode, key, item)
+                        if self.versions:
+                            self.set_version(mode, key, item, end)
+                    # The rest of the lap is reserved anyway, so the stream continues after the full dump
+                    self.dump(reset_stream=True, reserved=True)
+                except BaseException:
+                    self.abandon_reservation(start, end)
+                    raise
+                if appended and self.wal:
+                    self.write_wal(marshalled, end)
+                return appended
+
+        while True:
+            reservation = self.reserve(size)
+            if reservation:
+                break
+            # Our update would overwrite updates that are still needed to catch up from the
+            # latest full dump, so we need a new one first
+            self.make_room()
+
+        start, end = reservation
+        completed = False
+        try:
+            # After a wrap marker, the update starts at the beginning of the buffer
+            position = (end - size) % buffer_size
+            buf[position + 6:position + 6 + length] = marshalled
+
+            if check is None and not self.wal and self.get_head() != start:
+                # Until now, the range was marked as skipped, see reserve()
+                buf[position:position + 6] = self.update_header.pack(0xFF, length, 0xFF)
+                completed = True
+                self.advance_head()
+                return True
+
+            self.wait_for_head(start)
+            self.apply_update()
+            if not (check is None or check()):
+                return False
+
+            self.apply_record(mode, key, item)
+            # Versions and offsets in the log are the end of the update, readers never see the footer
+            offset = end - self.reservation_footer.size
+            if self.versions:
+                self.set_version(mode, key, item, offset)
+            if self.wal:
+                # All updates before ours are published, so the log has the order of the stream
+                self.write_wal(marshalled, offset)
+            # Until now, the range was marked as skipped, see reserve()
+            buf[position:position + 6] = self.update_header.pack(0xFF, length, 0xFF)
+            completed = True
+            self.publish(start, end)
+            return True
+        finally:
+            # The updates after ours can only be published after ours
+            if not completed:
+                self.abandon_reservation(start, end)
+
+    def reserve(self, size):
+        """
+        Reserve `size` bytes at the end of the update stream for a lock-free append, see append_update_lock_free().
+
+        The tail of the stream is the offset over all laps up to which the stream is reserved, it is
+        moved with compare-and-swap. With `size=None`, the rest of the current lap is reserved.
+
+        Right afterwards, the reserved range is marked with our pid, so others can publish it if we
+        die, see recover_head(): Until the update is written, it is a skipped update whose last bytes
+        are another skipped update with our pid, see `reservation_footer`. The rest of a lap might not
+        have space for that, so its reservation is marked in the control memory instead. Only a writer
+        that dies between moving the tail and marking its range can't be recovered from.
+
+        Returns the offsets of the start and the end of the reserved range. If it would overwrite
+        updates that are still needed to catch up from the latest full dump, nothing is reserved and
+        None is returned.
+        """
+        buffer_size = self.buffer_size
+        while True:
+            tail = int.from_bytes(self.stream_tail_remote, 'little')
+            lap, start = divmod(tail, buffer_size)
+            if size is None:
+                # Everyone has to load the next full dump, so nothing in the stream is needed anymore
+                end = (lap + 1) * buffer_size
+            else:
+                end = tail + size
+                if start + size > buffer_size:
+                    # The update continues at the start of the buffer in the next lap
+                    end = (lap + 1) * buffer_size + size
+                    if size > start:
+                        # The update would overwrite its own wrap marker, so we leave the rest of the lap empty
+                        filler = self.reserve_filler(tail)
+                        if filler is None:
+                            return None
+                        continue
+
+                # Writing the update overwrites what the stream contained one lap earlier
+                full_dump_lap, full_dump_position = self.get_full_dump_stream_position()
+                full_dump_offset = full_dump_lap * buffer_size + full_dump_position
+                if full_dump_offset < tail and end - buffer_size > full_dump_offset:
+                    return None
+
+            if self.move_tail(tail, end):
+                self.mark_reservation(tail, end, size)
+                return tail, end
+
+    def move_tail(self, tail, end):
+        """ Move the tail of the stream from `tail` to `end` with compare-and-swap, see reserve() """
+        # __ATOMIC_SEQ_CST is 5
+        return atomic_cas_8(self.stream_tail_address, ctypes.byref(ctypes.c_uint64(tail)), end, 5, 5)
+
+    def mark_reservation(self, start, end, size):
+        """ Mark the range of the stream from `start` to `end` as skipped and reserved by us, see reserve() """
+        if size is None:
+            # Pid first, see get_stream_reserver()
+            self.stream_reserver_remote[0:4] = self.lock.pid_bytes
+            self.stream_reserver_remote[4:12] = start.to_bytes(8, 'little')
+            return
+
+        buffer_size = self.buffer_size
+        buf = self.buffer.buf
+        footer = self.reservation_footer
+        position = start % buffer_size
+        record = (end - size) % buffer_size
+        buf[record:record + 6] = self.update_header.pack(0xFD, size - 6, 0xFF)
+        footer.pack_into(buf, record + size - footer.size, 0xFD, footer.size - 6, 0xFF, self.lock.pid, start & 0xFFFFFFFF)
+        if record != position:
+            # The rest of the stream in this lap is empty. Written last, see get_reservation()
+            buf[position] = 0xFE
+
+    def get_stream_reserver(self):
+        """ Get pid and offset of the writer that has reserved the rest of a lap, see reserve() """
+        # Offset first, the pid is written before it
+        start = int.from_bytes(self.stream_reserver_remote[4:12], 'little')
+        return int.from_bytes(self.stream_reserver_remote[0:4], 'little'), start
+
+    def get_reservation(self, offset):
+        """
+        Get the pid of the writer, the end of the range of the stream that is reserved at `offset` and
+        if the range is complete, see reserve(). The pid is 0 if the writer has given up. A range is complete
+        once its update is written or its writer has given up, the rest of a lap only once its wrap marker
+        is written as well. Returns None if the range is not marked.
+        """
+        buffer_size = self.buffer_size
+        buf = self.buffer.buf
+        lap, position = divmod(offset, buffer_size)
+        pid, start = self.get_stream_reserver()
+        # Both are 0 before the first reservation of the rest of a lap
+        if start == offset and (pid or start):
+            return pid, (lap + 1) * buffer_size, not pid and buf[position] == 0xFE
+        if buf[position] == 0xFE:
+            # The update continues at the start of the buffer in the next lap
+            lap, position = lap + 1, 0
+        elif position + 6 > buffer_size:
+            return None
+
+        footer = self.reservation_footer
+        marker, length, _ = self.update_header.unpack_from(buf, position)
+        if marker == 0xFF:
+            # The update is written, the footer comes after it
+            length += footer.size
+        elif marker != 0xFD:
+            return None
+        stop = position + 6 + length
+        if length < footer.size or stop > buffer_size:
+            return None
+
+        skipped, footer_length, end_marker, pid, start = footer.unpack_from(buf, stop - footer.size)
+        if (skipped, footer_length, end_marker, start) != (0xFD, footer.size - 6, 0xFF, offset & 0xFFFFFFFF):
+            return None
+        return pid, lap * buffer_size + stop, marker == 0xFF or not pid
+
+    def abandon_reservation(self, start, end):
+        """
+        Give up the reservation of the stream from `start` to `end` without an update. If all updates
+        before are published, it's published as skipped right away, otherwise it's complete as a skipped
+        update, see get_reservation(). Only the rest of a lap needs its wrap marker first, see recover_head().
+        """
+        buffer_size = self.buffer_size
+        if self.get_head() == start:
+            self.skip_reservation(start, end)
+            self.publish(start, end)
+            return
+        if self.get_stream_reserver()[1] == start:
+            self.stream_reserver_remote[0:4] = bytes(4)
+        else:
+            # The pid in the footer becomes 0
+            position = (end - self.reservation_footer.size) % buffer_size + 6
+            self.buffer.buf[position:position + 4] = bytes(4)
+        # The head might have reached us meanwhile
+        self.advance_head()
+
+    def recover_head(self, head):
+        """
+        Publish the reserved range at the offset `head` of the stream as skipped if it is not complete
+        and its writer has died or given up, see reserve(). Returns True if it was published.
+        """
+        reservation = self.get_reservation(head)
+        if reservation is None or reservation[2] or (reservation[0] and not self.SharedLock.is_dead(reservation[0])):
+            return False
+
+        # Only one of the waiting writers may publish it. If the writer has died while holding
+        # the lock for a full dump, someone has to steal the lock first, see SharedLock.steal_from_dead()
+        try:
+            self.lock.acquire(block=False)
+        except Exceptions.CannotAcquireLock:
+            return False
+        try:
+            if self.get_head() != head or self.get_reservation(head) != reservation:
+                return False
+            log.warning(f"Publishing the update at stream offset {head} as skipped because its writer pid={reservation[0]} has died or given up")
+            self.skip_reservation(head, reservation[1])
+            self.publish(head, reservation[1])
+            return True
+        finally:
+            self.lock.release()
+
+    def skip_reservation(self, start, end):
+        """
+        Mark the range of the stream from `start` to `end` as skipped, once all updates before are
+        published, see recover_head(). Skipping the rest of a lap might need a full dump first.
+        """
+        buffer_size = self.buffer_size
+        buf = self.buffer.buf
+        lap, position = divmod(start, buffer_size)
+        if end >= (lap + 1) * buffer_size:
+            if buf[position] != 0xFE and not self.is_overrun(start - buffer_size):
+                # The wrap marker would overwrite the stream that is still needed to catch up from the
+                # latest full dump. Only the rest of a lap reserved with the lock for a full dump can be
+                # that far ahead, see reserve_filler() for the others.
+                self.dump()
+            # The stream continues at the start of the buffer
+            buf[position] = 0xFE
+            lap, position = lap + 1, 0
+        if end > lap * buffer_size + position:
+            buf[position:position + 6] = self.update_header.pack(0xFD, end - lap * buffer_size - position - 6, 0xFF)
+
+    def reserve_filler(self, tail):
+        """ Leave the rest of the lap after `tail` empty, see reserve() """
+        buffer_size = self.buffer_size
+        lap, start = divmod(tail, buffer_size)
+        end = (lap + 1) * buffer_size
+
+        # Only the wrap marker overwrites the stream
+        full_dump_lap, full_dump_position = self.get_full_dump_stream_position()
+        full_dump_offset = full_dump_lap * buffer_size + full_dump_position
+        if full_dump_offset < tail and tail + 1 - buffer_size > full_dump_offset:
+            return None
+
+        if not self.move_tail(tail, end):
+            # Someone else was faster, try again
+            return False
+
+        self.mark_reservation(tail, end, None)
+        self.buffer.buf[start] = 0xFE
+        # With its wrap marker, the rest of the lap is complete as if we had given up, see get_reservation()
+        self.stream_reserver_remote[0:4] = bytes(4)
+        self.advance_head()
+        return True
+
+    def make_room(self):
+        """
+        Create a full dump or a compaction, so lock-free appends can overwrite the stream up to its head.
+        If that does not help, wait for the updates after the head to be published.
+        """
+        buffer_size = self.buffer_size
+        with self.lock:
+            self.apply_update()
+            lap, position = self.update_stream_lap, self.update_stream_position
+            full_dump_lap, full_dump_position = self.get_full_dump_stream_position()
+            if full_dump_lap * buffer_size + full_dump_position < lap * buffer_size + position:
+                if self.should_compact():
+                    self.compact()
+                else:
+                    self.dump()
+                return
+
+        # Most of the stream is reserved by updates that are not published yet
+        def blocked():
+            head_lap, head_position = self.get_stream_head()
+            return head_lap == lap and head_position == position
+
+        self.wait_for_writers(blocked)
+
+    def wait_for_head(self, offset):
+        """ Wait until all updates before `offset` in the stream are published, see append_update_lock_free() """
+        buffer_size = self.buffer_size
+        def blocked():
+            lap, position = self.get_stream_head()
+            return lap * buffer_size + position != offset
+
+        self.wait_for_writers(blocked)
+
+    def wait_for_writers(self, blocked, sleep_time=0.000001):
+        """
+        Wait until the writers of the reserved updates have published them, so `blocked()` is false.
+        If the head of the stream stands still for `dead_writer_timeout` seconds, the writer of the
+        next update might have died, see recover_head().
+
+        We sleep on the stream futex like the shared lock on its futex, see SharedLock.wait(). Without
+        a futex, we poll every `sleep_time` seconds, which doubles up to `SharedLock.futex_timeout`.
+        """
+        head = since = None
+        while blocked():
+            now = time.monotonic()
+            if head != self.get_head():
+                head, since = self.get_head(), now
+            elif now - since > self.dead_writer_timeout:
+                self.recover_head(head)
+                since = now
+            self.lock.wait(sleep_time, futex=self.stream_futex, blocked=blocked)
+            if not self.stream_futex:
+                sleep_time = min(sleep_time * 2, self.SharedLock.futex_timeout)
+
+    def get_head(self):
+        """ Get the offset over all laps of the head of the stream, see advance_head() """
+        while True:
+            head = int.from_bytes(self.generation_remote, 'little')
+            if head == int.from_bytes(self.generation_remote, 'little'):
+                return head
+
+    def move_head(self, head, end):
+        """ Move the head of the stream from `head` to `end` with compare-and-swap, returns the head afterwards """
+        expected = ctypes.c_uint64(head)
+        # __ATOMIC_SEQ_CST is 5, on failure `expected` gets the current head
+        if atomic_cas_8(self.generation_address, ctypes.byref(expected), end, 5, 5):
+            return end
+        return expected.value
+
+    def advance_head(self, head=None):
+        """
+        Move the head of the stream over all complete updates after it, see append_update_lock_free().
+        Everyone who completes an update calls this afterwards, so the head never stands still at a
+        complete update: Reading the head with compare-and-swap orders it after completing our update,
+        so whoever moves the head to our update either sees it complete or we see the head there.
+
+        If the head stands still at the same update for `dead_writer_timeout` seconds whenever we get
+        here, its writer might have died, see recover_head().
+        """
+        if head is None:
+            head = self.get_head()
+            head = self.move_head(head, head)
+        start = head
+        while head != int.from_bytes(self.stream_tail_remote, 'little'):
+            reservation = self.get_reservation(head)
+            if reservation is None or not reservation[2]:
+                stalled, since = self.stalled_head
+                now = time.monotonic()
+                if stalled != head:
+                    self.stalled_head = (head, now)
+                elif now - since > self.dead_writer_timeout:
+                    self.stalled_head = (head, now)
+                    self.recover_head(head)
+                break
+            # Someone else might have been faster, then we go on from where the head is now
+            head = self.move_head(head, reservation[1])
+        if head != start and self.stream_futex:
+            self.stream_futex.wake(self.Futex.all)
+
+    def publish(self, start, end):
+        """
+        Move the head of the stream from the offset `start` to `end` and on over the complete updates
+        after it, see advance_head(). If our local copy is at `start`, it is assumed to contain the update as well.
+        """
+        buffer_size = self.buffer_size
+        if self.update_stream_lap * buffer_size + self.update_stream_position == start:
+            self.update_stream_lap, self.update_stream_position = divmod(end, buffer_size)
+        # If our update is complete, others might already have moved the head over it
+        head = self.move_head(start, end)
+        if self.stream_futex:
+            self.stream_futex.wake(self.Futex.all)
+        self.advance_head(head)
+
+    def set_version(self, mode, key, value, version):
+        """ Remember the stream offset `version` of an update as the version of all keys it changes """
+        key_versions = self.key_versions
+        if mode == 2:
+            for mode, key, _ in value:
+                if mode:
+                    key_versions[key] = version
+                else:
+                    key_versions.pop(key, None)
+        elif mode:
+            key_versions[key] = version
+        else:
+            key_versions.pop(key, None)
+
+    def apply_record(self, mode, key, value, notify=True):
+        """ Apply a single update from the stream to our local copy """
+        if notify and self.listeners:
+            self.apply_record_and_notify(mode, key, value)
+        elif mode == 1:
+            self.data.__setitem__(key, value)
+        elif mode == 0:
+            self.data.__delitem__(key)
+        elif mode == 2:
+            # Batches are applied as a whole, the keys of deletes might not exist anymore
+            data = self.data
+            for mode, key, value in value:
+                if mode == 1:
+                    data.__setitem__(key, value)
+                elif mode == 0:
+                    data.pop(key, None)
+                else:
+                    self.apply_operations(key, value)
+        elif mode == 3:
+            self.apply_operations(key, value)
+
+    def apply_record_and_notify(self, mode, key, value):
+        """
+        Apply a single update like apply_record() and call all listeners with
+        `(op, key, old, new)` for each changed key, `op` is either 'set' or 'delete'.
+        """
+        if mode == 2:
+            for record in value:
+                self.apply_record_and_notify(*record)
+            return
+
+        data = self.data
+        exists = key in data
+        old = data[key] if exists else None
+        if old is self.lazy_value:
+            old = self.load_lazy_value(key)
+
+        if mode == 1:
+            data[key] = value
+        elif mode == 0:
+            # Deletes in batches, the key might not exist anymore
+            if not exists:
+                return
+            del data[key]
+        else:
+            self.apply_operations(key, value)
+
+        op, new = ('set', data[key]) if mode else ('delete', None)
+        for listener in self.listeners:
+            listener(op, key, old, new)
+
+    def apply_operations(self, key, operations):
+        """ Apply a chain of operations like add() to the value of `key` in our local copy """
+        data = self.data
+        exists = key in data
+        value = data[key] if exists else None
+        if value is self.lazy_value:
+            value = self.load_lazy_value(key)
+        data[key] = self.run_operations(value, operations, exists)
+
+    @classmethod
+    def run_operations(cls, value, operations, exists=True):
+        """ Apply a chain of operations to `value`, if it does not exist, the first operand is the result """
+        for operation, operand in operations:
+            value = cls.operations[operation](value, operand) if exists else operand
+            exists = True
+        return value
+
+    @staticmethod
+    def chain_operations(first, second):
+        """ Chain two chains of operations, folding neighbours of the same kind """
+        chain = list(first)
+        for operation, operand in second:
+            if chain and chain[-1][0] == operation:
+                chain[-1] = (operation, UltraDict.operations[operation](chain[-1][1], operand))
+            else:
+                chain.append((operation, operand))
+        return tuple(chain)
+
+    def dumps_record(self, mode, key, item):
+        """ Serialize an update for the stream, compact if possible, see RecordCodec """
+        if self.serializer is pickle and mode < 2:
+            # The value of deletes is not used
+            if not mode:
+                item = None
+            encoder = self.record_codec.encoders.get((type(key), type(item)))
+            if encoder is not None:
+                try:
+                    return encoder(mode, key, item)
+                except struct.error:
+                    # Int with more than 8 bytes
+                    pass
+        return self.serializer.dumps((mode, key, item))
+
+    def dumps_key_record(self, mode, key, item):
+        """
+        Serialize an update for the stream that refers to its key by id, see KeyTable. Needs the lock
+        and all updates applied.
+
+        Returns the update and, if it defines the id of the key, the arguments for KeyTable.define().
+        """
+        full_dump_lap, full_dump_position = self.get_full_dump_stream_position()
+        epoch = full_dump_lap * self.buffer_size + full_dump_position
+        if not mode:
+            # The value of deletes is not used
+            item = None
+        key_id = self.key_table.lookup(epoch, key)
+        if key_id is not None:
+            return self.record_codec.dumps_reference(mode, key_id, item), None
+        key_id = self.key_table.next_id(epoch)
+        return self.record_codec.dumps_definition(mode, key_id, epoch, key, item), (epoch, key_id, key)
+
+    def loads_record(self, view):
+        """ Unserialize an update of the stream, see dumps_record() """
+        if self.serializer is pickle:
+            return self.record_codec.decoders[view[0]](view)
+        return self.loads(view)
+
+    def read_updates(self, lap, pos, end, offsets=None, key_table=None):
+        """
+        Read and unserialize all updates from the stream starting at `lap` and `pos`
+        up to the offset `end` without applying them.
+
+        If `offsets` is a list, the stream offset at the end of each update is appended.
+        Keys with ids are looked up in and added to `key_table`, by default our own, see KeyTable.
+
+        First, all headers are scanned in one pass, then all updates are unserialized
+        in one go.
+
+        Returns the list of updates and the lap and position after the last update.
+        """
+        buffer_size = self.buffer_size
+        buf = self.buffer.buf
+        unpack_from = self.update_header.unpack_from
+        # Offset of the start of the current lap
+        offset = lap * buffer_size
+        spans = []
+
+        while offset + pos < end:
+            # Updates need at least 6 bytes, so they never start in the last 5 bytes of the buffer
+            limit = min(end - offset, buffer_size - 5)
+            # Iterate over all headers in this lap until the start of the last update
+            while pos < limit:
+                # Read header, 6 bytes
+                # FF byte, 4 bytes of length, then another FF byte
+                marker, length, end_marker = unpack_from(buf, pos)
+                if marker == 0xFD:
+                    # Skipped update, see append_update_lock_free()
+                    pos += length + 6
+                    continue
+                if marker != 0xFF:
+                    # A wrap marker means the stream continues at the start of the buffer
+                    assert marker == 0xFE
+                    break
+                assert end_marker == 0xFF
+                pos += 6
+                #log.debug("Found update, update_stream_position={} length={}", self.update_stream_position, length + 6)
+                spans.append((pos, pos + length))
+                pos += length
+                if offsets is not None:
+                    offsets.append(offset + pos)
+            else:
+                if offset + pos >= end:
+                    break
+            # The stream continues at the start of the buffer in the next lap
+            lap += 1
+            offset += buffer_size
+            pos = 0
+
+        # Unserialize the update data, we expect tuples of mode, key and value
+        if self.serializer is pickle:
+            # Compact updates or pickles, see RecordCodec
+            decoders = (key_table or self.key_table).decoders
+            updates = [ decoders[buf[start]](buf[start:stop]) for start, stop in spans ]
+        else:
+            loads = self.loads
+            updates = [ loads(buf[start:stop]) for start, stop in spans ]
+
+        return updates, lap, pos
+
+    #@profile
+    def apply_update(self):
+        """
+        Opportunistically apply dict changes from shared memory stream without any locking.
+
+        Returns the number of updates applied, a full dump that had to be loaded counts as one.
+        """
+
+        # Nothing has changed since our last update, see generation_remote. Full dumps and
+        # compactions are only relevant for us if the head of the stream has moved as well.
+        if int.from_bytes(self.generation_remote, 'little') == self.generation:
+            return 0
+
+        count = 0
+        full_dump_counter = int.from_bytes(self.full_dump_counter_remote, 'little')
+        if self.full_dump_counter < full_dump_counter:
+            # We only need to load the new full dump if the stream might have
+            # already been overwritten at our position
+            if self.is_overrun():
+                self.load(force=True)
+                count = 1
+            else:
+                self.full_dump_counter = full_dump_counter
+
+        lap, position = self.get_stream_head()
+
+        if self.update_stream_position != position or self.update_stream_lap != lap:
+
+            buffer_size = self.buffer_size
+            start = self.update_stream_lap * buffer_size + self.update_stream_position
+            end = lap * buffer_size + position
+
+            # Torn read while the stream has wrapped around, there's nothing new for us yet
+            if end <= start:
+                return count
+
+            # Remember start position in the update stream
+            lap, pos = self.update_stream_lap, self.update_stream_position
+            updates = []
+            offsets = [] if self.versions else None
+            #log.debug("Apply update: stream position own={} remote={} full_dump_counter={}", pos, int.from_bytes(self.update_stream_position_remote, 'little'), self.full_dump_counter)
+
+            try:
+                updates, lap, pos = self.read_updates(lap, pos, end, offsets)
+
+            # Reading garbage could raise any kind of exception in the serializer
+            except Exception as e: # pylint: disable=broad-except
+
+                # It can happen that a slow process is not fast enough reading the stream and some
+                # other process already got around overwriting the current position. It is possible to
+                # recover from this situation if and only if a new, fresh full dump exists that can be loaded.
+                if not self.is_overrun(start):
+                    # With `lock_free`, the stream up to the head is never overwritten before a new full dump,
+                    # see reserve(), and writers waiting for the head must never block on the lock
+                    if self.lock_free:
+                        raise e
+                    # As a last resort, let's get a lock. This way we are safe but slow.
+                    with self.lock.read():
+                        if not self.is_overrun(start):
+                            raise e
+
+            # Only after reading all updates we can be sure nobody has overwritten them meanwhile
+            if self.is_overrun(start):
+                log.warning(f"Update stream overrun full_dump_counter={self.full_dump_counter} full_dump_counter_remote={int.from_bytes(self.full_dump_counter_remote, 'little')}. Consider increasing buffer_size.")
+                self.load(force=True)
+                return self.apply_update() + 1
+
+            # Update or local dict cache (in our parent)
+            if self.versions:
+                for (mode, key, value), offset in zip(updates, offsets):
+                    self.apply_record(mode, key, value)
+                    self.set_version(mode, key, value, offset)
+            elif self.listeners:
+                for mode, key, value in updates:
+                    self.apply_record(mode, key, value)
+            else:
+                setitem = self.data.__setitem__
+                delitem = self.data.__delitem__
+                for mode, key, value in updates:
+                    if mode == 1:
+                        setitem(key, value)
+                    elif mode == 0:
+                        delitem(key)
+                    else:
+                        self.apply_record(mode, key, value)
+
+            # Remember that we have applied the updates
+            self.update_stream_lap = lap
+            self.update_stream_position = pos
+            count += len(updates)
+
+        self.generation = self.update_stream_lap * self.buffer_size + self.update_stream_position
+        return count
+
+    def wait_for_update(self, timeout=None, sleep_time=0.001):
+        """
+        Sleep until others have changed the dict, then apply their changes like apply_update().
+
+        On Linux, this sleeps on a futex until a writer wakes it up, otherwise the stream is
+        polled every `sleep_time` seconds. Full dumps and compactions without new updates
+        don't end the wait.
+
+        Returns the number of new updates, a full dump that had to be loaded counts as one,
+        or 0 if nothing has changed within `timeout` seconds.
+        """
+        if timeout is not None:
+            time_end = time.monotonic() + timeout
+
+        while True:
+            count = self.apply_update()
+            if count:
+                return count
+
+            if timeout is not None:
+                timeout = time_end - time.monotonic()
+                if timeout <= 0:
+                    return 0
+
+            self.wait_for_change(self.update_stream_lap, self.update_stream_position, timeout, sleep_time)
+
+    def wait_for_change(self, lap, position, timeout=None, sleep_time=0.001):
+        """
+        Sleep until the head of the update stream has moved away from `lap` and `position`,
+        see wait_for_update(). Only reads the control memory, so it can be called from any thread.
+
+        Returns False if the head has not moved within `timeout` seconds.
+        """
+        if timeout is not None:
+            time_end = time.monotonic() + timeout
+
+        def blocked():
+            return self.get_stream_head() == (lap, position)
+
+        while blocked():
+            wait = 1.0
+            if timeout is not None:
+                wait = min(time_end - time.monotonic(), wait)
+                if wait <= 0:
+                    return False
+
+            if self.stream_futex:
+                # Also limited because writers without the futex don't wake us up
+                self.stream_futex.wait(blocked, wait)
+            else:
+                time.sleep(min(wait, sleep_time))
+
+        return True
 
-        with self.lock:
-            start_position = int.from_bytes(self.update_stream_position_remote, 'little')
-            # 6 bytes for the header
-            end_position = start_position + length + 6
-            #log.debug("Update start from={} len={}", start_position, length)
-            if end_position > self.buffer_size:
-                #log.debug("Buffer is full")
-
-                # todo: is is necessary? apply_update() is also done inside dump()
-                self.apply_update()
-                if not delete:
-                    self.data.__setitem__(key, item)
-                self.dump()
-                return
+    def cursor(self):
+        """
+        Get the position up to which our local copy contains all changes as
+        `(full_dump_counter, offset)`, see changes_since(). Cursors only ever grow.
+        """
+        self.apply_update()
+        return self.full_dump_counter, self.update_stream_lap * self.buffer_size + self.update_stream_position
 
-            marshalled = b'\xFF' + length.to_bytes(4, 'little') + b'\xFF' + marshalled
+    def changes_since(self, cursor):
+        """
+        Get the keys that have changed since `cursor`, see cursor(). The changes are read from
+        the update stream, so this only takes time proportional to the number of changes.
 
-            # Write body with the real data
-            self.buffer.buf[start_position:end_position] = marshalled
+        Returns the set of keys and the current cursor. If the changes are not available anymore
+        because a full dump or a compaction has been created after `cursor`, None is returned instead
+        of the keys and everything has to be read again. The bigger the `buffer_size`, the longer
+        cursors stay usable.
+        """
+        full_dump_counter, offset = cursor
+        current = self.cursor()
+        end = current[1]
 
-            # Inform others about it
-            self.update_stream_position = end_position
-            self.update_stream_position_remote[:] = end_position.to_bytes(4, 'little')
-            #log.debug("Update end to={} buffer_size={} ", end_position, self.buffer_size)
+        if full_dump_counter > current[0] or offset > end or self.is_overrun(offset):
+            return None, current
 
-    #@profile
-    def apply_update(self):
-        """ Opportunistically apply dict changes from shared memory stream without any locking.  """
+        try:
+            # Our key table knows all ids up to `end`, but reading older updates must not change it
+            updates, _, _ = self.read_updates(*divmod(offset, self.buffer_size), end, key_table=self.key_table.copy(self.record_codec))
+        # Reading garbage could raise any kind of exception in the serializer, see apply_update()
+        except Exception: # pylint: disable=broad-except
+            if not self.is_overrun(offset):
+                raise
+        # Only after reading all updates we can be sure nobody has overwritten them meanwhile
+        if self.is_overrun(offset):
+            return None, current
+
+        keys = set()
+        for mode, key, value in updates:
+            if mode == 2:
+                keys.update(key for _, key, _ in value)
+            else:
+                keys.add(key)
+        return keys, current
 
-        if self.full_dump_counter < int.from_bytes(self.full_dump_counter_remote, 'little'):
-            self.load(force=True)
+    def on_change(self, fn, keys=None, prefix=None):
+        """
+        Call `fn(key, old, new)` for each change of the dict while updates are applied to our local copy,
+        including our own changes. Keys that have been deleted get `new=None`, new keys get `old=None`.
 
-        if self.update_stream_position < int.from_bytes(self.update_stream_position_remote, 'little'):
+        With `keys`, only changes of these keys are reported, with `prefix`, only changes of string keys
+        starting with it. If our local copy had to be replaced by a full dump, it is compared with the old
+        one to report all changes, which takes time proportional to the size of the dict. In lazy mode,
+        values that have never been accessed are compared in their serialized form and only loaded
+        if they have changed and match `keys` and `prefix`.
 
-            # Remember start position in the update stream
-            pos = self.update_stream_position
-            #log.debug("Apply update: stream position own={} remote={} full_dump_counter={}", pos, int.from_bytes(self.update_stream_position_remote, 'little'), self.full_dump_counter)
+        Exceptions raised by `fn` are logged, they must not interrupt applying updates.
+        Returns `fn`, see off_change().
+        """
+        if keys is not None:
+            keys = set(keys)
 
+        def matches(key):
+            return (keys is None or key in keys) and (prefix is None or isinstance(key, str) and key.startswith(prefix))
+
+        def call(key, old, new):
             try:
-                # Iterate over all updates until the start of the last update
-                while pos < int.from_bytes(self.update_stream_position_remote, 'little'):
-                    # Read header
-                    # The first byte should be a FF byte to introduce the headerfull_dump_counter_remote
-                    assert bytes(self.buffer.buf[pos:pos+1]) == b'\xFF'
-                    pos += 1
-                    # Then comes 4 bytes of length
-                    length = int.from_bytes(bytes(self.buffer.buf[pos:pos+4]), 'little')
-                    pos += 4
-                    #log.debug("Found update, update_stream_position={} length={}", self.update_stream_position, length + 6)
-                    assert bytes(self.buffer.buf[pos:pos+1]) == b'\xFF'
-                    pos += 1
-                    # Unserialize the update data, we expect a tuple of key and value
-                    mode, key, value = self.serializer.loads(bytes(self.buffer.buf[pos:pos+length]))
-                    # Update or local dict cache (in our parent)
-                    if mode:
-                        self.data.__setitem__(key, value)
-                    else:
-                        self.data.__delitem__(key)
-                    pos += length
-                    # Remember that we have applied the update
-                    self.update_stream_position = pos
-            except (AssertionError, pickle.UnpicklingError) as e:
+                fn(key, old, new)
+            except Exception as e: # pylint: disable=broad-except
+                log.error(f"Exception in on_change() callback for key={key!r}: {e!r}")
+
+        def listener(op, key, old, new):
+            if op != 'resync':
+                if matches(key):
+                    call(key, old, new)
+                return
+            # For a resync, `key` is the lazy full dump the old local copy was loaded from, if any
+            old_lazy_dump, data, missing, lazy_value = key, self.data, object(), self.lazy_value
+            for key in (keys if keys is not None else old.keys() | new.keys()):
+                if not matches(key):
+                    continue
+                old_value, new_value = old.get(key, missing), new.get(key, missing)
+                if old_value is new_value and old_value is not lazy_value:
+                    continue
+                if old_value is lazy_value and new_value is lazy_value:
+                    # Unchanged values need not be loaded at all
+                    if self.get_lazy_chunk(key, old_lazy_dump) == self.get_lazy_chunk(key):
+                        continue
+                if old_value is lazy_value:
+                    old_value = self.load_lazy_value(key, old_lazy_dump)
+                if new_value is lazy_value:
+                    new_value = data[key] = self.load_lazy_value(key)
+                if old_value == new_value:
+                    continue
+                call(key, None if old_value is missing else old_value, None if new_value is missing else new_value)
+
+        listener.fn = fn
+        self.listeners.append(listener)
+        return fn
+
+    def off_change(self, fn):
+        """ Stop calling `fn` for changes of the dict, see on_change() """
+        self.listeners = [ listener for listener in self.listeners if getattr(listener, 'fn', None) is not fn ]
+
+    async def watch(self, sleep_time=0.001):
+        """
+        Asynchronously iterate over all changes of the dict from now on, including our own,
+        e.g. `async for op, key, value in ultra.watch()`. `op` is either 'set' or 'delete'.
 
-                # It can happen that a slow process is not fast enough reading the stream and some
-                # other process already got around overwriting the current position. It is possible to
-                # recover from this situation if and only if a new, fresh full dump exists that can be loaded.
-                if self.full_dump_counter < int.from_bytes(self.full_dump_counter_remote, 'little'):
-                    log.warning(f"Full dumps too fast full_dump_counter={self.full_dump_counter} full_dump_counter_remote={int.from_bytes(self.full_dump_counter_remote, 'little')}. Consider increasing buffer_size.")
-                    return self.apply_update()
+        If we have fallen behind so far that our local copy had to be replaced by a full dump,
+        `('resync', None, None)` is yielded instead of the single changes.
+
+        The event loop is never blocked, waiting for new updates and reading full dumps happens in
+        its default executor, see wait_for_change() and read_full_dump(). The updates are applied to
+        our local copy in the thread of the event loop, so other coroutines can keep using the dict.
+        """
+        loop = asyncio.get_running_loop()
+        changes = collections.deque()
 
-                # As a last resort, let's get a lock. This way we are safe but slow.
-                with self.lock:
-                    if self.full_dump_counter < int.from_bytes(self.full_dump_counter_remote, 'little'):
-                        log.warning(f"Full dumps too fast full_dump_counter={self.full_dump_counter} full_dump_counter_remote={int.from_bytes(self.full_dump_counter_remote, 'little')}. Consider increasing buffer_size.")
-                        return self.apply_update()
+        def listener(op, key, old, new):
+            changes.append(('resync', None, None) if op == 'resync' else (op, key, new))
 
-                raise e
+        self.listeners.append(listener)
+        try:
+            while True:
+                if self.full_dump_counter < int.from_bytes(self.full_dump_counter_remote, 'little') and self.is_overrun():
+                    full_dump = await loop.run_in_executor(None, self.read_full_dump)
+                    # Unless our local copy has already got further meanwhile
+                    lap, position = full_dump[2:4]
+                    if lap * self.buffer_size + position > self.update_stream_lap * self.buffer_size + self.update_stream_position:
+                        self.install_full_dump(full_dump)
+                self.apply_update()
+                while changes:
+                    yield changes.popleft()
+
+                # Limited, so the executor is not blocked for long after the iteration has ended
+                await loop.run_in_executor(None, self.wait_for_change,
+                    self.update_stream_lap, self.update_stream_position, 1.0, sleep_time)
+        finally:
+            self.listeners.remove(listener)
 
     def update(self, other=None, *args, **kwargs):
         # pylint: disable=arguments-differ, keyword-arg-before-vararg
@@ -810,76 +3659,225 @@ class UltraDict(collections.UserDict, dict):
         # The original signature would be `def update(self, other=None, /, **kwargs)` but
         # this is not possible with Cython. *args will just be ignored.
 
-        if other is not None:
-            for k, v in other.items() if isinstance(other, collections.abc.Mapping) else other:
-                self[k] = v
-        for k, v in kwargs.items():
-            self[k] = v
+        # All items are streamed as one single batch
+        with self.batch() as batch:
+            batch.update(other, **kwargs)
+
+    def add(self, key, value):
+        """
+        Add `value` to the value of `key` and return the result, if `key` does not exist, it is set to `value`.
+
+        Only the operation is streamed, not the new value. Other users apply it to their local copy.
+        """
+        return self.apply_operation('add', key, value)
+
+    def incr(self, key, delta=1):
+        """ Increment the counter `key` by `delta` and return the result, see add() """
+        return self.apply_operation('add', key, delta)
+
+    def max(self, key, value):
+        """ Set `key` to the maximum of its value and `value` and return the result, see add() """
+        return self.apply_operation('max', key, value)
+
+    def min(self, key, value):
+        """ Set `key` to the minimum of its value and `value` and return the result, see add() """
+        return self.apply_operation('min', key, value)
+
+    def apply_operation(self, operation, key, operand):
+        operations = ((operation, operand),)
+
+        def check():
+            # Make sure the operation works before we stream it, otherwise it would fail for everyone
+            exists = key in self.data
+            self.run_operations(self[key] if exists else None, operations, exists)
+            return True
+
+        if self.lock_free:
+            # Also updates our local copy, checks the operation in the order of the stream
+            self.append_update(key, operations, mode=3, check=check)
+            return self.data[key]
 
-    def __delitem__(self, key):
-        #log.debug("__delitem__ {}", key)
         with self.lock:
             self.apply_update()
 
-            # Update our local copy
-            self.data.__delitem__(key)
+            # Also updates our local copy
+            self.append_update(key, operations, mode=3, check=check)
 
-            self.append_update(key, b'', delete=True)
-            # TODO: Do something if append_update() fails
+            return self.data[key]
+
+    def get_with_version(self, key, default=None):
+        """
+        Get the value of `key` and its version, a number that grows with each change of the key.
+        If `key` does not exist, `default` and version 0 are returned.
+        """
+        self.assert_versions()
+        self.apply_update()
+        if key not in self.data:
+            return default, 0
+        return self[key], self.key_versions.get(key, 0)
+
+    def cas(self, key, expected_version, value):
+        """
+        Compare and swap: Set `key` to `value` only if its version is still `expected_version`,
+        use 0 to only set `key` if it does not exist, see get_with_version().
+
+        Returns if `key` was set.
+        """
+        self.assert_versions()
+
+        def check():
+            version = self.key_versions.get(key, 0) if key in self.data else 0
+            return version == expected_version
+
+        if self.lock_free:
+            # Checks the version in the order of the stream
+            return self.append_update(key, self.prepare_item(value), check=check)
 
-    def __setitem__(self, key, item):
-        #log.debug("__setitem__ {}, {}", key, item)
         with self.lock:
             self.apply_update()
+            if not check():
+                return False
+            return self.append_update(key, self.prepare_item(value), check=check)
 
-            if self.recurse:
+    def assert_versions(self):
+        if not self.versions:
+            raise Exception("Versions are not available, use versions=True")
 
-                assert type(self.recurse_register) == UltraDict, "recurse_register must be an UltraDict instance"
+    def batch(self):
+        """
+        Collect many changes and stream them as one single update when leaving the context,
+        e.g. `with ultra.batch() as batch: batch['a'] = 1`
+        """
+        return self.Batch(self)
 
-                if type(item) == dict:
-                    # TODO: Use parent's buffer with a namespace prefix?
-                    item = UltraDict(item,
-                                     recurse          = True,
-                                     recurse_register = self.recurse_register,
-                                     auto_unlink      = False,
-                                     shared_lock      = self.shared_lock,
-                                     buffer_size      = self.buffer_size,
-                                     full_dump_size   = self.full_dump_size)
+    def __delitem__(self, key):
+        #log.debug("__delitem__ {}", key)
 
-                    if item.name not in self.recurse_register.data:
-                        self.recurse_register[item.name] = True
+        # Make sure the key exists before we stream its deletion
+        def check():
+            return key in self.data
 
-            # Update our local copy
-            # It's important for the integrity to do this first
-            self.data.__setitem__(key, item)
+        if self.lock_free:
+            # Also updates our local copy, checks the key in the order of the stream
+            appended = self.append_update(key, b'', delete=True, check=check)
+        else:
+            with self.lock:
+                self.apply_update()
+
+                # Also updates our local copy
+                appended = self.append_update(key, b'', delete=True, check=check)
+
+        if not appended:
+            raise KeyError(key)
+
+    def __setitem__(self, key, item):
+        #log.debug("__setitem__ {}, {}", key, item)
+        if self.lock_free:
+            # Plain sets need no lock, see append_update_lock_free()
+            self.append_update(key, self.prepare_item(item))
+            return
+
+        with self.lock:
+            self.apply_update()
+
+            item = self.prepare_item(item)
 
-            # Append the update to the update stream
+            # Append the update to the update stream, also updates our local copy
             self.append_update(key, item)
             # TODO: Do something if append_u int.from_bytes(self.update_stream_position_remote, 'little')pdate() fails
 
+    def prepare_item(self, item):
+        """ In recurse mode, wrap nested dicts in an UltraDict before storing them """
+        if self.recurse:
+
+            assert type(self.recurse_register) == UltraDict, "recurse_register must be an UltraDict instance"
+
+            if type(item) == dict:
+                # TODO: Use parent's buffer with a namespace prefix?
+                item = UltraDict(item,
+                                 # With path, the name would otherwise be the one of the directory
+                                 name             = f'psm_{secrets.token_hex(4)}' if self.path else None,
+                                 path             = self.path,
+                                 recurse          = True,
+                                 recurse_register = self.recurse_register,
+                                 auto_unlink      = False,
+                                 shared_lock      = self.shared_lock,
+                                 buffer_size      = self.buffer_size,
+                                 full_dump_size   = self.full_dump_size)
+
+                if item.name not in self.recurse_register.data:
+                    self.recurse_register[item.name] = True
+
+        return item
+
     def __getitem__(self, key):
         #log.debug("__getitem__ {}", key)
-        self.apply_update()
-        return self.data[key]
+        if self.max_staleness:
+            self.apply_update_if_stale()
+        else:
+            self.apply_update()
+        value = self.data[key]
+        if value is self.lazy_value:
+            value = self.data[key] = self.load_lazy_value(key)
+        return value
+
+    def get(self, key, default=None, fresh=None):
+        """
+        Get the value of `key` or `default` if it does not exist.
+
+        With `fresh=False`, checking for new updates is skipped if the last check of a read like this
+        was less than `max_staleness` seconds ago, or `default_max_staleness` if it is not set. This is
+        the default with `max_staleness`. With `fresh=True`, we always check for new updates.
+        """
+        if fresh or fresh is None and not self.max_staleness:
+            self.apply_update()
+        else:
+            self.apply_update_if_stale()
+        value = self.data.get(key, default)
+        if value is self.lazy_value:
+            value = self.data[key] = self.load_lazy_value(key)
+        return value
+
+    def apply_update_if_stale(self):
+        """ Apply new updates if we have not checked for them for `max_staleness` seconds, see get() """
+        now = time.monotonic()
+        if now - self.synced >= (self.max_staleness or self.default_max_staleness):
+            self.synced = now
+            self.apply_update()
 
     # deprecated in Python 3
     def has_key(self, key):
-        self.apply_update()
-        return key in self.data
+        return self.__contains__(key)
 
     def __eq__(self, other):
-        return self.apply_update() == other.apply_update()
+        self.apply_update()
+        # Placeholders of lazy values are never equal to the values
+        self.load_lazy_values()
+        if isinstance(other, UltraDict):
+            other.apply_update()
+            other.load_lazy_values()
+            other = other.data
+        return self.data == other
 
     def __contains__(self, key):
-        self.apply_update()
+        if self.max_staleness:
+            self.apply_update_if_stale()
+        else:
+            self.apply_update()
         return key in self.data
 
     def __len__(self):
-        self.apply_update()
+        if self.max_staleness:
+            self.apply_update_if_stale()
+        else:
+            self.apply_update()
         return len(self.data)
 
     def __iter__(self):
-        self.apply_update()
+        if self.max_staleness:
+            self.apply_update_if_stale()
+        else:
+            self.apply_update()
         return iter(self.data)
 
     def __repr__(self):
@@ -889,6 +3887,7 @@ class UltraDict(collections.UserDict, dict):
             # If something goes wrong during the update, let's ignore it and still return a representation
             # TODO: Maybe somehow add a stale update warning?
             pass
+        self.load_lazy_values()
         return self.data.__repr__()
 
     def status(self):
@@ -896,13 +3895,30 @@ class UltraDict(collections.UserDict, dict):
         ret = { attr: getattr(self, attr) for attr in self.__slots__ if hasattr(self, attr) and attr != 'data' }
 
         ret['update_stream_position_remote'] = int.from_bytes(self.update_stream_position_remote, 'little')
+        ret['update_stream_lap_remote']      = int.from_bytes(self.update_stream_lap_remote, 'little')
         ret['lock_pid_remote']               = int.from_bytes(self.lock_pid_remote, 'little')
         ret['lock_remote']                   = int.from_bytes(self.lock_remote, 'little')
         ret['shared_lock_remote']            = self.shared_lock_remote[0:1] == b'1'
         ret['recurse_remote']                = self.recurse_remote[0:1] == b'1'
+        ret['zero_copy_remote']              = self.zero_copy_remote[0:1] == b'1'
+        ret['lazy_remote']                   = self.lazy_remote[0:1] == b'1'
+        ret['versions_remote']               = self.versions_remote[0:1] == b'1'
+        ret['fair_lock_remote']              = self.fair_lock_remote[0:1] == b'1'
+        ret['lock_free_remote']              = self.lock_free_remote[0:1] == b'1'
+        ret['stream_tail_remote']            = int.from_bytes(self.stream_tail_remote, 'little')
         ret['lock']                          = self.lock
+        # Includes waiting time statistics of the shared lock
+        ret['lock_status']                   = self.lock.status() if self.shared_lock else None
         ret['full_dump_counter_remote']      = int.from_bytes(self.full_dump_counter_remote, 'little')
         ret['full_dump_memory_name_remote']  = bytes(self.full_dump_memory_name_remote).decode('utf-8').strip('\x00').strip()
+        ret['full_dump_stream_lap_remote']   = int.from_bytes(self.full_dump_stream_lap_remote, 'little')
+        ret['full_dump_stream_position_remote'] = int.from_bytes(self.full_dump_stream_position_remote, 'little')
+        ret['full_dump_length_remote']       = int.from_bytes(self.full_dump_length_remote, 'little')
+        ret['compaction_counter_remote']     = int.from_bytes(self.compaction_counter_remote, 'little')
+        ret['compaction_length_remote']      = int.from_bytes(self.compaction_length_remote, 'little')
+        ret['compaction_memory_name_remote'] = self.get_compaction_memory_name()
+        # Estimated costs when the stream buffer is full, the cheaper one is chosen
+        ret['compaction_cost'], ret['full_dump_cost'] = self.get_compaction_costs()
 
         return ret
 
@@ -922,15 +3938,26 @@ class UltraDict(collections.UserDict, dict):
         if hasattr(self, 'lock') and hasattr(self.lock, 'cleanup'):
             self.lock.cleanup()
 
+        if getattr(self, 'stream_futex', None):
+            self.stream_futex.cleanup()
+            self.stream_futex = None
+
         # If we use RLock(), this closes the file handle
         if hasattr(self, 'lock'):
             del self.lock
         if hasattr(self, 'full_dump_memory'):
             del self.full_dump_memory
+        if hasattr(self, 'compaction_memory'):
+            del self.compaction_memory
 
         data = self.data
         del self.data
 
+        # Release the views into full dump memories, values that still use them keep them open, see load()
+        self.lazy_dump = None
+        if hasattr(self, 'view_memories'):
+            self.close_view_memories()
+
         self.del_remotes()
 
         #self.control.close()
@@ -960,6 +3987,7 @@ class UltraDict(collections.UserDict, dict):
 
     def values(self):
         self.apply_update()
+        self.load_lazy_values()
         return self.data.values()
 
     def unlink(self):
@@ -976,8 +4004,21 @@ class UltraDict(collections.UserDict, dict):
         if hasattr(self, 'finalizer'):
             self.finalizer.detach()
 
+        if getattr(self, 'checkpoint_thread', None):
+            self.stop_checkpoints()
+        if getattr(self, 'wal_fd', None) is not None:
+            self.close_wal()
+
+        # Placeholders of the lazy full dump cannot be resolved anymore once its memory is closed. From the
+        # finalizer, nobody gets our local copy anymore, cleanup() only drops the lazy full dump then. Our local
+        # copy must stay as it is, with recurse, it keeps the nested children open until unlink_recursed().
+        if not from_finalizer and getattr(self, 'lazy_dump', None) is not None:
+            self.load_lazy_values()
+
         if hasattr(self, 'full_dump_memory_name_remote'):
             full_dump_name = bytes(self.full_dump_memory_name_remote).decode('utf-8').strip().strip('\x00')
+        if hasattr(self, 'compaction_memory_name_remote'):
+            compaction_name = self.get_compaction_memory_name()
 
         data = self.cleanup()
 
@@ -989,7 +4030,9 @@ class UltraDict(collections.UserDict, dict):
             self.control.unlink()
             self.buffer.unlink()
             if full_dump_name:
-                self.unlink_by_name(full_dump_name, ignore_errors=True)
+                self.unlink_by_name(full_dump_name, ignore_errors=True, path=self.path)
+            if compaction_name:
+                self.unlink_by_name(compaction_name, ignore_errors=True, path=self.path)
 
             if getattr(self, 'recurse', False):
                 self.unlink_recursed()
@@ -1009,20 +4052,20 @@ class UltraDict(collections.UserDict, dict):
         ignore_errors = sys.platform == 'win32'
         for name in self.recurse_register.keys():
             #log.debug("Unlink recursed child name={}", name)
-            self.unlink_by_name(name=name, ignore_errors=ignore_errors)
-            self.unlink_by_name(name=f"{name}_memory", ignore_errors=ignore_errors)
+            self.unlink_by_name(name=name, ignore_errors=ignore_errors, path=self.path)
+            self.unlink_by_name(name=f"{name}_memory", ignore_errors=ignore_errors, path=self.path)
 
         self.recurse_register.close(unlink=True)
 
 
     @staticmethod
-    def unlink_by_name(name, ignore_errors=False):
+    def unlink_by_name(name, ignore_errors=False, path=None):
         """
         Can be used to delete left over shared memory blocks after crashes.
         """
         try:
             #log.debug("Unlinking memory '{}'", name)
-            memory = UltraDict.get_memory(create=False, name=name)
+            memory = UltraDict.get_memory(create=False, name=name, path=path)
             memory.unlink()
             memory.close()
             return True
@@ -1032,6 +4075,516 @@ class UltraDict(collections.UserDict, dict):
         return False
 
 
+class ShardedUltraDict(collections.abc.MutableMapping):
+    """
+    Partitions the keys across `shards` independent UltraDicts, each with its own
+    update stream, full dumps and lock, but presents one mapping interface.
+
+    Writers of keys in different shards don't block each other. The number of shards
+    is stored in a small UltraDict with `name`, the shards are named `{name}_{index}`.
+    """
+
+    __slots__ = 'name', 'meta', 'shards'
+
+    def __init__(self, *args, name=None, create=None, shards=None, buffer_size=10_000, serializer=pickle,
+            shared_lock=None, full_dump_size=None, auto_unlink=None, zero_copy=None, lazy=None, versions=None, fair_lock=None, lock_free=None,
+            max_staleness=None, path=None, **kwargs):
+
+        self.meta = UltraDict(name=name, create=create, buffer_size=1000, auto_unlink=auto_unlink, shared_lock=shared_lock, path=path)
+        self.name = self.meta.name
+
+        parameters = dict(buffer_size=buffer_size, serializer=serializer, shared_lock=shared_lock,
+            full_dump_size=full_dump_size, zero_copy=zero_copy, lazy=lazy, versions=versions, fair_lock=fair_lock, lock_free=lock_free,
+            max_staleness=max_staleness, path=path)
+
+        if hasattr(self.meta.control, 'created_by_ultra'):
+            self.shards = self.get_shards(shards or os.cpu_count() or 1, **parameters)
+            # Only publish the number of shards after all shards exist
+            self.meta['shards'] = len(self.shards)
+        else:
+            # Wait for the creator to publish the number of shards
+            timeout = time.monotonic() + 1
+            while 'shards' not in self.meta:
+                if time.monotonic() > timeout:
+                    raise Exceptions.CannotAttachSharedMemory(f"Could not get number of shards of '{self.name}'")
+                time.sleep(0.001)
+            shards_remote = self.meta['shards']
+            if shards is not None and shards != shards_remote:
+                raise Exceptions.ParameterMismatch(f"shards={shards} was set but the creator has used shards={shards_remote}")
+            self.shards = self.get_shards(shards_remote, **parameters)
+
+        if args or kwargs:
+            self.update(*args, **kwargs)
+
+    def get_shards(self, count, **kwargs):
+        """ Create or attach the UltraDicts of all shards """
+        return [ UltraDict(name=f'{self.name}_{index}', auto_unlink=self.meta.auto_unlink, **kwargs) for index in range(count) ]
+
+    @staticmethod
+    def get_hash(key):
+        """
+        Hash of `key` that is the same in all processes, unlike hash() of str and bytes.
+        Keys of other types than str, bytes, numbers, None and tuples and frozensets of them raise
+        TypeError, their pickle or hash() might differ between processes, e.g. the order of a frozenset.
+        """
+        if type(key) is str:
+            return zlib.crc32(key.encode('utf-8', 'surrogatepass'))
+        if type(key) is bytes:
+            return zlib.crc32(key)
+        if type(key) in (int, float, bool):
+            return hash(key)
+        if key is None:
+            return 0
+        if type(key) is tuple:
+            return hash(tuple(map(ShardedUltraDict.get_hash, key)))
+        if type(key) is frozenset:
+            # Independent of the order of iteration
+            return hash(tuple(sorted(map(ShardedUltraDict.get_hash, key))))
+        raise TypeError(f"Keys of type {type(key).__name__} are not supported by ShardedUltraDict, use str, bytes, numbers, None or tuples and frozensets of them")
+
+    def get_shard(self, key):
+        """ Get the UltraDict that contains `key` """
+        return self.shards[self.get_hash(key) % len(self.shards)]
+
+    def __getitem__(self, key):
+        return self.get_shard(key)[key]
+
+    def __setitem__(self, key, item):
+        self.get_shard(key)[key] = item
+
+    def __delitem__(self, key):
+        del self.get_shard(key)[key]
+
+    def __contains__(self, key):
+        return key in self.get_shard(key)
+
+    def __iter__(self):
+        return itertools.chain.from_iterable(self.shards)
+
+    def __len__(self):
+        return sum(len(shard) for shard in self.shards)
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+    def __reduce__(self):
+        from functools import partial
+        return (partial(self.__class__, name=self.name, auto_unlink=self.meta.auto_unlink, path=self.meta.path), ())
+
+    def update(self, other=None, **kwargs):
+        """ Stream the changes as one batch per shard """
+        batches = {}
+        def items():
+            if other is not None:
+                yield from other.items() if isinstance(other, collections.abc.Mapping) else other
+            yield from kwargs.items()
+        for key, value in items():
+            shard = self.get_shard(key)
+            batch = batches.get(id(shard))
+            if batch is None:
+                batch = batches[id(shard)] = shard.batch()
+            batch[key] = value
+        for batch in batches.values():
+            batch.commit()
+
+    def add(self, key, value):
+        return self.get_shard(key).add(key, value)
+
+    def incr(self, key, delta=1):
+        return self.get_shard(key).incr(key, delta)
+
+    def max(self, key, value):
+        return self.get_shard(key).max(key, value)
+
+    def min(self, key, value):
+        return self.get_shard(key).min(key, value)
+
+    def get_with_version(self, key, default=None):
+        return self.get_shard(key).get_with_version(key, default)
+
+    def cas(self, key, expected_version, value):
+        return self.get_shard(key).cas(key, expected_version, value)
+
+    def dump(self):
+        """ Dump all shards into shared memory """
+        for shard in self.shards:
+            shard.dump()
+
+    def status(self):
+        """ Internal debug helper to get the control state variables of all shards """
+        return [ shard.status() for shard in self.shards ]
+
+    def unlink(self):
+        self.close(unlink=True)
+
+    def close(self, unlink=False):
+        for shard in self.shards:
+            shard.close(unlink=unlink)
+        self.meta.close(unlink=unlink)
+
+
+
+class HashTableUltraDict(collections.abc.MutableMapping):
+    """
+    Dict that only lives in shared memory, there is no local copy in each process.
+
+    One shared memory block contains a small header, an open addressing hash table
+    of slots and an arena with the serialized keys and values the slots point to.
+    Readers never lock, they use the generation counter in the header like a seqlock
+    and retry if a writer has changed the table meanwhile. Writers use the lock.
+
+    The table has a fixed number of slots and a fixed arena size. Keys are compared by
+    their pickle, equal numbers are the same key like in a dict, see get_key_bytes().
+    """
+
+    Exceptions = Exceptions
+
+    # Offsets of empty and deleted slots, no record can start there
+    EMPTY, DELETED = 0, 1
+
+    # Maximum share of filled slots, including deleted ones
+    max_load = 0.75
+
+    # Header of the shared memory block, the slots start afterwards
+    header_size = 128
+
+    # Each slot has 8 bytes of hash and record length, then 8 bytes of record offset
+    slot_size = 16
+
+    __slots__ = 'name', 'memory', 'capacity', 'serializer', 'lock', 'shared_lock', \
+        'generation_remote', 'arena_remote', 'counts_remote', 'lock_remote', 'lock_pid_remote', \
+        'shared_lock_remote', 'lock_futex_remote', 'lock_readers_remote', 'slots_remote', \
+        'closed', 'auto_unlink', 'finalizer', '__weakref__'
+
+    def __init__(self, *args, name=None, create=None, capacity=10_000, arena_size=1_000_000, serializer=pickle,
+            shared_lock=None, auto_unlink=None, **kwargs):
+
+        self.closed = False
+        self.auto_unlink = auto_unlink
+        self.serializer = serializer
+
+        # Number of slots is a power of two, so we can use a mask instead of modulo
+        slots = 1 << (max(int(capacity / self.max_load), 2) - 1).bit_length()
+        arena_start = self.header_size + slots * self.slot_size
+
+        self.memory = UltraDict.get_memory(create=create, name=name, size=arena_start + arena_size)
+        self.name = self.memory.name
+
+        def finalize(weak_self, name):
+            resolved_self = weak_self()
+            if resolved_self is not None:
+                resolved_self.close()
+
+        self.finalizer = weakref.finalize(self, finalize, weakref.ref(self), self.name)
+
+        buf = self.memory.buf
+        # Generation counter, odd while a writer is changing the table
+        self.generation_remote = buf[ 0:  8].cast('Q')
+        # Arena start, arena end and the position of the next free byte in the arena
+        self.arena_remote      = buf[ 8: 32].cast('Q')
+        # Number of slots, then number of used slots and filled slots, ie. used or deleted
+        self.counts_remote     = buf[32: 44].cast('I')
+        self.lock_remote       = buf[44: 46]
+        self.lock_pid_remote   = buf[48: 52]
+        self.shared_lock_remote= buf[52: 53]
+        self.lock_futex_remote = buf[64: 80]
+        self.lock_readers_remote = buf[80: 88]
+
+        if hasattr(self.memory, 'created_by_ultra'):
+            if auto_unlink is None:
+                self.auto_unlink = True
+            if shared_lock:
+                self.shared_lock_remote[0:1] = b'1'
+            self.arena_remote[0] = self.arena_remote[2] = arena_start
+            self.arena_remote[1] = self.memory.size
+            # The number of slots comes last, it tells others that the table is ready
+            self.counts_remote[0] = slots
+        else:
+            # Wait for the creator to set up the table
+            timeout = time.monotonic() + 1
+            while not self.counts_remote[0]:
+                if time.monotonic() > timeout:
+                    raise Exceptions.CannotAttachSharedMemory(f"Hash table '{self.name}' was not set up")
+                time.sleep(0.001)
+
+            shared_lock_remote = self.shared_lock_remote[0:1] == b'1'
+            if shared_lock is None:
+                shared_lock = shared_lock_remote
+            elif shared_lock != shared_lock_remote:
+                raise Exceptions.ParameterMismatch(f"shared_lock={shared_lock} was set but the creator has used shared_lock={shared_lock_remote}")
+
+        self.capacity = self.counts_remote[0]
+        # Hash and length, then offset of each slot
+        self.slots_remote = buf[self.header_size:self.header_size + self.capacity * self.slot_size].cast('Q')
+
+        if shared_lock:
+            try:
+                self.lock = UltraDict.SharedLock(self, 'lock_remote', 'lock_pid_remote', 'lock_futex_remote', 'lock_readers_remote')
+            except NameError:
+                raise Exceptions.MissingDependency("Install `atomics` Python package to use shared_lock=True") from None
+        else:
+            self.lock = UltraDict.RLock(ctx=multiprocessing.get_context())
+        self.shared_lock = shared_lock
+
+        if args or kwargs:
+            self.update(*args, **kwargs)
+
+    def __del__(self):
+        self.close()
+
+    def __reduce__(self):
+        from functools import partial
+        return (partial(self.__class__, name=self.name, auto_unlink=self.auto_unlink), ())
+
+    @staticmethod
+    def get_key_bytes(key):
+        """ Keys are always pickled, independent of the serializer, so they can be compared as bytes """
+        return pickle.dumps(HashTableUltraDict.normalize_key(key), protocol=4)
+
+    @staticmethod
+    def normalize_key(key):
+        """
+        Equal numbers must have the same pickle, so True and 1.0 become 1, also in tuples.
+        Such keys come back as int when iterating.
+        """
+        if type(key) is bool:
+            return int(key)
+        if type(key) is float and key.is_integer():
+            return int(key)
+        if type(key) is tuple:
+            return tuple(map(HashTableUltraDict.normalize_key, key))
+        return key
+
+    def find(self, key_bytes):
+        """
+        Find the slot of `key_bytes`, returns the index of the slot and the offset of its record,
+        or the index of the first free slot and 0 if there is no such key. Does not lock.
+        """
+        key_hash = zlib.crc32(key_bytes)
+        key_length = len(key_bytes)
+        buf, slots, mask = self.memory.buf, self.slots_remote, self.capacity - 1
+        index = key_hash & mask
+        free = None
+        for _ in range(self.capacity):
+            offset = slots[2*index + 1]
+            if offset == self.EMPTY:
+                break
+            if offset == self.DELETED:
+                if free is None:
+                    free = index
+            elif slots[2*index] & 0xFFFFFFFF == key_hash \
+                    and int.from_bytes(buf[offset:offset+4], 'little') == key_length \
+                    and buf[offset+4:offset+4+key_length] == key_bytes:
+                return index, offset
+            index = (index + 1) & mask
+        return (index if free is None else free), 0
+
+    def read(self, key_bytes):
+        """ Get a copy of the serialized value of `key_bytes` or None if there is no such key, without locking """
+        generation = self.generation_remote
+        while True:
+            start = generation[0]
+            # A writer is changing the table
+            if start & 1:
+                time.sleep(0.000001)
+                continue
+
+            index, offset = self.find(key_bytes)
+            value = None
+            if offset:
+                length = self.slots_remote[2*index] >> 32
+                value = bytes(self.memory.buf[offset+4+len(key_bytes):offset+length])
+
+            # Nothing has changed while we were reading
+            if generation[0] == start:
+                return value
+
+    def read_all(self):
+        """ Get copies of the serialized keys and values of all records, without locking """
+        generation = self.generation_remote
+        while True:
+            start = generation[0]
+            if start & 1:
+                time.sleep(0.000001)
+                continue
+
+            buf = self.memory.buf
+            slots = self.slots_remote.tolist()
+            records = [ bytes(buf[offset:offset + (info >> 32)]) for info, offset in zip(slots[0::2], slots[1::2]) if offset > self.DELETED ]
+
+            if generation[0] == start:
+                break
+
+        items = []
+        for record in records:
+            key_length = int.from_bytes(record[:4], 'little')
+            items.append((record[4:4+key_length], record[4+key_length:]))
+        return items
+
+    def write(self, key_bytes, value_bytes=None):
+        """ Set the serialized value of `key_bytes` or delete it if `value_bytes` is None, returns if the key existed """
+        with self.lock:
+            index, offset = self.find(key_bytes)
+
+            if value_bytes is None:
+                if not offset:
+                    return False
+                self.begin_write()
+                self.slots_remote[2*index + 1] = self.DELETED
+                self.counts_remote[1] -= 1
+                self.end_write()
+                return True
+
+            length = 4 + len(key_bytes) + len(value_bytes)
+
+            # Remove deleted slots and records that are not used anymore if we run out of space
+            if (not offset and self.slots_remote[2*index + 1] == self.EMPTY and self.counts_remote[2] + 1 > self.capacity * self.max_load) \
+                    or self.arena_remote[2] + length > self.arena_remote[1]:
+                self.reorganize()
+                index, offset = self.find(key_bytes)
+                if not offset and self.counts_remote[1] + 1 > self.capacity * self.max_load:
+                    raise Exceptions.HashTableFull(f'Hash table has no free slots: capacity={int(self.capacity * self.max_load)}')
+                if self.arena_remote[2] + length > self.arena_remote[1]:
+                    raise Exceptions.HashTableFull(f'Hash table arena too small: needed={length} free={self.arena_remote[1] - self.arena_remote[2]}')
+
+            self.begin_write()
+            position = self.arena_remote[2]
+            buf = self.memory.buf
+            buf[position:position+4] = len(key_bytes).to_bytes(4, 'little')
+            buf[position+4:position+4+len(key_bytes)] = key_bytes
+            buf[position+4+len(key_bytes):position+length] = value_bytes
+            self.arena_remote[2] = position + length
+
+            if not offset:
+                self.counts_remote[1] += 1
+                if self.slots_remote[2*index + 1] == self.EMPTY:
+                    self.counts_remote[2] += 1
+            self.slots_remote[2*index] = zlib.crc32(key_bytes) | length << 32
+            self.slots_remote[2*index + 1] = position
+            self.end_write()
+            return bool(offset)
+
+    def reorganize(self):
+        """ Rebuild the hash table without deleted slots and the arena without records that are not used anymore """
+        with self.lock:
+            records = [ len(key).to_bytes(4, 'little') + key + value for key, value in self.read_all() ]
+
+            self.begin_write()
+            slots, mask = self.slots_remote, self.capacity - 1
+            for index in range(len(slots)):
+                slots[index] = 0
+            buf = self.memory.buf
+            position = self.arena_remote[0]
+            for record in records:
+                key_bytes = record[4:4+int.from_bytes(record[:4], 'little')]
+                key_hash = zlib.crc32(key_bytes)
+                index = key_hash & mask
+                while slots[2*index + 1] != self.EMPTY:
+                    index = (index + 1) & mask
+                buf[position:position+len(record)] = record
+                slots[2*index] = key_hash | len(record) << 32
+                slots[2*index + 1] = position
+                position += len(record)
+            self.arena_remote[2] = position
+            self.counts_remote[1] = self.counts_remote[2] = len(records)
+            self.end_write()
+
+    def begin_write(self):
+        self.generation_remote[0] += 1
+
+    def end_write(self):
+        self.generation_remote[0] += 1
+
+    def __getitem__(self, key):
+        value = self.read(self.get_key_bytes(key))
+        if value is None:
+            raise KeyError(key)
+        return self.serializer.loads(value)
+
+    def __setitem__(self, key, item):
+        self.write(self.get_key_bytes(key), self.serializer.dumps(item))
+
+    def __delitem__(self, key):
+        if not self.write(self.get_key_bytes(key)):
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        return self.read(self.get_key_bytes(key)) is not None
+
+    def pop(self, key, *default):
+        with self.lock:
+            try:
+                value = self[key]
+            except KeyError:
+                if default:
+                    return default[0]
+                raise
+            del self[key]
+            return value
+
+    def setdefault(self, key, default=None):
+        with self.lock:
+            try:
+                return self[key]
+            except KeyError:
+                self[key] = default
+                return default
+
+    def __iter__(self):
+        return iter([ pickle.loads(key) for key, _ in self.read_all() ])
+
+    def __len__(self):
+        return self.counts_remote[1]
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+    def items(self):
+        """ Consistent snapshot of all items """
+        return [ (pickle.loads(key), self.serializer.loads(value)) for key, value in self.read_all() ]
+
+    def values(self):
+        """ Consistent snapshot of all values """
+        return [ self.serializer.loads(value) for _, value in self.read_all() ]
+
+    def status(self):
+        """ Internal debug helper to get the header state variables """
+        return {
+            'name': self.name,
+            'generation_remote': self.generation_remote[0],
+            'capacity': int(self.capacity * self.max_load),
+            'slots': self.capacity,
+            'used_slots': self.counts_remote[1],
+            'filled_slots': self.counts_remote[2],
+            'arena_size': self.arena_remote[1] - self.arena_remote[0],
+            'arena_used': self.arena_remote[2] - self.arena_remote[0],
+        }
+
+    def unlink(self):
+        self.close(unlink=True)
+
+    def close(self, unlink=False):
+        if getattr(self, 'closed', True):
+            return
+        self.closed = True
+        if hasattr(self, 'finalizer'):
+            self.finalizer.detach()
+
+        if hasattr(self, 'lock'):
+            if hasattr(self.lock, 'cleanup'):
+                self.lock.cleanup()
+            del self.lock
+
+        # Release all views, otherwise the memory cannot be closed
+        for attr in ('generation_remote', 'arena_remote', 'counts_remote', 'slots_remote'):
+            if hasattr(self, attr):
+                getattr(self, attr).release()
+        UltraDict.del_remotes(self)
+
+        if unlink or (self.auto_unlink and hasattr(self.memory, 'created_by_ultra')):
+            self.memory.unlink()
+        self.memory.close()
+
 
 # Saved as a reference
 
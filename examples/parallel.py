@@ -29,6 +29,7 @@ def run(name, target, x):
             # between reading and writing.
             d['counter'] += 1
             #print("counter: ", d['counter'], i, x)
+        # For simple counters, d.incr('counter') does the same without a read-modify-write
 
 if __name__ == '__main__':
 
@@ -0,0 +1,39 @@
+#
+# Measures how fast a reader catches up with updates in the stream
+#
+# A writer appends `count` updates while a second UltraDict attached to the same
+# shared memory does not read. Afterwards, the reader applies all pending updates
+# at once.
+
+import sys, time
+sys.path.insert(0, '../../..')
+
+count = 100_000
+
+def print_perf(name, t_start, t_end, iterations):
+    t = t_end - t_start
+    speed = round(iterations / t)
+    print(f"{name} = {speed:,d} records per second")
+
+def main():
+
+    print(f"\nTesting catch-up performance with {count!r} records\n")
+
+    import UltraDict
+
+    # Big enough for all updates, so the reader really has to catch up from the stream
+    ultra = UltraDict.UltraDict(buffer_size=count * 50)
+    other = UltraDict.UltraDict(name=ultra.name)
+
+    for name, value in (('int values', 1), ('str values', 'x' * 20)):
+        for i in range(count):
+            ultra[i] = value
+
+        t_start = time.perf_counter()
+        other.apply_update()
+        t_end = time.perf_counter()
+        assert len(other.data) == count
+        print_perf(f'UltraDict catch-up ({name})', t_start, t_end, count)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+#
+# Measures the CPU time used by consumers that mostly wait for changes
+#
+# A writer changes a key every `interval` seconds while many consumer processes
+# react to the changes. Compares consumers polling the dict with consumers
+# sleeping in `wait_for_update()`, which uses a futex on Linux.
+#
+# Usage: python idle_consumers.py [process counts ...]
+
+import sys, time, resource, multiprocessing
+sys.path.insert(0, '../../..')
+
+count = 20
+interval = 0.05
+
+def poll(ultra, start):
+    start.wait()
+    while ultra.get('counter') != count:
+        pass
+
+def wait(ultra, start):
+    start.wait()
+    while ultra.data.get('counter') != count:
+        ultra.wait_for_update()
+
+def run(target, processes):
+    import UltraDict
+
+    ultra = UltraDict.UltraDict(shared_lock=True)
+    ultra['counter'] = 0
+
+    ctx = multiprocessing.get_context('spawn')
+    start = ctx.Barrier(processes + 1)
+    consumers = [ ctx.Process(target=target, args=(ultra, start)) for _ in range(processes) ]
+    for consumer in consumers:
+        consumer.start()
+
+    cpu_start = resource.getrusage(resource.RUSAGE_CHILDREN)
+    start.wait()
+    t_start = time.perf_counter()
+    for i in range(count):
+        time.sleep(interval)
+        ultra['counter'] = i + 1
+    for consumer in consumers:
+        consumer.join()
+    t_end = time.perf_counter()
+    cpu_end = resource.getrusage(resource.RUSAGE_CHILDREN)
+    ultra.unlink()
+
+    # Includes the CPU time for starting the processes
+    cpu = cpu_end.ru_utime + cpu_end.ru_stime - cpu_start.ru_utime - cpu_start.ru_stime
+    return t_end - t_start, cpu
+
+def main():
+    process_counts = [ int(arg) for arg in sys.argv[1:] ] or [ 2, 8, 32 ]
+
+    print(f"\nTesting idle consumers with {count!r} changes every {interval!r} s\n")
+
+    for processes in process_counts:
+        for name, target in (('polling', poll), ('wait_for_update()', wait)):
+            t, cpu = run(target, processes)
+            print(f"{name} ({processes} consumers) = {t:.2f} s, {cpu:.2f} s CPU time")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,41 @@
+#
+# Measures writes of long string keys that are rewritten again and again
+#
+# Updates of str and bytes keys refer to their key by id after its first update
+# since the latest full dump, see `UltraDict.KeyTable`. This makes updates smaller,
+# so the stream needs less full dumps. Shows the bytes written to the stream and
+# the speed of a reader catching up.
+
+import sys, time
+sys.path.insert(0, '../../..')
+
+count = 100_000
+keys = [ f'tenant:{i}:feature:some-rather-long-feature-name' for i in range(1_000) ]
+
+def main():
+    import UltraDict
+
+    print(f"\nTesting {count!r} updates of {len(keys)!r} long keys\n")
+
+    # Big enough for all updates, so the reader really has to catch up from the stream
+    ultra = UltraDict.UltraDict(buffer_size=count * 100, shared_lock=True)
+    other = UltraDict.UltraDict(name=ultra.name)
+
+    t_start = time.perf_counter()
+    for i in range(count):
+        ultra[keys[i % len(keys)]] = i
+    t_end = time.perf_counter()
+    print(f"UltraDict writes = {round(count / (t_end - t_start)):,d} per second")
+
+    lap, position = ultra.get_stream_head()
+    print(f"Update stream = {lap * ultra.buffer_size + position:,d} bytes")
+
+    t_start = time.perf_counter()
+    other.apply_update()
+    t_end = time.perf_counter()
+    print(f"UltraDict catch-up = {round(count / (t_end - t_start)):,d} records per second")
+
+    ultra.unlink()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+#
+# Measures the shared lock under contention
+#
+# Many processes increment a counter under the shared lock. Compares waiting on
+# a futex (Linux only) with polling the lock using `sleep_time`, and the default
+# lock with the fair ticket lock. Besides the throughput, the CPU time used by
+# all processes and the tail latency of waiting for the lock is shown.
+#
+# Usage: python lock_contention.py [process counts ...]
+
+import sys, time, resource, multiprocessing
+sys.path.insert(0, '../../..')
+
+count = 2_000
+
+def print_perf(name, processes, t_start, t_end, iterations, cpu, wait_times):
+    t = t_end - t_start
+    speed = round(iterations / t)
+    wait_times.sort()
+    p999 = wait_times[min(int(len(wait_times) * 0.999), len(wait_times) - 1)] * 1000 if wait_times else 0.0
+    p_max = wait_times[-1] * 1000 if wait_times else 0.0
+    print(f"{name} ({processes} processes) = {speed:,d} ops per second, {cpu:.2f} s CPU time, "
+        f"wait p99.9 {p999:.2f} ms, max {p_max:.2f} ms")
+
+def increment(name, use_futex, start, results):
+    import UltraDict
+    UltraDict.UltraDict.SharedLock.use_futex = use_futex
+    ultra = UltraDict.UltraDict(name=name, shared_lock=True)
+    start.wait()
+    for _ in range(count):
+        with ultra.lock:
+            ultra['counter'] += 1
+    results.put(list(ultra.lock.wait_times))
+
+def run(processes, use_futex, fair_lock):
+    import UltraDict
+
+    ultra = UltraDict.UltraDict(shared_lock=True, fair_lock=fair_lock, buffer_size=1_000_000)
+    ultra['counter'] = 0
+
+    ctx = multiprocessing.get_context('spawn')
+    start = ctx.Barrier(processes + 1)
+    results = ctx.Queue()
+    workers = [ ctx.Process(target=increment, args=(ultra.name, use_futex, start, results)) for _ in range(processes) ]
+    for worker in workers:
+        worker.start()
+
+    cpu_start = resource.getrusage(resource.RUSAGE_CHILDREN)
+    start.wait()
+    t_start = time.perf_counter()
+    wait_times = [ t for _ in workers for t in results.get() ]
+    for worker in workers:
+        worker.join()
+    t_end = time.perf_counter()
+    cpu_end = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+    assert ultra['counter'] == count * processes
+    ultra.unlink()
+
+    # Includes the CPU time for starting the processes
+    cpu = cpu_end.ru_utime + cpu_end.ru_stime - cpu_start.ru_utime - cpu_start.ru_stime
+    return t_start, t_end, cpu, wait_times
+
+def main():
+    import UltraDict
+
+    process_counts = [ int(arg) for arg in sys.argv[1:] ] or [ 2, 4, 8, 16, 32, 64 ]
+
+    print(f"\nTesting shared lock contention with {count!r} increments per process\n")
+
+    if not UltraDict.futex_syscall:
+        print("Futex not available, only polling is tested\n")
+
+    for processes in process_counts:
+        for name, use_futex, fair_lock in (('futex', True, False), ('polling', False, False), ('fair, futex', True, True), ('fair, polling', False, True)):
+            if use_futex and not UltraDict.futex_syscall:
+                continue
+            t_start, t_end, cpu, wait_times = run(processes, use_futex, fair_lock)
+            print_perf(f'SharedLock ({name})', processes, t_start, t_end, count * processes, cpu, wait_times)
+
+if __name__ == '__main__':
+    main()
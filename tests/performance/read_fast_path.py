@@ -0,0 +1,48 @@
+#
+# Measures reads of an UltraDict when nothing has changed
+#
+# Every read checks for new updates in the stream first. Without new updates,
+# this is only one read of the generation in the control memory, see
+# `UltraDict.apply_update()`. With `max_staleness`, reads skip even that check
+# for a while after the last one.
+
+import sys, time
+sys.path.insert(0, '../../..')
+
+count = 1_000_000
+
+def print_perf(name, t_start, t_end, iterations, base=None):
+    t = t_end - t_start
+    speed = round(iterations / t)
+    factor = f" (factor {base / speed:.2f})" if base else ''
+    print(f"{name} = {speed:,d} reads per second{factor}")
+    return speed
+
+def measure(name, read, base=None):
+    t_start = time.perf_counter()
+    for _ in range(count):
+        read(1)
+    t_end = time.perf_counter()
+    return print_perf(name, t_start, t_end, count, base)
+
+def main():
+    import UltraDict
+
+    print(f"\nTesting reads without changes with {count!r} reads\n")
+
+    ultra = UltraDict.UltraDict({ i: i for i in range(10_000) })
+    orig = dict(ultra)
+
+    base = measure('Python dict', orig.__getitem__)
+    measure('UltraDict', ultra.__getitem__, base)
+    measure('UltraDict contains', ultra.__contains__, base)
+    measure('UltraDict apply_update()', lambda _: ultra.apply_update(), base)
+
+    stale = UltraDict.UltraDict(name=ultra.name, max_staleness=0.005)
+    measure('UltraDict (max_staleness=0.005)', stale.__getitem__, base)
+    measure('UltraDict get(fresh=False)', lambda key: ultra.get(key, fresh=False), base)
+
+    ultra.unlink()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+#
+# Measures the write throughput of many writer processes
+#
+# All writers of an UltraDict serialize on its single lock, writers of a
+# ShardedUltraDict only contend on the lock of the shard that contains the key.
+# With `lock_free=True`, writers of an UltraDict don't take the lock at all.
+#
+# Usage: python sharded_writers.py [process counts ...]
+
+import sys, time, multiprocessing
+sys.path.insert(0, '../../..')
+
+count = 20_000
+
+def print_perf(name, processes, t_start, t_end, iterations):
+    t = t_end - t_start
+    speed = round(iterations / t)
+    print(f"{name} ({processes} writers) = {speed:,d} writes per second")
+
+def write(ultra, index, start):
+    start.wait()
+    for i in range(count):
+        ultra[f'{index}_{i}'] = i
+
+def run(ultra, processes):
+    start = multiprocessing.Barrier(processes + 1)
+    workers = [ multiprocessing.Process(target=write, args=(ultra, index, start)) for index in range(processes) ]
+    for worker in workers:
+        worker.start()
+    start.wait()
+    t_start = time.perf_counter()
+    for worker in workers:
+        worker.join()
+    t_end = time.perf_counter()
+    return t_start, t_end
+
+def main():
+    import UltraDict
+
+    process_counts = [ int(arg) for arg in sys.argv[1:] ] or [ 1, 2, 4, 8 ]
+
+    print(f"\nTesting write throughput with {count!r} writes per process\n")
+
+    for processes in process_counts:
+        ultra = UltraDict.UltraDict(shared_lock=True, buffer_size=1_000_000)
+        t_start, t_end = run(ultra, processes)
+        print_perf('UltraDict', processes, t_start, t_end, count * processes)
+        ultra.unlink()
+
+        ultra = UltraDict.UltraDict(shared_lock=True, lock_free=True, buffer_size=1_000_000)
+        t_start, t_end = run(ultra, processes)
+        print_perf('UltraDict (lock_free=True)', processes, t_start, t_end, count * processes)
+        ultra.unlink()
+
+        sharded = UltraDict.ShardedUltraDict(shards=processes * 4, shared_lock=True, buffer_size=1_000_000)
+        t_start, t_end = run(sharded, processes)
+        print_perf('ShardedUltraDict', processes, t_start, t_end, count * processes)
+        sharded.unlink()
+
+if __name__ == '__main__':
+    main()
@@ -1,9 +1,16 @@
 import unittest
 import subprocess
+import os
+import gc
 import sys
+import asyncio
+import tempfile
+import threading
+import time
+import pickle
 
 sys.path.insert(0, '..')
-from UltraDict import UltraDict
+from UltraDict import UltraDict, ShardedUltraDict, HashTableUltraDict
 
 # Disable logging
 if hasattr(UltraDict.log, 'disable'):
@@ -60,6 +67,786 @@ class UltraDictTests(unittest.TestCase):
 
         self.assertEqual(len(other.data['huge']), length)
 
+    def test_stream_wrap_around(self):
+        ultra = UltraDict(buffer_size=1000)
+        other = UltraDict(name=ultra.name)
+
+        data = other.data
+        for i in range(1000):
+            ultra[i % 10] = i
+            # Keep up with the stream, so we never need to load a full dump
+            self.assertEqual(other[i % 10], i)
+
+        self.assertGreater(ultra.update_stream_lap, 0)
+        self.assertIs(other.data, data)
+
+        late = UltraDict(name=ultra.name)
+        self.assertEqual(late.data, ultra.data)
+
+    def test_compaction(self):
+        # Full dumps are expensive compared to rewriting the same few keys
+        ultra = UltraDict({ i: i for i in range(10_000) }, buffer_size=1000)
+        ultra.dump()
+        other = UltraDict(name=ultra.name)
+
+        full_dump_counter = ultra.full_dump_counter
+        compaction_counter = ultra.status()['compaction_counter_remote']
+
+        data = other.data
+        for i in range(1000):
+            ultra[i % 10] = -i
+            self.assertEqual(other[i % 10], -i)
+        del ultra[5]
+
+        compactions = ultra.status()['compaction_counter_remote'] - compaction_counter
+        self.assertGreater(compactions, 0)
+        # No full dumps, only compactions
+        self.assertEqual(ultra.full_dump_counter - full_dump_counter, compactions)
+        self.assertIs(other.data, data)
+
+        late = UltraDict(name=ultra.name)
+        self.assertEqual(late.data, ultra.data)
+        self.assertNotIn(5, late)
+
+    def test_batch(self):
+        ultra = UltraDict({ 'delete': True })
+        other = UltraDict(name=ultra.name)
+
+        position = ultra.update_stream_position
+        with ultra.batch() as batch:
+            for i in range(100):
+                batch[i] = i
+            del batch['delete']
+            with self.assertRaises(KeyError):
+                del batch['missing']
+            # Nothing is streamed before the batch is complete
+            self.assertNotIn(0, other)
+
+        self.assertEqual(len(other), 100)
+        self.assertNotIn('delete', other)
+
+        # The whole batch is one single update in the stream
+        updates, _, _ = other.read_updates(0, position, ultra.update_stream_position)
+        self.assertEqual(len(updates), 1)
+
+        ultra.update({ i: -i for i in range(100) }, extra=1)
+        self.assertEqual(other[99], -99)
+        self.assertEqual(other['extra'], 1)
+
+    def test_catch_up(self):
+        ultra = UltraDict(buffer_size=100_000)
+        other = UltraDict(name=ultra.name)
+        data = other.data
+
+        # Compact updates, pickles and updates with key ids, all read in one go
+        count = 0
+        for i in range(200):
+            ultra[i] = i * 1.5
+            ultra[f'key{i}'] = str(i)
+            ultra[(i, 'tuple')] = [i]
+            ultra[i + 1000] = 2**70 if i % 2 else None
+            ultra.incr('counter')
+            count += 5
+            if i % 10 == 9:
+                del ultra[i]
+                with ultra.batch() as batch:
+                    batch[f'batch{i}'] = i
+                    del batch[f'key{i}']
+                count += 2
+
+        self.assertEqual(other.apply_update(), count)
+        self.assertEqual(other.data, ultra.data)
+        self.assertEqual(other['counter'], 200)
+        # Caught up from the stream without loading a full dump
+        self.assertIs(other.data, data)
+
+    def test_operations(self):
+        # Big enough full dump, so the stream is compacted and operations get folded
+        ultra = UltraDict({ i: i for i in range(10_000) }, buffer_size=1000)
+        ultra.dump()
+        other = UltraDict(name=ultra.name)
+        compaction_counter = ultra.status()['compaction_counter_remote']
+
+        for i in range(300):
+            self.assertEqual(ultra.incr('counter'), i + 1)
+            ultra.max('max', i % 7)
+            other.min('min', -i)
+            other.add('text', 'a')
+            if i % 50 == 0:
+                del ultra['counter']
+                ultra.incr('counter', i + 1)
+        self.assertEqual(other['counter'], 300)
+        self.assertEqual(other['max'], 6)
+        self.assertEqual(ultra['min'], -299)
+        self.assertEqual(ultra['text'], 'a' * 300)
+
+        # Operations that fail are not streamed
+        with self.assertRaises(TypeError):
+            ultra.add('text', 1)
+
+        self.assertGreater(ultra.status()['compaction_counter_remote'], compaction_counter)
+        late = UltraDict(name=ultra.name)
+        self.assertEqual(late.data, ultra.data)
+
+    def test_versions(self):
+        # Big enough full dump, so the stream is compacted
+        ultra = UltraDict({ f'big{i}': i for i in range(10_000) }, versions=True, buffer_size=1000)
+        ultra['a'] = 1
+        ultra.dump()
+        other = UltraDict(name=ultra.name)
+        compaction_counter = ultra.status()['compaction_counter_remote']
+
+        value, version = other.get_with_version('a')
+        self.assertEqual(value, 1)
+        self.assertGreater(version, 0)
+        self.assertEqual(other.get_with_version('missing'), (None, 0))
+
+        ultra['a'] = 2
+        # Someone else has changed the key meanwhile
+        self.assertFalse(other.cas('a', version, 3))
+        value, version = other.get_with_version('a')
+        self.assertTrue(other.cas('a', version, value + 1))
+        self.assertEqual(ultra['a'], 3)
+        # Version 0 only sets keys that don't exist
+        self.assertFalse(ultra.cas('a', 0, 4))
+        self.assertTrue(ultra.cas('b', 0, 4))
+
+        # Versions survive full dumps and compactions
+        for i in range(100):
+            ultra.incr(i % 10)
+            with ultra.batch() as batch:
+                batch['c'] = i
+        self.assertGreater(ultra.status()['compaction_counter_remote'], compaction_counter)
+        late = UltraDict(name=ultra.name)
+        other.apply_update()
+        self.assertEqual(late.key_versions, ultra.key_versions)
+        self.assertEqual(late.key_versions, other.key_versions)
+        ultra.dump()
+        self.assertEqual(UltraDict(name=ultra.name).key_versions, ultra.key_versions)
+
+        with self.assertRaises(UltraDict.Exceptions.ParameterMismatch):
+            UltraDict(name=ultra.name, versions=False)
+
+    def test_futex(self):
+        ultra = UltraDict(shared_lock=True, buffer_size=1000)
+        other = UltraDict(name=ultra.name, shared_lock=True)
+        if other.lock.futex is None:
+            self.skipTest("Futex not available")
+
+        def release():
+            time.sleep(0.1)
+            ultra.lock.release()
+
+        # Polling with this sleep_time would take 10 seconds, and without the wake up, the futex
+        # would only time out after 10 seconds as well
+        futex_timeout = UltraDict.SharedLock.futex_timeout
+        UltraDict.SharedLock.futex_timeout = 10
+        try:
+            ultra.lock.acquire()
+            thread = threading.Thread(target=release)
+            thread.start()
+            time_start = time.monotonic()
+            with other.lock(sleep_time=10):
+                self.assertLess(time.monotonic() - time_start, 2)
+            thread.join()
+        finally:
+            UltraDict.SharedLock.futex_timeout = futex_timeout
+
+        def write():
+            time.sleep(0.1)
+            ultra['a'] = 1
+
+        # Without the futex, the stream would be polled once per second
+        thread = threading.Thread(target=write)
+        thread.start()
+        time_start = time.monotonic()
+        self.assertEqual(other.wait_for_update(sleep_time=10), 1)
+        self.assertLess(time.monotonic() - time_start, 0.5)
+        thread.join()
+
+    def test_read_write_lock(self):
+        ultra = UltraDict({ 'a': 1 }, shared_lock=True)
+        other = UltraDict(name=ultra.name, shared_lock=True)
+
+        # Many readers at once, but no writer
+        with ultra.lock.read():
+            with other.lock.read(block=False):
+                self.assertEqual(other['a'], 1)
+                self.assertEqual(ultra.lock.status()['readers'], 2)
+            with self.assertRaises(UltraDict.Exceptions.CannotAcquireLock):
+                other.lock.acquire(block=False)
+            # Giving the lock back to the readers is no acquisition
+            self.assertEqual(other.lock.status()['acquisitions'], 0)
+            # No upgrade from reading to writing
+            with self.assertRaises(Exception):
+                ultra['a'] = 2
+        self.assertEqual(ultra.lock.status()['readers'], 0)
+
+        # Writing excludes readers and includes reading
+        with ultra.lock.write():
+            with self.assertRaises(UltraDict.Exceptions.CannotAcquireLock):
+                other.lock.acquire_read(block=False)
+            with ultra.lock.read():
+                ultra['a'] = 2
+        with other.lock.read(block=False):
+            self.assertEqual(other['a'], 2)
+        self.assertEqual(ultra.lock.status()['lock_remote'], 0)
+
+        # Writers only announce themselves to the readers when they have to wait
+        with other.lock(timeout=1):
+            self.assertEqual(other.lock.get_writers(), 0)
+        self.assertEqual(other.lock.status()['acquisitions'], 1)
+
+    def test_fair_lock(self):
+        ultra = UltraDict(shared_lock=True, fair_lock=True)
+        other = UltraDict(name=ultra.name)
+        self.assertTrue(other.fair_lock)
+
+        with ultra.lock:
+            with self.assertRaises(UltraDict.Exceptions.CannotAcquireLock):
+                other.lock.acquire(block=False)
+            with self.assertRaises(UltraDict.Exceptions.CannotAcquireLockTimeout):
+                other.lock.acquire(timeout=0.01)
+        # Given up tickets don't block others
+        with other.lock(block=False):
+            other['a'] = 1
+
+        status = other.lock.status()
+        self.assertEqual(status['next_ticket'], status['now_serving'])
+        self.assertEqual(status['acquisitions'], 1)
+        self.assertEqual(ultra.status()['lock_status']['acquisitions'], 1)
+
+        with self.assertRaises(UltraDict.Exceptions.ParameterMismatch):
+            UltraDict(name=ultra.name, fair_lock=False)
+
+    def test_lock_free(self):
+        ultra = UltraDict(shared_lock=True, lock_free=True, versions=True, buffer_size=1000)
+        other = UltraDict(name=ultra.name)
+        self.assertTrue(other.lock_free)
+
+        # Wraps around the stream many times
+        for i in range(200):
+            ultra[i % 10] = str(i)
+            other[f'other{i % 10}'] = i
+        del other[0]
+        with self.assertRaises(KeyError):
+            del ultra[0]
+        ultra.incr('counter')
+        other.incr('counter')
+        # Too big for the stream
+        ultra['big'] = b'x' * 2000
+
+        version = other.get_with_version(1)[1]
+        self.assertTrue(other.cas(1, version, 'new'))
+        self.assertFalse(ultra.cas(1, version, 'newer'))
+
+        self.assertEqual(ultra['counter'], 2)
+        self.assertEqual(other[1], 'new')
+        self.assertEqual(ultra.data, other.data)
+        self.assertEqual(UltraDict(name=ultra.name).data, ultra.data)
+        self.assertEqual(ultra.status()['stream_tail_remote'], other.status()['stream_tail_remote'])
+
+        with self.assertRaises(UltraDict.Exceptions.ParameterMismatch):
+            UltraDict(name=ultra.name, lock_free=False)
+        with self.assertRaises(UltraDict.Exceptions.ParameterMismatch):
+            UltraDict(lock_free=True)
+
+    def test_dead_writer(self):
+        ultra = UltraDict(shared_lock=True, lock_free=True, buffer_size=1000)
+        ultra['a'] = 1
+
+        # Writers that have died after reserving space in the stream
+        for code in ('ultra.reserve(20)', 'ultra.lock.acquire(); ultra.reserve(None)'):
+            ret = subprocess.run([sys.executable, '-c', 'import os, sys; sys.path.insert(0, ".."); from UltraDict import UltraDict; '
+                f'ultra = UltraDict(name={ultra.name!r}); {code}; os._exit(0)'])
+            self.assertEqual(ret.returncode, 0)
+        # The second one has also left the lock behind
+        self.assertTrue(ultra.lock.steal_from_dead(ultra.lock.get_remote_pid(), release=True))
+        time_start = time.monotonic()
+        # Checked updates wait for the updates before them
+        ultra.incr('b', 2)
+        self.assertLess(time.monotonic() - time_start, 5)
+
+        # A writer that gives up while waiting for an update before its own
+        other = UltraDict(name=ultra.name)
+        # Nothing in the stream is needed anymore, so there is room for the reservation
+        ultra.dump()
+        start, end = ultra.reserve(20)
+        wait_for_head = UltraDict.wait_for_head
+        def interrupt(self, offset):
+            raise KeyboardInterrupt()
+        UltraDict.wait_for_head = interrupt
+        try:
+            with self.assertRaises(KeyboardInterrupt):
+                other.incr('c')
+        finally:
+            UltraDict.wait_for_head = wait_for_head
+        ultra.abandon_reservation(start, end)
+        ultra['d'] = 4
+
+        self.assertEqual(other.get('d', fresh=True), 4)
+        self.assertEqual(other.data, { 'a': 1, 'b': 2, 'd': 4 })
+        self.assertEqual(UltraDict(name=ultra.name).data, ultra.data)
+
+    def test_lock_free_batch(self):
+        ultra = UltraDict(shared_lock=True, lock_free=True, buffer_size=2000)
+
+        # Batches and full dumps that start the stream over run at the same time as lock-free writers
+        writers = [ subprocess.Popen([sys.executable, '-c', 'import sys; sys.path.insert(0, ".."); from UltraDict import UltraDict; '
+            f'ultra = UltraDict(name={ultra.name!r})\nfor i in range(300): ultra[{n}, i] = i; ultra.incr("counter")']) for n in range(2) ]
+        i = 0
+        while any(writer.poll() is None for writer in writers):
+            with ultra.batch() as batch:
+                batch['batch', i] = i
+                batch['last'] = i
+            if i % 20 == 0:
+                ultra.dump(reset_stream=True)
+            i += 1
+        self.assertEqual([ writer.returncode for writer in writers ], [0, 0])
+
+        self.assertEqual(ultra.get('counter', fresh=True), 600)
+        self.assertEqual(ultra['last'], i - 1)
+        self.assertEqual(len(ultra), 600 + i + 2)
+        self.assertEqual(UltraDict(name=ultra.name).data, ultra.data)
+
+        # A writer that needs the lock before it publishes the update it has reserved
+        writer = subprocess.Popen([sys.executable, '-c', 'import sys; sys.path.insert(0, ".."); from UltraDict import UltraDict; '
+            f'ultra = UltraDict(name={ultra.name!r}); start, end = ultra.reserve(20); print(flush=True); sys.stdin.readline()\n'
+            'with ultra.lock.read(): ultra.abandon_reservation(start, end)'], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        writer.stdout.readline()
+        # The batch must not hold the lock while it waits for the reserved update
+        thread = threading.Thread(target=lambda: ultra.update(batch=True), daemon=True)
+        thread.start()
+        time.sleep(0.1)
+        try:
+            writer.communicate(b'\n', timeout=10)
+        finally:
+            writer.kill()
+        thread.join(10)
+        self.assertFalse(thread.is_alive())
+        self.assertTrue(ultra.get('batch', fresh=True))
+
+    def test_wait_for_update(self):
+        ultra = UltraDict(buffer_size=1000)
+        other = UltraDict(name=ultra.name)
+        self.assertEqual(other.wait_for_update(timeout=0.01), 0)
+
+        def write():
+            time.sleep(0.1)
+            ultra['a'] = 1
+        thread = threading.Thread(target=write)
+        thread.start()
+        self.assertEqual(other.wait_for_update(timeout=10), 1)
+        self.assertEqual(other.data, { 'a': 1 })
+        thread.join()
+
+        ultra['b'] = 2
+        ultra['c'] = 3
+        self.assertEqual(other.wait_for_update(), 2)
+        # Too big for the stream, the full dump counts as one update
+        ultra['big'] = ' ' * 2000
+        self.assertEqual(other.wait_for_update(), 1)
+        self.assertEqual(other.data, ultra.data)
+
+    def test_watch(self):
+        ultra = UltraDict(buffer_size=1000)
+        other = UltraDict(name=ultra.name)
+
+        async def watch():
+            changes = []
+            async for change in other.watch():
+                changes.append(change)
+                if change[0] == 'resync':
+                    return changes
+
+        async def write():
+            await asyncio.sleep(0.05)
+            ultra['a'] = 1
+            ultra.incr('a')
+            with ultra.batch() as batch:
+                batch['b'] = 3
+                del batch['a']
+            await asyncio.sleep(0.1)
+            # Too big for the stream, others have to load the full dump
+            ultra['big'] = ' ' * 2000
+
+        async def main():
+            return await asyncio.gather(watch(), write())
+
+        # Full dumps are read in the executor, not in the thread of the event loop
+        threads = []
+        read_full_dump = UltraDict.read_full_dump
+        def read_in_thread(self):
+            threads.append(threading.current_thread())
+            return read_full_dump(self)
+        UltraDict.read_full_dump = read_in_thread
+        try:
+            changes, _ = asyncio.run(main())
+        finally:
+            UltraDict.read_full_dump = read_full_dump
+        self.assertEqual(changes, [ ('set', 'a', 1), ('set', 'a', 2), ('set', 'b', 3), ('delete', 'a', None), ('resync', None, None) ])
+        self.assertTrue(threads)
+        self.assertNotIn(threading.main_thread(), threads)
+        self.assertEqual(other.data, ultra.data)
+        self.assertEqual(other.listeners, [])
+
+    def test_on_change(self):
+        ultra = UltraDict({ 'user:1': 'a', 'other': 1 }, buffer_size=1000)
+        other = UltraDict(name=ultra.name)
+
+        changes, users = [], []
+        other.on_change(lambda *change: changes.append(change))
+        callback = other.on_change(lambda *change: users.append(change), prefix='user:')
+        other.on_change(lambda *change: 1 / 0, keys=['other'])
+
+        ultra['user:2'] = 'b'
+        ultra.incr('other')
+        del ultra['user:1']
+        other['own'] = True
+        self.assertEqual(len(other), 3)
+        self.assertEqual(changes, [ ('user:2', None, 'b'), ('other', 1, 2), ('user:1', 'a', None), ('own', None, True) ])
+        self.assertEqual(users, [ ('user:2', None, 'b'), ('user:1', 'a', None) ])
+
+        # Only the differences to the full dump are reported
+        del changes[:]
+        other.off_change(callback)
+        ultra['user:2'] = 'c'
+        ultra['big'] = ' ' * 2000
+        other.apply_update()
+        self.assertEqual(sorted(changes), [ ('big', None, ' ' * 2000), ('user:2', 'b', 'c') ])
+        self.assertEqual(len(users), 2)
+
+        # In lazy mode, only values that have changed and are watched get loaded
+        lazy = UltraDict({ i: str(i) for i in range(10) }, buffer_size=1000, lazy=True)
+        lazy.dump()
+        reader = UltraDict(name=lazy.name)
+        lazy_changes = []
+        reader.on_change(lambda *change: lazy_changes.append(change), keys=[1, 2, 'big'])
+        lazy[1] = 'one'
+        lazy[3] = 'three'
+        lazy['big'] = ' ' * 2000
+        reader.apply_update()
+        self.assertEqual(sorted(lazy_changes, key=repr), [ ('big', None, ' ' * 2000), (1, '1', 'one') ])
+        self.assertIsInstance(reader.data[2], UltraDict.LazyValue)
+        self.assertIsInstance(reader.data[3], UltraDict.LazyValue)
+        self.assertEqual(reader[3], 'three')
+
+    def test_changes_since(self):
+        ultra = UltraDict({ 'a': 1 }, buffer_size=1000)
+        other = UltraDict(name=ultra.name)
+
+        cursor = other.cursor()
+        self.assertEqual(other.changes_since(cursor), (set(), cursor))
+
+        ultra['b'] = 2
+        ultra.incr('a')
+        with ultra.batch() as batch:
+            batch['c'] = 3
+            del batch['b']
+        keys, new_cursor = other.changes_since(cursor)
+        self.assertEqual(keys, { 'a', 'b', 'c' })
+        self.assertGreater(new_cursor, cursor)
+        self.assertEqual(other.changes_since(new_cursor), (set(), new_cursor))
+
+        # Too big for the stream, everything has to be read again
+        ultra['big'] = ' ' * 2000
+        keys, cursor = other.changes_since(new_cursor)
+        self.assertIsNone(keys)
+        self.assertEqual(other.changes_since(cursor), (set(), cursor))
+
+    def test_generation(self):
+        # Big enough full dump, so the stream is compacted instead of dumped
+        ultra = UltraDict({ i: i for i in range(10_000) }, buffer_size=1000)
+        other = UltraDict(name=ultra.name)
+        idle = UltraDict(name=ultra.name)
+        self.assertEqual(other.apply_update(), 0)
+
+        # The stream continues in a new lap after the full dump
+        ultra.dump(reset_stream=True)
+        self.assertEqual(other.apply_update(), 1)
+        # Without new updates, a full dump is not loaded
+        ultra.dump()
+        self.assertEqual(other.apply_update(), 0)
+        ultra['a'] = 1
+        self.assertEqual(other['a'], 1)
+
+        compaction_counter = ultra.status()['compaction_counter_remote']
+        lap = ultra.update_stream_lap
+        for i in range(1000):
+            ultra[i % 10] = -i
+            self.assertEqual(other[i % 10], -i)
+        self.assertGreater(ultra.status()['compaction_counter_remote'], compaction_counter)
+        self.assertGreater(ultra.update_stream_lap, lap)
+
+        # Catches up with all of it at once
+        self.assertGreater(idle.apply_update(), 0)
+        self.assertEqual(idle.data, ultra.data)
+        self.assertEqual(other.apply_update(), 0)
+        self.assertEqual(other.generation, int.from_bytes(ultra.generation_remote, 'little'))
+
+    def test_max_staleness(self):
+        ultra = UltraDict({ 'a': 1 })
+        other = UltraDict(name=ultra.name, max_staleness=0.2)
+        self.assertEqual(other['a'], 1)
+
+        ultra['a'] = 2
+        # Checked for new updates just now
+        self.assertEqual(other['a'], 1)
+        self.assertEqual(other.get('a', fresh=True), 2)
+        ultra['a'] = 3
+        self.assertEqual(ultra.get('a', fresh=False), 3)
+        time.sleep(0.2)
+        self.assertEqual(other.get('a'), 3)
+        self.assertEqual(other.get('missing', 4), 4)
+
+    def test_path(self):
+        with tempfile.TemporaryDirectory() as path:
+            ultra = UltraDict(path=path, buffer_size=1000, shared_lock=True)
+            for i in range(100):
+                ultra[i] = i
+            ultra.close()
+
+            # Left over lock of a process that has died
+            ret = subprocess.run([sys.executable, '-c', 'import os, sys; sys.path.insert(0, ".."); from UltraDict import UltraDict; '
+                f'ultra = UltraDict(path={path!r}); ultra["last"] = True; ultra.lock.acquire(); os._exit(0)'])
+            self.assertEqual(ret.returncode, 0)
+
+            # Resumes from the last full dump and the stream
+            ultra = UltraDict(path=path)
+            self.assertEqual(len(ultra), 101)
+            self.assertEqual(ultra[99], 99)
+            self.assertTrue(ultra['last'])
+            ultra['after'] = 1
+            self.assertEqual(UltraDict(path=path)['after'], 1)
+            ultra.unlink()
+
+    def test_checkpoint(self):
+        with tempfile.TemporaryDirectory() as path:
+            file_name = f'{path}/checkpoint'
+            ultra = UltraDict(buffer_size=1000, versions=True)
+            for i in range(100):
+                ultra[i] = i
+            ultra.add(1, 10)
+            ultra.checkpoint(file_name)
+
+            restored = UltraDict.restore(file_name)
+            self.assertEqual(restored, ultra)
+            self.assertEqual(restored.key_versions, ultra.key_versions)
+            self.assertEqual(UltraDict(name=restored.name)[1], 11)
+            restored.unlink()
+
+            # The update stream is compacted instead of dumping the big dict again
+            ultra.update({ i: 'x' * 50 for i in range(2000) })
+            for i in range(100):
+                ultra[0] = i
+            self.assertTrue(ultra.get_compaction_memory_name())
+            ultra.checkpoint(file_name)
+
+            # The compaction is gone right before we attach it, so the checkpoint starts over
+            get_memory = UltraDict.__dict__['get_memory']
+            failed = []
+            def fail_once(*args, name=None, **kwargs):
+                if name == ultra.get_compaction_memory_name() and not failed:
+                    failed.append(name)
+                    raise UltraDict.Exceptions.CannotAttachSharedMemory(name)
+                return get_memory.__func__(*args, name=name, **kwargs)
+            UltraDict.get_memory = staticmethod(fail_once)
+            try:
+                ultra.checkpoint(file_name)
+            finally:
+                UltraDict.get_memory = get_memory
+            self.assertTrue(failed)
+            restored = UltraDict.restore(file_name)
+            self.assertEqual(restored, ultra)
+            restored.unlink()
+
+            ultra.start_checkpoints(file_name, 0.01)
+            ultra['new'] = True
+            time.sleep(0.1)
+            ultra.stop_checkpoints()
+            restored = UltraDict.restore(file_name)
+            self.assertTrue(restored['new'])
+            restored.unlink()
+
+    def test_wal(self):
+        with tempfile.TemporaryDirectory() as path:
+            wal, checkpoint = f'{path}/wal', f'{path}/checkpoint'
+            ultra = UltraDict(buffer_size=1000, wal=wal)
+            for i in range(100):
+                ultra[i] = i
+            ultra.add(1, 10)
+            other = UltraDict(name=ultra.name)
+            self.assertEqual(other.wal, ultra.wal)
+            del other[2]
+            expected = dict(ultra)
+            other.close()
+            ultra.close()
+
+            # Only the write-ahead log is left
+            ultra = UltraDict(buffer_size=1000, wal=wal)
+            self.assertEqual(dict(ultra), expected)
+            ultra.checkpoint(checkpoint)
+            ultra['after'] = True
+            expected['after'] = True
+            ultra.close()
+
+            restored = UltraDict.restore(checkpoint, wal=wal)
+            self.assertEqual(dict(restored), expected)
+            restored.unlink()
+
+    def test_record_codec(self):
+        ultra = UltraDict()
+        other = UltraDict(name=ultra.name)
+        values = { 1: 2, 2: -1.5, 3: None, 4: True, 5: 2**40, 2**70: 1, 6: 2**70, 1.5: 'str', None: (1, 2), False: b'x' }
+        for key, value in values.items():
+            ultra[key] = value
+        del ultra[3]
+        del values[3]
+        self.assertEqual(dict(other), values)
+        self.assertEqual([ type(key) for key in other.data ], [ type(key) for key in values ])
+        self.assertEqual([ type(value) for value in other.data.values() ], [ type(value) for value in values.values() ])
+
+        # Small ints are stored in less bytes than with pickle
+        self.assertLess(len(ultra.dumps_record(1, 1, 2)), len(pickle.dumps((1, 1, 2))))
+        ultra.unlink()
+
+    def test_key_ids(self):
+        ultra = UltraDict(buffer_size=2000, shared_lock=True)
+        other = UltraDict(name=ultra.name)
+        keys = [ f'tenant:{i}:feature:name' for i in range(10) ] + [ b'bytes' ]
+        for i in range(100):
+            ultra[keys[i % len(keys)]] = i
+            other[keys[(i + 1) % len(keys)]] = str(i)
+            if i % 30 == 29:
+                del ultra[keys[2]]
+                ultra.dump()
+        cursor = other.cursor()
+        ultra[keys[3]] = None
+        ultra.add(keys[4], 1)
+        self.assertEqual(dict(other), dict(ultra))
+        self.assertEqual(dict(UltraDict(name=ultra.name)), dict(ultra))
+        self.assertEqual(other.changes_since(cursor)[0], { keys[3], keys[4] })
+
+        # Only the first update of a key after a full dump contains the key
+        self.assertLess(len(ultra.dumps_key_record(1, keys[0], 1)[0]), len(keys[0]))
+        ultra.unlink()
+
+    def test_zero_copy(self):
+        ultra = UltraDict(zero_copy=True)
+        ultra['big'] = b'x' * 100_000
+        ultra['small'] = b'y'
+        ultra.dump()
+
+        other = UltraDict(name=ultra.name)
+        # Big values are views into the full dump memory, small values are copies
+        self.assertIsInstance(other['big'], memoryview)
+        self.assertTrue(other['big'].readonly)
+        self.assertEqual(bytes(other['big']), ultra['big'])
+        self.assertEqual(other['small'], b'y')
+
+        # Views can be dumped again
+        other.dump()
+        self.assertEqual(bytes(UltraDict(name=ultra.name)['big']), ultra['big'])
+
+        with self.assertRaises(UltraDict.Exceptions.ParameterMismatch):
+            UltraDict(name=ultra.name, zero_copy=False)
+
+    def test_lazy(self):
+        ultra = UltraDict(lazy=True, zero_copy=True)
+        ultra['big'] = b'x' * 100_000
+        ultra.update({ i: str(i) for i in range(100) })
+        ultra.dump()
+
+        other = UltraDict(name=ultra.name)
+        # Values are only unserialized on first access
+        self.assertIsInstance(other.data[1], UltraDict.LazyValue)
+        self.assertEqual(other[1], '1')
+        self.assertEqual(other.data[1], '1')
+        self.assertIsInstance(other.data[2], UltraDict.LazyValue)
+        self.assertEqual(bytes(other['big']), ultra['big'])
+
+        # Values that have never been accessed are copied over into new full dumps
+        other[0] = 'zero'
+        other.dump()
+        self.assertEqual(dict(UltraDict(name=ultra.name)), dict(ultra))
+        self.assertEqual(list(other.values())[3], '2')
+
+        with self.assertRaises(UltraDict.Exceptions.ParameterMismatch):
+            UltraDict(name=ultra.name, lazy=False)
+
+        # Closing resolves the placeholders that are left and releases the full dump memory
+        small = UltraDict({ i: str(i) for i in range(10) }, lazy=True)
+        small.dump()
+        reader = UltraDict(name=small.name)
+        self.assertIsInstance(reader.data[1], UltraDict.LazyValue)
+        # Placeholders are loaded for comparisons, from both sides
+        self.assertEqual(UltraDict(name=small.name), { i: str(i) for i in range(10) })
+        self.assertEqual({ i: str(i) for i in range(10) }, UltraDict(name=small.name))
+        self.assertEqual(small, UltraDict(name=small.name))
+        self.assertEqual(reader.close(), { i: str(i) for i in range(10) })
+        self.assertEqual(reader.view_memories, [])
+        small.unlink()
+
+    def test_sharded(self):
+        ultra = ShardedUltraDict({ 'a': 1 }, shards=4, shared_lock=True)
+        other = ShardedUltraDict(name=ultra.name)
+        self.assertEqual(len(other.shards), 4)
+
+        ultra.update({ i: i for i in range(100) })
+        ultra[(1, 'b')] = 'tuple'
+        del ultra[0]
+        self.assertEqual(len(other), 101)
+        self.assertEqual(other['a'], 1)
+        self.assertEqual(other[(1, 'b')], 'tuple')
+        self.assertNotIn(0, other)
+        self.assertEqual(sorted(other.keys(), key=str), sorted(ultra.keys(), key=str))
+        # Keys are spread across all shards
+        self.assertTrue(all(len(shard) for shard in other.shards))
+
+        # The hash of a frozenset does not depend on its order, other types might hash differently in other processes
+        self.assertEqual(ShardedUltraDict.get_hash(frozenset(('x', 'y'))), ShardedUltraDict.get_hash(frozenset(('y', 'x'))))
+        ultra[frozenset(('x', 'y'))] = 'frozenset'
+        self.assertEqual(other[frozenset(('y', 'x'))], 'frozenset')
+        with self.assertRaises(TypeError):
+            ultra[object()] = 1
+
+        with self.assertRaises(UltraDict.Exceptions.ParameterMismatch):
+            ShardedUltraDict(name=ultra.name, shards=3)
+
+        ultra.unlink()
+
+    def test_hash_table(self):
+        ultra = HashTableUltraDict({ 'a': 1 }, capacity=10, arena_size=1000)
+        other = HashTableUltraDict(name=ultra.name)
+
+        ultra[(1, 2)] = [ 3 ]
+        self.assertEqual(other[(1, 2)], [ 3 ])
+        self.assertEqual(other.pop('a'), 1)
+        self.assertNotIn('a', ultra)
+        with self.assertRaises(KeyError):
+            del other['a']
+
+        # Overwriting and deleting leaves garbage that is removed once the arena is full
+        for i in range(1000):
+            ultra[i % 10] = str(i)
+            del ultra[i % 10]
+        ultra.update({ i: str(i) for i in range(10) })
+        self.assertEqual(dict(other.items()), { (1, 2): [ 3 ], **{ i: str(i) for i in range(10) } })
+        self.assertEqual(len(other), 11)
+
+        # Equal numbers are the same key, like in a dict
+        ultra[1.0] = 'float'
+        self.assertEqual(other[1], 'float')
+        self.assertEqual(other[True], 'float')
+        self.assertIn((1, 2.0), other)
+        self.assertEqual(len(other), 11)
+
+        with self.assertRaises(UltraDict.Exceptions.HashTableFull):
+            for i in range(100):
+                ultra[i] = i
+
+        ultra.unlink()
+
     def test_parameter_passing(self):
         ultra = UltraDict(shared_lock=True, buffer_size=4096*8, full_dump_size=4096*8)
         # Connect `other` dict to `ultra` dict via `name`
@@ -150,6 +937,16 @@ class UltraDictTests(unittest.TestCase):
         file_count = len(p.open_files())
         self.assertEqual(file_count, 0, "nested file handle count after deleting UltraDict should be 0 again")
 
+    @unittest.skipUnless(os.path.isdir('/dev/shm'), "requires /dev/shm")
+    def test_cleanup_recurse(self):
+        # Garbage collecting a recurse dict unlinks the nested children and the recurse register
+        memories = set(os.listdir('/dev/shm'))
+        ultra = UltraDict(nested={ 1: 1 }, recurse=True)
+        self.assertEqual(len(set(os.listdir('/dev/shm')) - memories), 6)
+        del ultra
+        gc.collect()
+        self.assertEqual(set(os.listdir('/dev/shm')) - memories, set())
+
     def test_example_simple(self):
         filename = "examples/simple.py"
         ret = self.exec(filename)